@@ -1,6 +1,9 @@
 import os
+from contextlib import nullcontext
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from functools import partial
+from itertools import chain
+from typing import List, Optional, Tuple, Union
 from zipfile import ZipFile
 
 import numpy as np
@@ -11,69 +14,28 @@ from PIL import Image
 from torch import FloatTensor, LongTensor
 from torch.utils.data.dataloader import DataLoader
 
+from .packed import PackedData
+from .sampler import BucketBatchSampler
 from .vocab import vocab
 
-Data = List[Tuple[str, Image.Image, List[str]]]
+Data = List[Tuple[str, Union[Image.Image, np.ndarray], List[int]]]
 
 MAX_SIZE = 32e4  # change here accroading to your GPU memory
 
-# load data
-def data_iterator(
-    data: Data,
-    batch_size: int,
-    batch_Imagesize: int = MAX_SIZE,
-    maxlen: int = 200,
-    maxImagesize: int = MAX_SIZE,
-):
-    fname_batch = []
-    feature_batch = []
-    label_batch = []
-    feature_total = []
-    label_total = []
-    fname_total = []
-    biggest_image_size = 0
-
-    data.sort(key=lambda x: x[1].size[0] * x[1].size[1])
-
-    i = 0
-    for fname, fea, lab in data:
-        size = fea.size[0] * fea.size[1]
-        fea = np.array(fea)
-        if size > biggest_image_size:
-            biggest_image_size = size
-        batch_image_size = biggest_image_size * (i + 1)
-        if len(lab) > maxlen:
-            print("sentence", i, "length bigger than", maxlen, "ignore")
-        elif size > maxImagesize:
-            print(
-                f"image: {fname} size: {fea.shape[0]} x {fea.shape[1]} =  bigger than {maxImagesize}, ignore"
-            )
-        else:
-            if batch_image_size > batch_Imagesize or i == batch_size:  # a batch is full
-                fname_total.append(fname_batch)
-                feature_total.append(feature_batch)
-                label_total.append(label_batch)
-                i = 0
-                biggest_image_size = size
-                fname_batch = []
-                feature_batch = []
-                label_batch = []
-                fname_batch.append(fname)
-                feature_batch.append(fea)
-                label_batch.append(lab)
-                i += 1
-            else:
-                fname_batch.append(fname)
-                feature_batch.append(fea)
-                label_batch.append(lab)
-                i += 1
-
-    # last batch
-    fname_total.append(fname_batch)
-    feature_total.append(feature_batch)
-    label_total.append(label_batch)
-    print("total ", len(feature_total), "batch data loaded")
-    return list(zip(fname_total, feature_total, label_total))
+
+def _image_shape(img: Union[Image.Image, np.ndarray]) -> Tuple[int, int]:
+    if isinstance(img, Image.Image):
+        return img.size[1], img.size[0]
+    return img.shape[0], img.shape[1]
+
+
+def _shapes_and_lens(data: Union[Data, PackedData]) -> Tuple[np.ndarray, np.ndarray]:
+    """image shape and caption length of each sample, without loading packed images"""
+    if isinstance(data, PackedData):
+        return data.shapes, np.diff(data.token_offsets)
+    shapes = np.array([_image_shape(img) for _, img, _ in data], dtype=np.int64)
+    lens = np.array([len(caption) for _, _, caption in data], dtype=np.int64)
+    return shapes.reshape(-1, 2), lens
 
 
 def extract_data(archive: ZipFile, dir_name: str) -> Data:
@@ -84,7 +46,7 @@ def extract_data(archive: ZipFile, dir_name: str) -> Data:
         dir_name (str): dir name in archive zip (eg: train, test_2014......)
 
     Returns:
-        Data: list of tuple of image and formula
+        Data: list of tuple of image and formula indices
     """
     with archive.open(f"data/{dir_name}/caption.txt", "r") as f:
         captions = f.readlines()
@@ -96,7 +58,7 @@ def extract_data(archive: ZipFile, dir_name: str) -> Data:
         with archive.open(f"data/{dir_name}/img/{img_name}.bmp", "r") as f:
             # move image to memory immediately, avoid lazy loading, which will lead to None pointer error in loading
             img = Image.open(f).copy()
-        data.append((img_name, img, formula))
+        data.append((img_name, img, vocab.words2indices(formula)))
 
     print(f"Extract data from: {dir_name}, with data size: {len(data)}")
 
@@ -108,47 +70,109 @@ class Batch:
     img_bases: List[str]  # [b,]
     imgs: FloatTensor  # [b, 1, H, W]
     mask: LongTensor  # [b, H, W]
-    indices: List[List[int]]  # [b, l]
+    indices: LongTensor  # [b, l], padded with PAD_IDX
+    lens: LongTensor  # [b,]
 
     def __len__(self) -> int:
         return len(self.img_bases)
 
+    def pin_memory(self) -> "Batch":
+        # called by DataLoader with pin_memory=True, which then reuses
+        # page-locked buffers through the caching host allocator
+        return Batch(
+            img_bases=self.img_bases,
+            imgs=self.imgs.pin_memory(),
+            mask=self.mask.pin_memory(),
+            indices=self.indices.pin_memory(),
+            lens=self.lens.pin_memory(),
+        )
+
     def to(self, device) -> "Batch":
+        # non_blocking takes effect when the batch is in pinned memory
         return Batch(
             img_bases=self.img_bases,
-            imgs=self.imgs.to(device),
-            mask=self.mask.to(device),
-            indices=self.indices,
+            imgs=self.imgs.to(device, non_blocking=True),
+            mask=self.mask.to(device, non_blocking=True),
+            indices=self.indices.to(device, non_blocking=True),
+            lens=self.lens.to(device, non_blocking=True),
         )
 
+    def indices_list(self) -> List[List[int]]:
+        return [seq[:l] for seq, l in zip(self.indices.tolist(), self.lens.tolist())]
 
-def collate_fn(batch):
-    assert len(batch) == 1
-    batch = batch[0]
-    fnames = batch[0]
-    images_x = batch[1]
-    seqs_y = [vocab.words2indices(x) for x in batch[2]]
 
-    heights_x = [s.size(1) for s in images_x]
-    widths_x = [s.size(2) for s in images_x]
+def pad_indices(seqs: List[List[int]]) -> Tuple[LongTensor, LongTensor]:
+    """pad indices of sequences into a tensor
 
-    n_samples = len(heights_x)
-    max_height_x = max(heights_x)
-    max_width_x = max(widths_x)
+    Parameters
+    ----------
+    seqs : List[List[int]]
+        [b, l]
 
-    x = torch.zeros(n_samples, 1, max_height_x, max_width_x)
-    x_mask = torch.ones(n_samples, max_height_x, max_width_x, dtype=torch.bool)
+    Returns
+    -------
+    Tuple[LongTensor, LongTensor]
+        indices: [b, max(l)], padded with PAD_IDX
+        lens: [b]
+    """
+    lens = torch.tensor([len(s) for s in seqs], dtype=torch.long)
+    indices = torch.full((len(seqs), int(lens.max())), vocab.PAD_IDX, dtype=torch.long)
+    indices[torch.arange(indices.size(1))[None, :] < lens[:, None]] = torch.tensor(
+        list(chain.from_iterable(seqs)), dtype=torch.long
+    )
+    return indices, lens
+
+
+def _round_up(x: int, multiple: int) -> int:
+    return (x + multiple - 1) // multiple * multiple
+
+
+def collate_fn(
+    batch: List[Tuple[str, FloatTensor, List[int]]], pad_multiple: int = 1
+) -> Batch:
+    """pad images and captions of samples into a batch
+
+    Parameters
+    ----------
+    batch : List[Tuple[str, FloatTensor, List[int]]]
+        file name, image of [1, h, w] and caption indices of each sample
+    pad_multiple : int, optional
+        round padded H and W up to a multiple of it, so that batches share
+        a few shapes, by default 1
+
+    Returns
+    -------
+    Batch
+    """
+    fnames = [b[0] for b in batch]
+    images_x = [b[1] for b in batch]
+    seqs_y = [b[2] for b in batch]
+
+    heights_x = torch.tensor([s.size(1) for s in images_x])
+    widths_x = torch.tensor([s.size(2) for s in images_x])
+
+    n_samples = len(images_x)
+    max_height_x = _round_up(int(heights_x.max()), pad_multiple)
+    max_width_x = _round_up(int(widths_x.max()), pad_multiple)
+
+    x = images_x[0].new_zeros(n_samples, 1, max_height_x, max_width_x)
     for idx, s_x in enumerate(images_x):
-        x[idx, :, : heights_x[idx], : widths_x[idx]] = s_x
-        x_mask[idx, : heights_x[idx], : widths_x[idx]] = 0
+        x[idx, :, : s_x.size(1), : s_x.size(2)] = s_x
+    x_mask = (torch.arange(max_height_x)[None, :, None] >= heights_x[:, None, None]) | (
+        torch.arange(max_width_x)[None, None, :] >= widths_x[:, None, None]
+    )
+
+    indices, lens = pad_indices(seqs_y)
+
+    return Batch(fnames, x, x_mask, indices, lens)
 
-    # return fnames, x, x_mask, seqs_y
-    return Batch(fnames, x, x_mask, seqs_y)
 
+def build_dataset(archive, folder: str) -> Data:
+    return extract_data(archive, folder)
 
-def build_dataset(archive, folder: str, batch_size: int):
-    data = extract_data(archive, folder)
-    return data_iterator(data, batch_size)
+
+def build_packed_dataset(packed_path: str, folder: str) -> PackedData:
+    return PackedData(os.path.join(packed_path, folder))
 
 
 class CROHMEDatamodule(pl.LightningDataModule):
@@ -160,58 +184,86 @@ class CROHMEDatamodule(pl.LightningDataModule):
         eval_batch_size: int = 4,
         num_workers: int = 5,
         scale_aug: bool = False,
+        packed_path: Optional[str] = None,
+        pad_multiple: int = 1,
     ) -> None:
+        """
+        packed_path is the output folder of scripts/pack_data.py, when given,
+        data is read from it through memory map instead of from zipfile_path.
+        pad_multiple rounds padded image sizes up, e.g. 32 lets pinned host
+        buffers and cudnn algorithms be reused across batches of similar size,
+        at the cost of extra padding.
+        """
         super().__init__()
         assert isinstance(test_year, str)
         self.zipfile_path = zipfile_path
+        self.packed_path = packed_path
         self.test_year = test_year
         self.train_batch_size = train_batch_size
         self.eval_batch_size = eval_batch_size
         self.num_workers = num_workers
         self.scale_aug = scale_aug
+        self.pad_multiple = pad_multiple
+
+        print(f"Load data from: {self.packed_path or self.zipfile_path}")
 
-        print(f"Load data from: {self.zipfile_path}")
+    def _build_dataset(self, archive: Optional[ZipFile], folder: str):
+        if self.packed_path is not None:
+            return build_packed_dataset(self.packed_path, folder)
+        return build_dataset(archive, folder)
 
     def setup(self, stage: Optional[str] = None) -> None:
-        with ZipFile(self.zipfile_path) as archive:
+        if self.packed_path is not None:
+            archive_ctx = nullcontext()
+        else:
+            archive_ctx = ZipFile(self.zipfile_path)
+
+        with archive_ctx as archive:
             if stage == "fit" or stage is None:
                 self.train_dataset = CROHMEDataset(
-                    build_dataset(archive, "train", self.train_batch_size),
+                    self._build_dataset(archive, "train"),
                     True,
                     self.scale_aug,
                 )
                 self.val_dataset = CROHMEDataset(
-                    build_dataset(archive, self.test_year, self.eval_batch_size),
+                    self._build_dataset(archive, self.test_year),
                     False,
                     self.scale_aug,
                 )
             if stage == "test" or stage is None:
                 self.test_dataset = CROHMEDataset(
-                    build_dataset(archive, self.test_year, self.eval_batch_size),
+                    self._build_dataset(archive, self.test_year),
                     False,
                     self.scale_aug,
                 )
 
-    def train_dataloader(self):
+    def _dataloader(self, dataset: CROHMEDataset, batch_size: int, shuffle: bool):
+        # built here rather than in setup, when distributed is initialized
+        shapes, lens = _shapes_and_lens(dataset.ds)
+        batch_sampler = BucketBatchSampler(
+            shapes,
+            lens,
+            batch_size,
+            batch_Imagesize=MAX_SIZE,
+            maxImagesize=MAX_SIZE,
+            shuffle=shuffle,
+        )
+        print("total ", len(batch_sampler), "batch data loaded")
+        if batch_sampler.num_replicas > 1 and batch_sampler.rank == 0:
+            print(f"expected imbalance between ranks: {batch_sampler.report()}")
         return DataLoader(
-            self.train_dataset,
-            shuffle=True,
+            dataset,
+            batch_sampler=batch_sampler,
             num_workers=self.num_workers,
-            collate_fn=collate_fn,
+            collate_fn=partial(collate_fn, pad_multiple=self.pad_multiple),
+            pin_memory=True,
         )
 
+    def train_dataloader(self):
+        return self._dataloader(self.train_dataset, self.train_batch_size, True)
+
     def val_dataloader(self):
-        return DataLoader(
-            self.val_dataset,
-            shuffle=False,
-            num_workers=self.num_workers,
-            collate_fn=collate_fn,
-        )
+        return self._dataloader(self.val_dataset, self.eval_batch_size, False)
 
     def test_dataloader(self):
-        return DataLoader(
-            self.test_dataset,
-            shuffle=False,
-            num_workers=self.num_workers,
-            collate_fn=collate_fn,
-        )
+        return self._dataloader(self.test_dataset, self.eval_batch_size, False)
@@ -1,4 +1,9 @@
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
 import torchvision.transforms as tr
+from PIL import Image
+from torch import FloatTensor
 from torch.utils.data.dataset import Dataset
 
 from .transforms import ScaleAugmentation, ScaleToLimitRange
@@ -13,7 +18,12 @@ W_HI = 1024
 
 
 class CROHMEDataset(Dataset):
-    def __init__(self, ds, is_train: bool, scale_aug: bool) -> None:
+    def __init__(
+        self,
+        ds: Sequence[Tuple[str, Union[Image.Image, np.ndarray], List[int]]],
+        is_train: bool,
+        scale_aug: bool,
+    ) -> None:
         super().__init__()
         self.ds = ds
 
@@ -27,10 +37,12 @@ class CROHMEDataset(Dataset):
         ]
         self.transform = tr.Compose(trans_list)
 
-    def __getitem__(self, idx):
+    def __getitem__(self, idx: int) -> Tuple[str, FloatTensor, List[int]]:
         fname, img, caption = self.ds[idx]
 
-        img = [self.transform(im) for im in img]
+        if isinstance(img, Image.Image):
+            img = np.array(img)
+        img = self.transform(img)
 
         return fname, img, caption
 
@@ -0,0 +1,93 @@
+import os
+from itertools import chain
+from typing import List, Tuple
+from zipfile import ZipFile
+
+import numpy as np
+from PIL import Image
+
+from .vocab import vocab
+
+IMAGES_FILE = "images.bin"
+META_FILE = "meta.npz"
+
+
+def pack_data(archive: ZipFile, dir_name: str, out_dir: str) -> None:
+    """Pack a dataset in zip archive into a contiguous uint8 image blob and an index
+
+    Args:
+        archive (ZipFile):
+        dir_name (str): dir name in archive zip (eg: train, test_2014......)
+        out_dir (str): folder to write images.bin and meta.npz into
+    """
+    with archive.open(f"data/{dir_name}/caption.txt", "r") as f:
+        captions = f.readlines()
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    names = []
+    offsets = []
+    shapes = []
+    tokens = []
+    offset = 0
+    with open(os.path.join(out_dir, IMAGES_FILE), "wb") as blob:
+        for line in captions:
+            tmp = line.decode().strip().split()
+            img_name = tmp[0]
+            formula = tmp[1:]
+            with archive.open(f"data/{dir_name}/img/{img_name}.bmp", "r") as f:
+                img = np.array(Image.open(f))
+            assert img.ndim == 2 and img.dtype == np.uint8, f"{img_name}: {img.dtype}"
+
+            blob.write(img.tobytes())
+            names.append(img_name)
+            offsets.append(offset)
+            shapes.append(img.shape)
+            tokens.append(vocab.words2indices(formula))
+            offset += img.size
+
+    token_offsets = np.cumsum([0] + [len(t) for t in tokens])
+    np.savez(
+        os.path.join(out_dir, META_FILE),
+        names=np.array(names),
+        offsets=np.array(offsets, dtype=np.int64),
+        shapes=np.array(shapes, dtype=np.int64).reshape(-1, 2),
+        tokens=np.fromiter(chain.from_iterable(tokens), dtype=np.int64),
+        token_offsets=token_offsets.astype(np.int64),
+    )
+
+    print(f"Pack data from: {dir_name}, with data size: {len(names)}")
+
+
+class PackedData:
+    """Read a dataset packed by pack_data through np.memmap
+
+    Images are views into the memory-mapped blob, so they are loaded lazily
+    and shared by all processes reading the same file.
+    """
+
+    def __init__(self, data_dir: str) -> None:
+        # copy-on-write, so that images are writable views without touching the file
+        self.images = np.memmap(
+            os.path.join(data_dir, IMAGES_FILE), dtype=np.uint8, mode="c"
+        )
+
+        meta = np.load(os.path.join(data_dir, META_FILE))
+        self.names: List[str] = meta["names"].tolist()
+        self.offsets = meta["offsets"]
+        self.shapes = meta["shapes"]
+        self.tokens = meta["tokens"]
+        self.token_offsets = meta["token_offsets"]
+
+        print(f"Load packed data from: {data_dir}, with data size: {len(self)}")
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, idx: int) -> Tuple[str, np.ndarray, List[int]]:
+        h, w = self.shapes[idx]
+        start = self.offsets[idx]
+        img = self.images[start : start + h * w].reshape(h, w)
+
+        caption = self.tokens[self.token_offsets[idx] : self.token_offsets[idx + 1]]
+        return self.names[idx], img, caption.tolist()
@@ -0,0 +1,270 @@
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data.sampler import Sampler
+
+
+def bucket_by_size(
+    indices: Sequence[int], sizes: Sequence[int], batch_size: int, batch_Imagesize: int
+) -> List[List[int]]:
+    """group indices into batches in ascending order of image size, a batch is full
+    when it has batch_size images or (biggest image size * number of images)
+    exceeds batch_Imagesize
+
+    Parameters
+    ----------
+    indices : Sequence[int]
+    sizes : Sequence[int]
+        h * w of each image, indexed by indices
+    batch_size : int
+    batch_Imagesize : int
+
+    Returns
+    -------
+    List[List[int]]
+        indices of images in each batch
+    """
+    batches = []
+    batch = []
+    biggest_image_size = 0
+    for idx in sorted(indices, key=lambda i: sizes[i]):
+        biggest_image_size = max(biggest_image_size, sizes[idx])
+        if batch and (
+            biggest_image_size * (len(batch) + 1) > batch_Imagesize
+            or len(batch) == batch_size
+        ):
+            batches.append(batch)
+            batch = []
+            biggest_image_size = sizes[idx]
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler grouping images of similar size under a pixel budget
+
+    When shuffle, indices are shuffled every epoch and bucketed within pools of
+    bucket_pool batches, so the composition of batches changes between epochs.
+    The number of batches is that of bucketing all images at once in every epoch:
+    surplus batches of an epoch are dropped after shuffling, and missing ones are
+    repeated, so len() depends only on the dataset.
+    In distributed training, batches are sharded to ranks so that batches of a
+    step have similar estimated compute, see batch_cost and report.
+    """
+
+    def __init__(
+        self,
+        shapes: Sequence[Tuple[int, int]],
+        lens: Sequence[int],
+        batch_size: int,
+        batch_Imagesize: int,
+        maxlen: int = 200,
+        maxImagesize: Optional[int] = None,
+        shuffle: bool = False,
+        seed: int = 0,
+        bucket_pool: int = 100,
+        token_cost: float = 100.0,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        shapes : Sequence[Tuple[int, int]]
+            [n, 2] h and w of each image
+        lens : Sequence[int]
+            caption length of each image
+        batch_size : int
+        batch_Imagesize : int
+            pixel budget of a batch
+        maxlen : int, optional
+            images with longer captions are ignored, by default 200
+        maxImagesize : Optional[int], optional
+            bigger images are ignored, by default batch_Imagesize
+        shuffle : bool, optional
+            by default False
+        seed : int, optional
+            seed of shuffling, same on all ranks, by default 0
+        bucket_pool : int, optional
+            number of batches bucketed together when shuffle, by default 100
+        token_cost : float, optional
+            estimated compute of a target token relative to a padded pixel, used to
+            balance ranks, by default 100.0 (about the FLOPs ratio of a decoder
+            step to an encoder pixel of the default model)
+        num_replicas : Optional[int], optional
+            by default the world size if distributed is initialized, else 1
+        rank : Optional[int], optional
+            by default the rank if distributed is initialized, else 0
+        """
+        if maxImagesize is None:
+            maxImagesize = batch_Imagesize
+        if num_replicas is None:
+            is_dist = dist.is_available() and dist.is_initialized()
+            num_replicas = dist.get_world_size() if is_dist else 1
+        if rank is None:
+            is_dist = dist.is_available() and dist.is_initialized()
+            rank = dist.get_rank() if is_dist else 0
+        assert 0 <= rank < num_replicas
+
+        self.shapes = np.asarray(shapes, dtype=np.int64).reshape(-1, 2)
+        self.sizes = self.shapes.prod(axis=1)
+        self.lens = np.asarray(lens, dtype=np.int64)
+        self.batch_size = batch_size
+        self.batch_Imagesize = batch_Imagesize
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_pool = bucket_pool
+        self.token_cost = token_cost
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        too_long = self.lens > maxlen
+        too_big = self.sizes > maxImagesize
+        for i in np.nonzero(too_long)[0]:
+            print("sentence", i, "length bigger than", maxlen, "ignore")
+        for i in np.nonzero(too_big & ~too_long)[0]:
+            print(
+                f"image: {i} size: {self.sizes[i]} bigger than {maxImagesize}, ignore"
+            )
+        self.indices = np.nonzero(~(too_long | too_big))[0]
+        self.buckets = bucket_by_size(
+            self.indices, self.sizes, self.batch_size, self.batch_Imagesize
+        )
+
+        self._cached_epoch = None
+        self._cached_batches = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _rng(self) -> Optional[np.random.RandomState]:
+        # one stream per epoch, shared by all shuffles of the epoch
+        if not self.shuffle:
+            return None
+        return np.random.RandomState(self.seed + self.epoch)
+
+    def _bucket(self, rng: Optional[np.random.RandomState]) -> List[List[int]]:
+        if rng is None:
+            return self.buckets
+
+        indices = rng.permutation(self.indices)
+        pool_size = self.bucket_pool * self.batch_size
+
+        batches = []
+        for i in range(0, len(indices), pool_size):
+            batches += bucket_by_size(
+                indices[i : i + pool_size],
+                self.sizes,
+                self.batch_size,
+                self.batch_Imagesize,
+            )
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        # pools pack a little worse than all images at once, keep the number of
+        # batches fixed over epochs
+        num_batches = len(self.buckets)
+        padding = max(num_batches - len(batches), 0)
+        batches += [batches[i % len(batches)] for i in range(padding)]
+        return batches[:num_batches]
+
+    def batch_cost(self, batch: Sequence[int]) -> float:
+        """estimated compute of a batch, padded pixels plus padded target tokens
+        of both directions
+        """
+        h, w = self.shapes[batch].max(axis=0)
+        l = self.lens[batch].max() + 1
+        return len(batch) * (h * w + self.token_cost * 2 * l)
+
+    def _assign(
+        self, batches: List[List[int]], rng: Optional[np.random.RandomState]
+    ) -> List[List[int]]:
+        """assign batches to ranks, balancing the straggler of each step, steps
+        are shuffled by rng if given
+
+        Returns
+        -------
+        List[List[int]]
+            [steps, num_replicas] index of the batch each rank runs at each step
+        """
+        costs = [self.batch_cost(b) for b in batches]
+        # batches of similar cost run at the same step on all ranks
+        order = sorted(range(len(batches)), key=lambda i: costs[i], reverse=True)
+        # pad to make it evenly divisible like DistributedSampler
+        padding = -len(order) % self.num_replicas
+        order += [order[-1 - i % len(order)] for i in range(padding)]
+
+        steps = []
+        loads = np.zeros(self.num_replicas)
+        for i in range(0, len(order), self.num_replicas):
+            # the costliest batch of a step goes to the least loaded rank,
+            # so that total loads of ranks are balanced as well
+            step = [0] * self.num_replicas
+            for rank, idx in zip(loads.argsort(kind="stable"), order[i:]):
+                step[rank] = idx
+                loads[rank] += costs[idx]
+            steps.append(step)
+
+        if rng is not None:
+            steps = [steps[i] for i in rng.permutation(len(steps))]
+        return steps
+
+    def _shard(
+        self, batches: List[List[int]], rng: Optional[np.random.RandomState]
+    ) -> List[List[int]]:
+        if self.num_replicas == 1:
+            return batches
+        return [batches[step[self.rank]] for step in self._assign(batches, rng)]
+
+    def report(self) -> Dict[str, float]:
+        """expected imbalance between ranks of the next epoch
+
+        Returns
+        -------
+        Dict[str, float]
+            step_overhead: time lost waiting for the straggler of each step,
+                relative to perfectly balanced steps
+            round_robin_step_overhead: the same if batches were split round-robin
+                as DistributedSampler does
+            rank_imbalance: max total cost of a rank over the mean
+        """
+        rng = self._rng()
+        batches = self._bucket(rng)
+        costs = np.array([self.batch_cost(b) for b in batches])
+
+        def step_overhead(steps: np.ndarray) -> float:
+            return float(steps.max(axis=1).sum() / steps.mean(axis=1).sum() - 1)
+
+        steps = costs[np.array(self._assign(batches, rng))]
+        padding = -len(costs) % self.num_replicas
+        round_robin = np.resize(costs, len(costs) + padding)
+        round_robin = round_robin.reshape(-1, self.num_replicas)
+
+        rank_loads = steps.sum(axis=0)
+        return {
+            "num_replicas": self.num_replicas,
+            "steps": len(steps),
+            "step_overhead": step_overhead(steps),
+            "round_robin_step_overhead": step_overhead(round_robin),
+            "rank_imbalance": float(rank_loads.max() / rank_loads.mean() - 1),
+        }
+
+    def _batches(self) -> List[List[int]]:
+        if self._cached_epoch != self.epoch:
+            rng = self._rng()
+            self._cached_batches = self._shard(self._bucket(rng), rng)
+            self._cached_epoch = self.epoch
+        return self._cached_batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._batches()
+        # re-bucket in the next epoch, if set_epoch is not called
+        self.epoch += 1
+        return iter([[int(i) for i in b] for b in batches])
+
+    def __len__(self) -> int:
+        # the same in every epoch, ranks are padded to the same number of steps
+        return -(-len(self.buckets) // self.num_replicas)
@@ -0,0 +1,149 @@
+import os
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple, Union
+
+import numpy as np
+import torch
+import torchvision.transforms as tr
+from PIL import Image
+
+from comer.datamodule import vocab
+from comer.datamodule.datamodule import MAX_SIZE, collate_fn
+from comer.datamodule.dataset import H_HI, H_LO, W_HI, W_LO
+from comer.datamodule.sampler import bucket_by_size
+from comer.datamodule.transforms import ScaleToLimitRange
+from comer.lit_comer import LitCoMER
+from comer.quantization import load_quantized
+
+ImageInput = Union[str, os.PathLike, Image.Image, np.ndarray]
+
+
+def _load_image(img: ImageInput) -> np.ndarray:
+    if isinstance(img, (str, os.PathLike)):
+        with Image.open(img) as f:
+            return np.array(f.convert("L"))
+    if isinstance(img, Image.Image):
+        return np.array(img.convert("L"))
+    if isinstance(img, np.ndarray):
+        assert img.ndim == 2, f"expect a gray image of [h, w], got shape {img.shape}"
+        return img
+    raise TypeError(f"unsupported image type: {type(img)}")
+
+
+class Recognizer:
+    """recognize images of handwritten mathematical expressions with a trained checkpoint
+
+    Examples
+    --------
+    >>> recognizer = Recognizer("lightning_logs/version_0/checkpoints/xxx.ckpt")  # doctest: +SKIP
+    >>> for img_id, latex, score in recognizer(["a.bmp", "b.bmp"]):  # doctest: +SKIP
+    ...     print(img_id, latex, score)
+    """
+
+    def __init__(
+        self,
+        checkpoint_path: str,
+        device: Union[str, torch.device] = "cpu",
+        batch_size: int = 8,
+        batch_Imagesize: int = MAX_SIZE,
+        chunk_size: int = 256,
+        quantized: bool = False,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        checkpoint_path : str
+            checkpoint of LitCoMER
+        device : Union[str, torch.device], optional
+            by default "cpu"
+        batch_size : int, optional
+            max number of images in a batch, by default 8
+        batch_Imagesize : int, optional
+            pixel budget of a batch, same as in training, by default MAX_SIZE
+        chunk_size : int, optional
+            number of images read from the input before bucketing, by default 256
+        quantized : bool, optional
+            checkpoint_path is an int8 checkpoint of scripts/quantize.py, which
+            runs on cpu only, by default False
+        """
+        self.device = torch.device(device)
+        if quantized:
+            assert self.device.type == "cpu", "quantized model runs on cpu only"
+            self.model = load_quantized(checkpoint_path)
+        else:
+            self.model = LitCoMER.load_from_checkpoint(
+                checkpoint_path, map_location=self.device
+            )
+        self.model = self.model.eval().to(self.device)
+
+        self.batch_size = batch_size
+        self.batch_Imagesize = batch_Imagesize
+        self.chunk_size = chunk_size
+
+        self.transform = tr.Compose(
+            [
+                ScaleToLimitRange(w_lo=W_LO, w_hi=W_HI, h_lo=H_LO, h_hi=H_HI),
+                tr.ToTensor(),
+            ]
+        )
+
+    def __call__(
+        self, images: Iterable[Union[ImageInput, Tuple[str, ImageInput]]]
+    ) -> Iterator[Tuple[str, str, float]]:
+        return self.recognize(images)
+
+    def recognize(
+        self, images: Iterable[Union[ImageInput, Tuple[str, ImageInput]]]
+    ) -> Iterator[Tuple[str, str, float]]:
+        """recognize a stream of images
+
+        Parameters
+        ----------
+        images : Iterable[Union[ImageInput, Tuple[str, ImageInput]]]
+            image paths, PIL images or gray numpy arrays of [h, w],
+            optionally paired with an id as (id, image)
+
+        Yields
+        -------
+        Iterator[Tuple[str, str, float]]
+            (id, latex, score) in input order, id defaults to the path of the
+            image, or its index in the input
+        """
+        it = iter(images)
+        offset = 0
+        while True:
+            chunk = list(islice(it, self.chunk_size))
+            if len(chunk) == 0:
+                return
+
+            ids, imgs = [], []
+            for i, item in enumerate(chunk):
+                if isinstance(item, tuple):
+                    img_id, img = item
+                elif isinstance(item, (str, os.PathLike)):
+                    img_id, img = os.fspath(item), item
+                else:
+                    img_id, img = str(offset + i), item
+                ids.append(img_id)
+                imgs.append(self.transform(_load_image(img)))
+            offset += len(chunk)
+
+            results = [None] * len(chunk)
+            sizes = [img.shape[1] * img.shape[2] for img in imgs]
+            for indices in bucket_by_size(
+                range(len(sizes)), sizes, self.batch_size, self.batch_Imagesize
+            ):
+                for idx, hyp in zip(
+                    indices, self._recognize([imgs[i] for i in indices])
+                ):
+                    results[idx] = hyp
+
+            for img_id, (latex, score) in zip(ids, results):
+                yield img_id, latex, score
+
+    @torch.no_grad()
+    def _recognize(self, imgs: List[torch.Tensor]) -> List[Tuple[str, float]]:
+        batch = collate_fn([("", img, []) for img in imgs])
+        batch = batch.to(self.device)
+        hyps = self.model.approximate_joint_search(batch.imgs, batch.mask)
+        return [(vocab.indices2label(h.seq), float(h.score)) for h in hyps]
@@ -1,5 +1,5 @@
 import zipfile
-from typing import List
+from typing import List, Tuple
 
 import pytorch_lightning as pl
 import torch.optim as optim
@@ -35,6 +35,8 @@ class LitCoMER(pl.LightningModule):
         # training
         learning_rate: float,
         patience: int,
+        # checkpointed dense blocks, see comer.model.encoder._DenseBlock
+        memory_efficient: bool = False,
     ):
         super().__init__()
         self.save_hyperparameters()
@@ -50,9 +52,13 @@ class LitCoMER(pl.LightningModule):
             dc=dc,
             cross_coverage=cross_coverage,
             self_coverage=self_coverage,
+            memory_efficient=memory_efficient,
         )
 
         self.exprate_recorder = ExpRateRecorder()
+        # ExpRate with at most 1 and 2 token errors
+        self.exprate_recorder_1 = ExpRateRecorder(error_tol=1)
+        self.exprate_recorder_2 = ExpRateRecorder(error_tol=2)
 
     def forward(
         self, img: FloatTensor, img_mask: LongTensor, tgt: LongTensor
@@ -76,7 +82,7 @@ class LitCoMER(pl.LightningModule):
         return self.comer_model(img, img_mask, tgt)
 
     def training_step(self, batch: Batch, _):
-        tgt, out = to_bi_tgt_out(batch.indices, self.device)
+        tgt, out = to_bi_tgt_out(batch.indices, batch.lens)
         out_hat = self(batch.imgs, batch.mask, tgt)
 
         loss = ce_loss(out_hat, out)
@@ -85,7 +91,7 @@ class LitCoMER(pl.LightningModule):
         return loss
 
     def validation_step(self, batch: Batch, _):
-        tgt, out = to_bi_tgt_out(batch.indices, self.device)
+        tgt, out = to_bi_tgt_out(batch.indices, batch.lens)
         out_hat = self(batch.imgs, batch.mask, tgt)
 
         loss = ce_loss(out_hat, out)
@@ -98,9 +104,9 @@ class LitCoMER(pl.LightningModule):
             sync_dist=True,
         )
 
-        hyps = self.approximate_joint_search(batch.imgs, batch.mask)
+        hyps, hyp_lens, _ = self.padded_joint_search(batch.imgs, batch.mask)
+        self._record_exprate(hyps, hyp_lens, batch)
 
-        self.exprate_recorder([h.seq for h in hyps], batch.indices)
         self.log(
             "val_ExpRate",
             self.exprate_recorder,
@@ -108,15 +114,23 @@ class LitCoMER(pl.LightningModule):
             on_step=False,
             on_epoch=True,
         )
+        self.log("val_ExpRate_1", self.exprate_recorder_1, on_step=False, on_epoch=True)
+        self.log("val_ExpRate_2", self.exprate_recorder_2, on_step=False, on_epoch=True)
 
     def test_step(self, batch: Batch, _):
-        hyps = self.approximate_joint_search(batch.imgs, batch.mask)
-        self.exprate_recorder([h.seq for h in hyps], batch.indices)
-        return batch.img_bases, [vocab.indices2label(h.seq) for h in hyps]
+        hyps, hyp_lens, _ = self.padded_joint_search(batch.imgs, batch.mask)
+        self._record_exprate(hyps, hyp_lens, batch)
+        preds = [
+            vocab.indices2label(hyp[:l])
+            for hyp, l in zip(hyps.tolist(), hyp_lens.tolist())
+        ]
+        return batch.img_bases, preds
 
     def test_epoch_end(self, test_outputs) -> None:
         exprate = self.exprate_recorder.compute()
         print(f"Validation ExpRate: {exprate}")
+        print(f"Validation ExpRate <= 1 error: {self.exprate_recorder_1.compute()}")
+        print(f"Validation ExpRate <= 2 errors: {self.exprate_recorder_2.compute()}")
 
         with zipfile.ZipFile("result.zip", "w") as zip_f:
             for img_bases, preds in test_outputs:
@@ -125,11 +139,27 @@ class LitCoMER(pl.LightningModule):
                     with zip_f.open(f"{img_base}.txt", "w") as f:
                         f.write(content)
 
+    def _record_exprate(
+        self, hyps: LongTensor, hyp_lens: LongTensor, batch: Batch
+    ) -> None:
+        # padded hypotheses stay on device, no per-sample python work
+        for recorder in [
+            self.exprate_recorder,
+            self.exprate_recorder_1,
+            self.exprate_recorder_2,
+        ]:
+            recorder(hyps, hyp_lens, batch.indices, batch.lens)
+
     def approximate_joint_search(
         self, img: FloatTensor, mask: LongTensor
     ) -> List[Hypothesis]:
         return self.comer_model.beam_search(img, mask, **self.hparams)
 
+    def padded_joint_search(
+        self, img: FloatTensor, mask: LongTensor
+    ) -> Tuple[LongTensor, LongTensor, FloatTensor]:
+        return self.comer_model.padded_beam_search(img, mask, **self.hparams)
+
     def configure_optimizers(self):
         optimizer = optim.SGD(
             self.parameters(),
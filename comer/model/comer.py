@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Tuple
 
 import pytorch_lightning as pl
 import torch
@@ -23,11 +23,15 @@ class CoMER(pl.LightningModule):
         dc: int,
         cross_coverage: bool,
         self_coverage: bool,
+        memory_efficient: bool = False,
     ):
         super().__init__()
 
         self.encoder = Encoder(
-            d_model=d_model, growth_rate=growth_rate, num_layers=num_layers
+            d_model=d_model,
+            growth_rate=growth_rate,
+            num_layers=num_layers,
+            memory_efficient=memory_efficient,
         )
         self.decoder = Decoder(
             d_model=d_model,
@@ -97,3 +101,36 @@ class CoMER(pl.LightningModule):
         return self.decoder.beam_search(
             [feature], [mask], beam_size, max_len, alpha, early_stopping, temperature
         )
+
+    def padded_beam_search(
+        self,
+        img: FloatTensor,
+        img_mask: LongTensor,
+        beam_size: int,
+        max_len: int,
+        alpha: float,
+        early_stopping: bool,
+        temperature: float,
+        **kwargs,
+    ) -> Tuple[LongTensor, LongTensor, FloatTensor]:
+        """run bi-direction beam search for given img, see
+        DecodeModel.padded_beam_search
+
+        Parameters
+        ----------
+        img : FloatTensor
+            [b, 1, h', w']
+        img_mask: LongTensor
+            [b, h', w']
+        beam_size : int
+        max_len : int
+
+        Returns
+        -------
+        Tuple[LongTensor, LongTensor, FloatTensor]
+            [b, l] padded hypotheses, [b] lengths and [b] scores
+        """
+        feature, mask = self.encoder(img, img_mask)  # [b, t, d]
+        return self.decoder.padded_beam_search(
+            [feature], [mask], beam_size, max_len, alpha, early_stopping, temperature
+        )
@@ -1,9 +1,9 @@
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 import torch
 import torch.nn as nn
 from einops import rearrange
-from torch import FloatTensor, LongTensor
+from torch import FloatTensor, LongTensor, Tensor
 
 from comer.datamodule import vocab, vocab_size
 from comer.model.pos_enc import WordPosEnc
@@ -85,7 +85,12 @@ class Decoder(DecodeModel):
         return mask
 
     def forward(
-        self, src: FloatTensor, src_mask: LongTensor, tgt: LongTensor
+        self,
+        src: FloatTensor,
+        src_mask: LongTensor,
+        tgt: LongTensor,
+        memory_kv: Optional[List[Tuple[Tensor, Tensor]]] = None,
+        cache: Optional[List[Dict[str, Tensor]]] = None,
     ) -> FloatTensor:
         """generate output for tgt
 
@@ -97,18 +102,31 @@ class Decoder(DecodeModel):
             [b, h, w]
         tgt : LongTensor
             [b, l]
+        memory_kv : Optional[List[Tuple[Tensor, Tensor]]], optional
+            result of encode_memory for src, computed here if not given, by default None
+        cache : Optional[List[Dict[str, Tensor]]], optional
+            incremental decoding cache, when given, only the last position of tgt
+            is decoded, by default None
 
         Returns
         -------
         FloatTensor
-            [b, l, vocab_size]
+            [b, l, vocab_size], or [b, 1, vocab_size] if cache is given
         """
         _, l = tgt.size()
-        tgt_mask = self._build_attention_mask(l)
         tgt_pad_mask = tgt == vocab.PAD_IDX
 
+        if cache is None:
+            tgt_mask = self._build_attention_mask(l)
+            offset = 0
+        else:
+            # newest position attends to all cached positions
+            tgt_mask = None
+            offset = l - 1
+            tgt = tgt[:, offset:]
+
         tgt = self.word_embed(tgt)  # [b, l, d]
-        tgt = self.pos_enc(tgt)  # [b, l, d]
+        tgt = self.pos_enc(tgt, offset)  # [b, l, d]
         tgt = self.norm(tgt)
 
         h = src.shape[1]
@@ -123,6 +141,8 @@ class Decoder(DecodeModel):
             tgt_mask=tgt_mask,
             tgt_key_padding_mask=tgt_pad_mask,
             memory_key_padding_mask=src_mask,
+            memory_kv=memory_kv,
+            cache=cache,
         )
 
         out = rearrange(out, "l b d -> b l d")
@@ -130,9 +150,50 @@ class Decoder(DecodeModel):
 
         return out
 
+    def encode_memory(self, src: FloatTensor) -> List[Tuple[Tensor, Tensor]]:
+        """project src into cross-attention key and value of every layer
+
+        Parameters
+        ----------
+        src : FloatTensor
+            [b, h, w, d]
+
+        Returns
+        -------
+        List[Tuple[Tensor, Tensor]]
+            k, v of each layer: [b, nhead, (h w), head_dim]
+        """
+        src = rearrange(src, "b h w d -> (h w) b d")
+        return self.model.encode_memory(src)
+
+    def transform_memory(
+        self, src: List[FloatTensor]
+    ) -> List[List[Tuple[Tensor, Tensor]]]:
+        assert len(src) == 1
+        return [self.encode_memory(src[0])]
+
     def transform(
-        self, src: List[FloatTensor], src_mask: List[LongTensor], input_ids: LongTensor
+        self,
+        src: List[FloatTensor],
+        src_mask: List[LongTensor],
+        input_ids: LongTensor,
+        memory: Optional[List[List[Tuple[Tensor, Tensor]]]] = None,
     ) -> FloatTensor:
         assert len(src) == 1 and len(src_mask) == 1
-        word_out = self(src[0], src_mask[0], input_ids)
+        memory_kv = memory[0] if memory is not None else None
+        word_out = self(src[0], src_mask[0], input_ids, memory_kv=memory_kv)
         return word_out
+
+    def transform_step(
+        self,
+        src: List[FloatTensor],
+        src_mask: List[LongTensor],
+        input_ids: LongTensor,
+        memory: List[List[Tuple[Tensor, Tensor]]],
+        cache: List[Dict[str, Tensor]],
+    ) -> FloatTensor:
+        assert len(src) == 1 and len(src_mask) == 1 and len(memory) == 1
+        word_out = self(
+            src[0], src_mask[0], input_ids, memory_kv=memory[0], cache=cache
+        )
+        return word_out[:, -1, :]
@@ -1,5 +1,6 @@
+import inspect
 import math
-from typing import Tuple
+from typing import List, Tuple
 
 import pytorch_lightning as pl
 import torch
@@ -7,9 +8,18 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops.einops import rearrange
 from torch import FloatTensor, LongTensor
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 
 from .pos_enc import ImgPosEnc
 
+# torch >= 1.11 asks for the checkpoint variant explicitly, 1.8 has no such argument
+_CHECKPOINT_KWARGS = (
+    {"use_reentrant": False}
+    if "use_reentrant" in inspect.signature(checkpoint).parameters
+    else {}
+)
+
 
 # DenseNet-B
 class _Bottleneck(nn.Module):
@@ -25,13 +35,27 @@ class _Bottleneck(nn.Module):
         self.use_dropout = use_dropout
         self.dropout = nn.Dropout(p=0.2)
 
-    def forward(self, x):
-        out = F.relu(self.bn1(self.conv1(x)), inplace=True)
+    def bottleneck(self, *features: FloatTensor) -> FloatTensor:
+        x = features[0] if len(features) == 1 else torch.cat(features, 1)
+        return self.conv1(x)
+
+    def new_features(self, out: FloatTensor) -> FloatTensor:
+        out = F.relu(self.bn1(out), inplace=True)
         if self.use_dropout:
             out = self.dropout(out)
         out = F.relu(self.bn2(self.conv2(out)), inplace=True)
         if self.use_dropout:
             out = self.dropout(out)
+        return out
+
+    def fuse_bn(self) -> None:
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.conv2 = fuse_conv_bn_eval(self.conv2, self.bn2)
+        self.bn1 = nn.Identity()
+        self.bn2 = nn.Identity()
+
+    def forward(self, x):
+        out = self.new_features(self.conv1(x))
         out = torch.cat((x, out), 1)
         return out
 
@@ -55,6 +79,47 @@ class _SingleLayer(nn.Module):
         return out
 
 
+class _DenseBlock(nn.Sequential):
+    """Dense block of _Bottleneck layers.
+
+    With memory_efficient, the layers do not concatenate their input and output
+    one after the other, which keeps a growing copy of the block per layer.
+    In training, each layer gets the list of previous features and the
+    concatenation with its 1x1 bottleneck conv is checkpointed, i.e. recomputed
+    in backward instead of kept; BN is left out of the checkpoint so that its
+    running statistics are updated once. Without grad, the layers read the
+    features written so far from one preallocated buffer and append theirs to it.
+    """
+
+    def __init__(self, layers: List[_Bottleneck], memory_efficient: bool):
+        super(_DenseBlock, self).__init__(*layers)
+        self.memory_efficient = memory_efficient
+
+    def forward(self, x):
+        if not self.memory_efficient:
+            return super(_DenseBlock, self).forward(x)
+
+        if torch.is_grad_enabled():
+            features = [x]
+            for layer in self:
+                if any(f.requires_grad for f in features):
+                    out = checkpoint(layer.bottleneck, *features, **_CHECKPOINT_KWARGS)
+                else:
+                    out = layer.bottleneck(*features)
+                features.append(layer.new_features(out))
+            return torch.cat(features, 1)
+
+        growth_rate = self[0].conv2.out_channels
+        b, n_channels, h, w = x.size()
+        out = x.new_empty(b, n_channels + len(self) * growth_rate, h, w)
+        out[:, :n_channels] = x
+        for layer in self:
+            new = layer.new_features(layer.bottleneck(out[:, :n_channels]))
+            out[:, n_channels : n_channels + growth_rate] = new
+            n_channels += growth_rate
+        return out
+
+
 # transition layer
 class _Transition(nn.Module):
     def __init__(self, n_channels: int, n_out_channels: int, use_dropout: bool):
@@ -64,6 +129,10 @@ class _Transition(nn.Module):
         self.use_dropout = use_dropout
         self.dropout = nn.Dropout(p=0.2)
 
+    def fuse_bn(self) -> None:
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.bn1 = nn.Identity()
+
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)), inplace=True)
         if self.use_dropout:
@@ -80,8 +149,11 @@ class DenseNet(nn.Module):
         reduction: float = 0.5,
         bottleneck: bool = True,
         use_dropout: bool = True,
+        memory_efficient: bool = False,
     ):
         super(DenseNet, self).__init__()
+        if memory_efficient and not bottleneck:
+            raise ValueError("memory_efficient requires bottleneck layers")
         n_dense_blocks = num_layers
         n_channels = 2 * growth_rate
         self.conv1 = nn.Conv2d(
@@ -89,7 +161,12 @@ class DenseNet(nn.Module):
         )
         self.norm1 = nn.BatchNorm2d(n_channels)
         self.dense1 = self._make_dense(
-            n_channels, growth_rate, n_dense_blocks, bottleneck, use_dropout
+            n_channels,
+            growth_rate,
+            n_dense_blocks,
+            bottleneck,
+            use_dropout,
+            memory_efficient,
         )
         n_channels += n_dense_blocks * growth_rate
         n_out_channels = int(math.floor(n_channels * reduction))
@@ -97,7 +174,12 @@ class DenseNet(nn.Module):
 
         n_channels = n_out_channels
         self.dense2 = self._make_dense(
-            n_channels, growth_rate, n_dense_blocks, bottleneck, use_dropout
+            n_channels,
+            growth_rate,
+            n_dense_blocks,
+            bottleneck,
+            use_dropout,
+            memory_efficient,
         )
         n_channels += n_dense_blocks * growth_rate
         n_out_channels = int(math.floor(n_channels * reduction))
@@ -105,14 +187,26 @@ class DenseNet(nn.Module):
 
         n_channels = n_out_channels
         self.dense3 = self._make_dense(
-            n_channels, growth_rate, n_dense_blocks, bottleneck, use_dropout
+            n_channels,
+            growth_rate,
+            n_dense_blocks,
+            bottleneck,
+            use_dropout,
+            memory_efficient,
         )
 
         self.out_channels = n_channels + n_dense_blocks * growth_rate
         self.post_norm = nn.BatchNorm2d(self.out_channels)
 
     @staticmethod
-    def _make_dense(n_channels, growth_rate, n_dense_blocks, bottleneck, use_dropout):
+    def _make_dense(
+        n_channels,
+        growth_rate,
+        n_dense_blocks,
+        bottleneck,
+        use_dropout,
+        memory_efficient,
+    ):
         layers = []
         for _ in range(int(n_dense_blocks)):
             if bottleneck:
@@ -120,8 +214,26 @@ class DenseNet(nn.Module):
             else:
                 layers.append(_SingleLayer(n_channels, growth_rate, use_dropout))
             n_channels += growth_rate
+        if bottleneck:
+            return _DenseBlock(layers, memory_efficient)
         return nn.Sequential(*layers)
 
+    def fuse_bn(self) -> None:
+        """fold the BatchNorm after each conv into the conv, for inference only
+
+        post_norm is not followed by a conv here, see Encoder.fuse_bn
+        """
+        assert not self.training, "BatchNorm can only be folded in eval mode"
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.norm1)
+        self.norm1 = nn.Identity()
+        for block in (self.dense1, self.dense2, self.dense3):
+            for layer in block:
+                # _SingleLayer does not use its BatchNorm
+                if isinstance(layer, _Bottleneck):
+                    layer.fuse_bn()
+        self.trans1.fuse_bn()
+        self.trans2.fuse_bn()
+
     def forward(self, x, x_mask):
         out = self.conv1(x)
         out = self.norm1(out)
@@ -141,10 +253,20 @@ class DenseNet(nn.Module):
 
 
 class Encoder(pl.LightningModule):
-    def __init__(self, d_model: int, growth_rate: int, num_layers: int):
+    def __init__(
+        self,
+        d_model: int,
+        growth_rate: int,
+        num_layers: int,
+        memory_efficient: bool = False,
+    ):
         super().__init__()
 
-        self.model = DenseNet(growth_rate=growth_rate, num_layers=num_layers)
+        self.model = DenseNet(
+            growth_rate=growth_rate,
+            num_layers=num_layers,
+            memory_efficient=memory_efficient,
+        )
 
         self.feature_proj = nn.Conv2d(self.model.out_channels, d_model, kernel_size=1)
 
@@ -152,6 +274,24 @@ class Encoder(pl.LightningModule):
 
         self.norm = nn.LayerNorm(d_model)
 
+    @torch.no_grad()
+    def fuse_bn(self) -> None:
+        """fold all BatchNorm of the encoder into convs, for inference only
+
+        The output is unchanged up to float rounding, but the encoder can not
+        be trained anymore. post_norm of DenseNet is folded into the following
+        1x1 feature_proj.
+        """
+        self.model.fuse_bn()
+
+        bn = self.model.post_norm
+        scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        weight = self.feature_proj.weight
+        self.feature_proj.bias.add_(weight.flatten(1) @ shift)
+        weight.mul_(scale[None, :, None, None])
+        self.model.post_norm = nn.Identity()
+
     def forward(
         self, img: FloatTensor, img_mask: LongTensor
     ) -> Tuple[FloatTensor, LongTensor]:
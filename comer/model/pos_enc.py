@@ -1,4 +1,5 @@
 import math
+from collections import OrderedDict
 from typing import Optional
 
 import pytorch_lightning as pl
@@ -6,30 +7,80 @@ import torch
 from einops import rearrange, repeat
 
 
+def _word_pos_table(
+    start: int,
+    end: int,
+    d_model: int,
+    temperature: float,
+    dtype: torch.dtype = torch.float,
+    device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """sinusoid table for positions [start, end), computed in float32 and stored
+    in dtype
+
+    Returns
+    -------
+    torch.Tensor
+        [end - start, d_model]
+    """
+    pe = torch.zeros(end - start, d_model, dtype=dtype, device=device)
+
+    position = torch.arange(start, end, dtype=torch.float, device=device)
+    dim_t = torch.arange(0, d_model, 2, dtype=torch.float, device=device)
+    div_term = 1.0 / (temperature ** (dim_t / d_model))
+
+    inv_freq = torch.einsum("i, j -> i j", position, div_term)
+
+    pe[:, 0::2] = inv_freq.sin()
+    pe[:, 1::2] = inv_freq.cos()
+    return pe
+
+
 class WordPosEnc(pl.LightningModule):
     def __init__(
         self, d_model: int = 512, max_len: int = 500, temperature: float = 10000.0
     ) -> None:
         super().__init__()
-        pe = torch.zeros(max_len, d_model)
-
-        position = torch.arange(0, max_len, dtype=torch.float)
-        dim_t = torch.arange(0, d_model, 2, dtype=torch.float)
-        div_term = 1.0 / (temperature ** (dim_t / d_model))
-
-        inv_freq = torch.einsum("i, j -> i j", position, div_term)
-
-        pe[:, 0::2] = inv_freq.sin()
-        pe[:, 1::2] = inv_freq.cos()
-        self.register_buffer("pe", pe)
-
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        self.d_model = d_model
+        self.temperature = temperature
+        self.register_buffer("pe", _word_pos_table(0, max_len, d_model, temperature))
+        # pe extended past max_len on demand, doubling its length each time;
+        # not a buffer so that checkpoints keep the [max_len, d_model] table
+        self._pe_ext: Optional[torch.Tensor] = None
+
+    def _table(self, end: int) -> torch.Tensor:
+        max_len = self.pe.size(0)
+        if end <= max_len:
+            return self.pe
+
+        ext = self._pe_ext
+        if (
+            ext is None
+            or ext.size(0) < end
+            or ext.device != self.pe.device
+            or ext.dtype != self.pe.dtype
+        ):
+            new_len = max(end, 2 * (max_len if ext is None else ext.size(0)))
+            rest = _word_pos_table(
+                max_len,
+                new_len,
+                self.d_model,
+                self.temperature,
+                dtype=self.pe.dtype,
+                device=self.pe.device,
+            )
+            self._pe_ext = torch.cat((self.pe, rest))
+        return self._pe_ext
+
+    def forward(self, x: torch.Tensor, offset: int = 0) -> torch.Tensor:
         """add positional encoding to feature
 
         Parameters
         ----------
         x : torch.Tensor
             [b, l, d]
+        offset : int, optional
+            position of the first element in x, by default 0
 
         Returns
         -------
@@ -37,7 +88,7 @@ class WordPosEnc(pl.LightningModule):
             [b, l, d]
         """
         _, seq_len, _ = x.size()
-        emb = self.pe[:seq_len, :]
+        emb = self._table(offset + seq_len)[offset : offset + seq_len, :]
         x = x + emb[None, :, :]
         return x
 
@@ -54,6 +105,7 @@ class ImgPosEnc(pl.LightningModule):
         temperature: float = 10000.0,
         normalize: bool = False,
         scale: Optional[float] = None,
+        cache_size: int = 64,
     ):
         super().__init__()
         assert d_model % 2 == 0
@@ -65,6 +117,30 @@ class ImgPosEnc(pl.LightningModule):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        # LRU cache of encodings of unpadded (h, w) feature maps, used in inference
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+
+    def _table(self, h: int, w: int, device: torch.device) -> torch.Tensor:
+        """encoding of an unpadded [h, w] feature map
+
+        Returns
+        -------
+        torch.Tensor
+            [h, w, d]
+        """
+        key = (h, w, device)
+        table = self._cache.get(key)
+        if table is not None:
+            self._cache.move_to_end(key)
+            return table
+
+        mask = torch.zeros(1, h, w, dtype=torch.bool, device=device)
+        table = self._pos(mask)[0]
+        self._cache[key] = table
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return table
 
     def forward(self, x: torch.Tensor, mask: torch.LongTensor) -> torch.Tensor:
         """add image positional encoding to feature
@@ -76,6 +152,48 @@ class ImgPosEnc(pl.LightningModule):
         mask: torch.LongTensor
             [b, h, w]
 
+        Returns
+        -------
+        torch.Tensor
+            [b, h, w, d]
+        """
+        if self.training or torch.is_grad_enabled() or self.cache_size <= 0:
+            # looking up the cache syncs with the device for every batch
+            return x + self._pos(mask)
+
+        b, h, w = mask.size()
+        heights = (~mask[:, :, 0]).sum(dim=1)
+        widths = (~mask[:, 0, :]).sum(dim=1)
+        pad = (
+            torch.arange(h, device=mask.device)[None, :, None] >= heights[:, None, None]
+        ) | (
+            torch.arange(w, device=mask.device)[None, None, :] >= widths[:, None, None]
+        )
+        if not torch.equal(pad, mask) or heights.min() == 0 or widths.min() == 0:
+            # not top-left aligned images, compute the encoding directly
+            return x + self._pos(mask)
+
+        # padding positions carry the encoding of cumsum 0, i.e. (sin, cos) = (0, 1),
+        # except that they continue the last row / column along the padded axis
+        half = self.half_d_model
+        pos = x.new_zeros((b, h, w, half * 2), dtype=torch.float)
+        pos[..., 1::2] = 1.0
+        for i, (h_i, w_i) in enumerate(zip(heights.tolist(), widths.tolist())):
+            table = self._table(h_i, w_i, mask.device)
+            pos[i, :h_i, :w_i] = table
+            pos[i, :h_i, w_i:, :half] = table[:, w_i - 1 : w_i, :half]
+            pos[i, h_i:, :w_i, half:] = table[h_i - 1 : h_i, :, half:]
+
+        return x + pos
+
+    def _pos(self, mask: torch.LongTensor) -> torch.Tensor:
+        """compute the encoding of a batch of masks
+
+        Parameters
+        ----------
+        mask: torch.LongTensor
+            [b, h, w]
+
         Returns
         -------
         torch.Tensor
@@ -100,9 +218,7 @@ class ImgPosEnc(pl.LightningModule):
         pos_x = torch.stack((pos_x.sin(), pos_x.cos()), dim=4).flatten(3)
         pos_y = torch.stack((pos_y.sin(), pos_y.cos()), dim=4).flatten(3)
         pos = torch.cat((pos_x, pos_y), dim=3)
-
-        x = x + pos
-        return x
+        return pos
 
 
 def rotate_every_two(x: torch.FloatTensor):
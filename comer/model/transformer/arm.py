@@ -1,5 +1,8 @@
+from typing import Dict, Optional, Tuple
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import rearrange, repeat
 from torch import Tensor
 from torch.nn.modules.batchnorm import BatchNorm1d
@@ -11,7 +14,8 @@ class MaskBatchNorm2d(nn.Module):
         self.bn = BatchNorm1d(num_features)
 
     def forward(self, x: Tensor, mask: Tensor) -> Tensor:
-        """
+        """normalize the non-masked pixels, masked ones are kept as they are
+
         Parameters
         ----------
         x : Tensor
@@ -24,18 +28,52 @@ class MaskBatchNorm2d(nn.Module):
         Tensor
             [b, d, h, w]
         """
-        x = rearrange(x, "b d h w -> b h w d")
-        mask = mask.squeeze(1)
-
-        not_mask = ~mask
+        bn = self.bn
+        not_mask = (~mask).to(x.dtype)
+        if bn.training:
+            # batch statistics over the non-masked pixels, as sums over the mask
+            n = not_mask.sum(dtype=torch.float)
+            mean = (x * not_mask).sum(dim=(0, 2, 3), dtype=torch.float) / n
+            diff = (x - mean.to(x.dtype)[:, None, None]) * not_mask
+            var = (diff * diff).sum(dim=(0, 2, 3), dtype=torch.float) / n
+            self._update_running_stats(mean, var, n)
+        else:
+            mean, var = bn.running_mean, bn.running_var
+            diff = x - mean.to(x.dtype)[:, None, None]
+
+        scale = bn.weight * torch.rsqrt(var + bn.eps)
+        out = (
+            diff * scale.to(x.dtype)[:, None, None] + bn.bias.to(x.dtype)[:, None, None]
+        )
+        return torch.where(mask, x, out)
+
+    @torch.no_grad()
+    def _update_running_stats(self, mean: Tensor, var: Tensor, n: Tensor) -> None:
+        bn = self.bn
+        bn.num_batches_tracked.add_(1)
+        if bn.momentum is None:
+            factor = 1.0 / float(bn.num_batches_tracked)
+        else:
+            factor = bn.momentum
+        bn.running_mean.mul_(1 - factor).add_(mean, alpha=factor)
+        bn.running_var.mul_(1 - factor).add_(var * n / (n - 1), alpha=factor)
 
-        flat_x = x[not_mask, :]
-        flat_x = self.bn(flat_x)
-        x[not_mask, :] = flat_x
+    def fuse(self, weight: Tensor) -> Tuple[Tensor, Tensor]:
+        """fold the running statistics into a preceding bias-free 1x1 conv
 
-        x = rearrange(x, "b h w d -> b d h w")
+        Parameters
+        ----------
+        weight : Tensor
+            [d, c, 1, 1]
 
-        return x
+        Returns
+        -------
+        Tuple[Tensor, Tensor]
+            weight [d, c, 1, 1] and bias [d] of the fused conv
+        """
+        bn = self.bn
+        scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+        return weight * scale[:, None, None, None], bn.bias - bn.running_mean * scale
 
 
 class AttentionRefinementModule(nn.Module):
@@ -58,7 +96,12 @@ class AttentionRefinementModule(nn.Module):
         self.post_norm = MaskBatchNorm2d(nhead)
 
     def forward(
-        self, prev_attn: Tensor, key_padding_mask: Tensor, h: int, curr_attn: Tensor
+        self,
+        prev_attn: Tensor,
+        key_padding_mask: Tensor,
+        h: int,
+        curr_attn: Tensor,
+        state: Optional[Dict[str, Tensor]] = None,
     ) -> Tensor:
         """
         Parameters
@@ -68,15 +111,89 @@ class AttentionRefinementModule(nn.Module):
         key_padding_mask : Tensor
             [b, l]
         h : int
+        state : Optional[Dict[str, Tensor]], optional
+            incremental decoding state, see step
 
         Returns
         -------
         Tensor
             [(b * nhead), t, l]
         """
-        t = curr_attn.shape[1]
-        mask = repeat(key_padding_mask, "b (h w) -> (b t) () h w", h=h, t=t)
+        if state is not None:
+            return self.step(prev_attn, key_padding_mask, h, curr_attn, state)
+
+        attns = self._attns(prev_attn, curr_attn)
+        attns = attns.cumsum(dim=2) - attns
+        return self._refine(attns, key_padding_mask, h)
+
+    def step(
+        self,
+        prev_attn: Tensor,
+        key_padding_mask: Tensor,
+        h: int,
+        curr_attn: Tensor,
+        state: Dict[str, Tensor],
+    ) -> Tensor:
+        """coverage of the newest decoding steps only
+
+        state["arm_cum"] carries the running attention sum of the previous steps
+        per (beam, head), [b, n, 1, l], and is updated in place. Like the other
+        incremental decoding states, its rows follow the beams by index_select on
+        dim 0 (see DecodeModel.reorder_cache).
+
+        Parameters
+        ----------
+        prev_attn : Tensor
+            [(b * nhead), t, l], t contains only the newest steps
+        key_padding_mask : Tensor
+            [b, l]
+        h : int
+        curr_attn : Tensor
+            [(b * nhead), t, l]
+        state : Dict[str, Tensor]
+            empty before the first step
+
+        Returns
+        -------
+        Tensor
+            [(b * nhead), t, l]
+
+        Examples
+        --------
+        coverage of the steps matches the one of the whole prefix within tolerance
+
+        >>> arm = AttentionRefinementModule(8, 32, True, True).eval()
+        >>> prev, curr = torch.rand(2, 16, 4, 30).softmax(dim=-1)
+        >>> mask = torch.zeros(2, 30, dtype=torch.bool)
+        >>> state = {}
+        >>> steps = [arm.step(prev[:, i : i + 1], mask, 5, curr[:, i : i + 1], state) for i in range(4)]
+        >>> torch.allclose(torch.cat(steps, dim=1), arm(prev, mask, 5, curr), atol=1e-6)
+        True
+        """
+        attns = self._attns(prev_attn, curr_attn)
+
+        # carry the running sum in double, like cumsum accumulates on cpu, so that
+        # coverage matches decoding the whole prefix within tolerance; it is not
+        # bitwise equal in general, e.g. on gpu or under amp the cumsum of the
+        # whole prefix may round differently in the last bits
+        cum = attns.double()
+        if "arm_cum" not in state:
+            cum = cum.cumsum(dim=2)
+        elif cum.shape[2] == 1:
+            cum = state["arm_cum"] + cum
+        else:
+            cum = torch.cat((state["arm_cum"], cum), dim=2).cumsum(dim=2)[:, :, 1:]
+        state["arm_cum"] = cum[:, :, -1:]
+        attns = cum.to(attns.dtype) - attns
+        return self._refine(attns, key_padding_mask, h)
 
+    def _attns(self, prev_attn: Tensor, curr_attn: Tensor) -> Tensor:
+        """
+        Returns
+        -------
+        Tensor
+            [b, in_chs, t, l]
+        """
         curr_attn = rearrange(curr_attn, "(b n) t l -> b n t l", n=self.nhead)
         prev_attn = rearrange(prev_attn, "(b n) t l -> b n t l", n=self.nhead)
 
@@ -85,18 +202,36 @@ class AttentionRefinementModule(nn.Module):
             attns.append(prev_attn)
         if self.self_coverage:
             attns.append(curr_attn)
-        attns = torch.cat(attns, dim=1)
+        return torch.cat(attns, dim=1)
 
-        attns = attns.cumsum(dim=2) - attns
+    def _refine(self, attns: Tensor, key_padding_mask: Tensor, h: int) -> Tensor:
+        """
+        Parameters
+        ----------
+        attns : Tensor
+            [b, in_chs, t, l] attention sums of the steps before each step
+
+        Returns
+        -------
+        Tensor
+            [(b * nhead), t, l]
+        """
+        t = attns.shape[2]
+        mask = repeat(key_padding_mask, "b (h w) -> (b t) () h w", h=h, t=t)
         attns = rearrange(attns, "b n t (h w) -> (b t) n h w", h=h)
 
         cov = self.conv(attns)
         cov = self.act(cov)
 
         cov = cov.masked_fill(mask, 0.0)
-        cov = self.proj(cov)
-
-        cov = self.post_norm(cov, mask)
+        if self.post_norm.training:
+            cov = self.proj(cov)
+            cov = self.post_norm(cov, mask)
+        else:
+            # frozen statistics: apply the norm as the bias of the projection,
+            # masked pixels stay 0 as the bias-free projection of 0
+            weight, bias = self.post_norm.fuse(self.proj.weight)
+            cov = F.conv2d(cov, weight, bias).masked_fill(mask, 0.0)
 
         cov = rearrange(cov, "(b t) n h w -> (b n) t (h w)", t=t)
         return cov
@@ -1,14 +1,31 @@
 import warnings
-from typing import Optional, Tuple
+from functools import partial
+from typing import Callable, Optional, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from einops import rearrange
 from torch import Tensor
 from torch.nn.init import constant_, xavier_normal_, xavier_uniform_
 
 from .arm import AttentionRefinementModule
 
+# fused attention kernels, torch >= 2.0
+_HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+
+
+def _softmax_supports_out() -> bool:
+    # softmax.int_out is missing in older torch releases
+    try:
+        torch.softmax(torch.zeros(1), -1, out=torch.empty(1))
+    except (TypeError, RuntimeError):
+        return False
+    return True
+
+
+_SOFTMAX_OUT = _softmax_supports_out()
+
 
 class MultiheadAttention(nn.Module):
     bias_k: Optional[torch.Tensor]
@@ -54,6 +71,8 @@ class MultiheadAttention(nn.Module):
         else:
             self.register_parameter("in_proj_bias", None)
         self.out_proj = nn.Linear(embed_dim, embed_dim)
+        # input projections as modules, see split_in_proj
+        self.q_proj = self.k_proj = self.v_proj = None
 
         if add_bias_kv:
             self.bias_k = nn.Parameter(torch.empty(1, 1, embed_dim))
@@ -88,6 +107,76 @@ class MultiheadAttention(nn.Module):
 
         super(MultiheadAttention, self).__setstate__(state)
 
+    @torch.no_grad()
+    def split_in_proj(self) -> None:
+        """move the input projection weights into q_proj, k_proj and v_proj
+
+        The attention then calls the projections, out_proj included, as modules
+        instead of reading their weights, so that they can be swapped by
+        e.g. torch.quantization.quantize_dynamic. The result is unchanged.
+        """
+        e = self.embed_dim
+        if self._qkv_same_embed_dim:
+            weights = self.in_proj_weight.split(e)
+        else:
+            weights = (self.q_proj_weight, self.k_proj_weight, self.v_proj_weight)
+        if self.in_proj_bias is not None:
+            biases = self.in_proj_bias.split(e)
+        else:
+            biases = (None, None, None)
+
+        projs = []
+        for weight, bias in zip(weights, biases):
+            proj = nn.Linear(weight.size(1), e, bias=bias is not None)
+            proj.to(weight)
+            proj.weight.copy_(weight)
+            if bias is not None:
+                proj.bias.copy_(bias)
+            projs.append(proj)
+        self.q_proj, self.k_proj, self.v_proj = projs
+
+        for name in (
+            "in_proj_weight",
+            "q_proj_weight",
+            "k_proj_weight",
+            "v_proj_weight",
+            "in_proj_bias",
+        ):
+            self.register_parameter(name, None)
+
+    def in_proj_kv(self, x: Tensor) -> Tuple[Tensor, Tensor]:
+        """project x into per-head key and value
+
+        Parameters
+        ----------
+        x : Tensor
+            [s, b, d]
+
+        Returns
+        -------
+        Tuple[Tensor, Tensor]
+            k, v: [b, nhead, s, head_dim]
+        """
+        e = self.embed_dim
+        if self.q_proj is not None:
+            k, v = self.k_proj(x), self.v_proj(x)
+        elif self._qkv_same_embed_dim:
+            _b = self.in_proj_bias
+            if _b is not None:
+                _b = _b[e:]
+            k, v = F.linear(x, self.in_proj_weight[e:, :], _b).chunk(2, dim=-1)
+        else:
+            b_k = b_v = None
+            if self.in_proj_bias is not None:
+                b_k = self.in_proj_bias[e : (e * 2)]
+                b_v = self.in_proj_bias[(e * 2) :]
+            k = F.linear(x, self.k_proj_weight, b_k)
+            v = F.linear(x, self.v_proj_weight, b_v)
+
+        k = rearrange(k, "s b (n d) -> b n s d", n=self.num_heads)
+        v = rearrange(v, "s b (n d) -> b n s d", n=self.num_heads)
+        return k, v
+
     def forward(
         self,
         query: Tensor,
@@ -97,8 +186,35 @@ class MultiheadAttention(nn.Module):
         key_padding_mask: Optional[Tensor] = None,
         need_weights: bool = True,
         attn_mask: Optional[Tensor] = None,
+        static_k: Optional[Tensor] = None,
+        static_v: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Optional[Tensor]]:
-        if not self._qkv_same_embed_dim:
+        if self.q_proj is not None:
+            return multi_head_attention_forward(
+                query,
+                key,
+                value,
+                arm,
+                self.embed_dim,
+                self.num_heads,
+                None,
+                None,
+                self.bias_k,
+                self.bias_v,
+                self.add_zero_attn,
+                self.dropout,
+                None,
+                None,
+                training=self.training,
+                key_padding_mask=key_padding_mask,
+                need_weights=need_weights,
+                attn_mask=attn_mask,
+                static_k=static_k,
+                static_v=static_v,
+                in_proj=(self.q_proj, self.k_proj, self.v_proj),
+                out_proj=self.out_proj,
+            )
+        elif not self._qkv_same_embed_dim:
             return multi_head_attention_forward(
                 query,
                 key,
@@ -122,6 +238,8 @@ class MultiheadAttention(nn.Module):
                 q_proj_weight=self.q_proj_weight,
                 k_proj_weight=self.k_proj_weight,
                 v_proj_weight=self.v_proj_weight,
+                static_k=static_k,
+                static_v=static_v,
             )
         else:
             return multi_head_attention_forward(
@@ -143,6 +261,8 @@ class MultiheadAttention(nn.Module):
                 key_padding_mask=key_padding_mask,
                 need_weights=need_weights,
                 attn_mask=attn_mask,
+                static_k=static_k,
+                static_v=static_v,
             )
 
 
@@ -171,7 +291,13 @@ def multi_head_attention_forward(
     v_proj_weight: Optional[Tensor] = None,
     static_k: Optional[Tensor] = None,
     static_v: Optional[Tensor] = None,
+    in_proj: Optional[Tuple[nn.Module, nn.Module, nn.Module]] = None,
+    out_proj: Optional[nn.Module] = None,
 ) -> Tuple[Tensor, Optional[Tensor]]:
+    """
+    in_proj and out_proj are the projections as modules, when given they are
+    used instead of the weights, see MultiheadAttention.split_in_proj.
+    """
     tgt_len, bsz, embed_dim = query.size()
     assert embed_dim == embed_dim_to_check
     # allow MHA to have different sizes for the feature dimension
@@ -181,7 +307,29 @@ def multi_head_attention_forward(
     assert head_dim * num_heads == embed_dim, "embed_dim must be divisible by num_heads"
     scaling = float(head_dim) ** -0.5
 
-    if not use_separate_proj_weight:
+    if out_proj is None:
+        out_proj = partial(F.linear, weight=out_proj_weight, bias=out_proj_bias)
+
+    if in_proj is not None:
+        q_proj, k_proj, v_proj = in_proj
+        q = q_proj(query)
+        k = v = None
+        if static_k is None or static_v is None:
+            k, v = k_proj(key), v_proj(value)
+    elif static_k is not None and static_v is not None:
+        # key and value are already projected (e.g. cached in incremental decoding),
+        # only query needs to be projected here
+        if not use_separate_proj_weight:
+            _w = in_proj_weight[0:embed_dim, :]
+        else:
+            _w = torch.jit._unwrap_optional(q_proj_weight)
+        _b = in_proj_bias
+        if _b is not None:
+            _b = _b[0:embed_dim]
+        q = F.linear(query, _w, _b)
+        k = None
+        v = None
+    elif not use_separate_proj_weight:
         if (query is key or torch.equal(query, key)) and (
             key is value or torch.equal(key, value)
         ):
@@ -264,7 +412,6 @@ def multi_head_attention_forward(
             q = F.linear(query, q_proj_weight_non_opt, in_proj_bias)
             k = F.linear(key, k_proj_weight_non_opt, in_proj_bias)
             v = F.linear(value, v_proj_weight_non_opt, in_proj_bias)
-    q = q * scaling
 
     if attn_mask is not None:
         assert (
@@ -364,39 +511,112 @@ def multi_head_attention_forward(
         if key_padding_mask is not None:
             key_padding_mask = F.pad(key_padding_mask, (0, 1))
 
-    attn_output_weights = torch.bmm(q, k.transpose(1, 2))
-    assert list(attn_output_weights.size()) == [bsz * num_heads, tgt_len, src_len]
-
-    def mask_softmax_dropout(dots):
-        if attn_mask is not None:
-            if attn_mask.dtype == torch.bool:
-                dots.masked_fill_(attn_mask, float("-inf"))
-            else:
-                dots += attn_mask
+    if (
+        _HAS_SDPA
+        and arm is None
+        and not need_weights
+        and (attn_mask is None or attn_mask.dtype == torch.bool)
+    ):
+        # nothing consumes the weights: let the fused kernel avoid materializing them
+        return _sdpa_forward(
+            q,
+            k,
+            v,
+            bsz,
+            num_heads,
+            attn_mask,
+            key_padding_mask,
+            dropout_p if training else 0.0,
+            out_proj,
+        )
 
-        if key_padding_mask is not None:
-            dots = dots.view(bsz, num_heads, tgt_len, src_len)
-            dots = dots.masked_fill(
-                key_padding_mask.unsqueeze(1).unsqueeze(2),
-                float("-inf"),
-            )
-            dots = dots.view(bsz * num_heads, tgt_len, src_len)
+    attn_output_weights = torch.bmm(q * scaling, k.transpose(1, 2))
+    assert list(attn_output_weights.size()) == [bsz * num_heads, tgt_len, src_len]
 
-        attn = F.softmax(dots, dim=-1)
-        attn = F.dropout(attn, p=dropout_p, training=training)
-        return attn
+    # mask the logits once and in place, masked positions stay -inf after the
+    # coverage is subtracted below, so the refined logits need no re-masking
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            attn_output_weights.masked_fill_(attn_mask, float("-inf"))
+        else:
+            attn_output_weights += attn_mask
+    if key_padding_mask is not None:
+        attn_output_weights.view(bsz, num_heads, tgt_len, src_len).masked_fill_(
+            key_padding_mask[:, None, None, :], float("-inf")
+        )
 
-    attention = mask_softmax_dropout(attn_output_weights)
+    attention = F.softmax(attn_output_weights, dim=-1)
+    attention = F.dropout(attention, p=dropout_p, training=training)
     if arm is not None:
+        # softmax keeps its output for backward, so the logits can be updated
         attn_output_weights -= arm(attention)
-        attention = mask_softmax_dropout(attn_output_weights)
+        if _SOFTMAX_OUT and not training and not torch.is_grad_enabled():
+            # inference: the first attention is consumed by the arm, reuse it
+            attention = torch.softmax(attn_output_weights, -1, out=attention)
+        else:
+            attention = F.softmax(attn_output_weights, dim=-1)
+            attention = F.dropout(attention, p=dropout_p, training=training)
 
     attn_output = torch.bmm(attention, v)
     assert list(attn_output.size()) == [bsz * num_heads, tgt_len, head_dim]
     attn_output = attn_output.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
-    attn_output = F.linear(attn_output, out_proj_weight, out_proj_bias)
+    attn_output = out_proj(attn_output)
 
     if need_weights:
         return attn_output, attention
     else:
         return attn_output, None
+
+
+def _sdpa_forward(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    bsz: int,
+    num_heads: int,
+    attn_mask: Optional[Tensor],
+    key_padding_mask: Optional[Tensor],
+    dropout_p: float,
+    out_proj: Callable[[Tensor], Tensor],
+) -> Tuple[Tensor, None]:
+    """attention output with F.scaled_dot_product_attention
+
+    Parameters
+    ----------
+    q : Tensor
+        [(bsz * num_heads), tgt_len, head_dim], not scaled
+    k : Tensor
+        [(bsz * num_heads), src_len, head_dim]
+    v : Tensor
+        [(bsz * num_heads), src_len, head_dim]
+    attn_mask : Optional[Tensor]
+        bool, [1 or (bsz * num_heads), tgt_len, src_len]
+    key_padding_mask : Optional[Tensor]
+        bool, [bsz, src_len]
+
+    Returns
+    -------
+    Tuple[Tensor, None]
+        [tgt_len, bsz, embed_dim]
+    """
+    tgt_len, head_dim = q.shape[1:]
+    q, k, v = [x.reshape(bsz, num_heads, x.size(1), head_dim) for x in (q, k, v)]
+
+    # True masks a key out here, but lets it take part in attention for sdpa
+    mask = None
+    if attn_mask is not None:
+        mask = attn_mask.reshape(
+            -1, 1 if attn_mask.size(0) == 1 else num_heads, tgt_len, k.size(2)
+        )
+    if key_padding_mask is not None:
+        kpm = key_padding_mask[:, None, None, :]
+        mask = kpm if mask is None else mask | kpm
+    if mask is not None:
+        mask = ~mask
+
+    attn_output = F.scaled_dot_product_attention(
+        q, k, v, attn_mask=mask, dropout_p=dropout_p
+    )
+    attn_output = rearrange(attn_output, "b n t d -> t b (n d)")
+    attn_output = out_proj(attn_output)
+    return attn_output, None
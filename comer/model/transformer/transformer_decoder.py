@@ -1,7 +1,8 @@
 import copy
 from functools import partial
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
@@ -29,6 +30,21 @@ class TransformerDecoder(nn.Module):
 
         self.arm = arm
 
+    def encode_memory(self, memory: Tensor) -> List[Tuple[Tensor, Tensor]]:
+        """project memory into cross-attention key and value of every layer
+
+        Parameters
+        ----------
+        memory : Tensor
+            [s, b, d]
+
+        Returns
+        -------
+        List[Tuple[Tensor, Tensor]]
+            k, v of each layer: [b, nhead, s, head_dim]
+        """
+        return [mod.multihead_attn.in_proj_kv(memory) for mod in self.layers]
+
     def forward(
         self,
         tgt: Tensor,
@@ -38,11 +54,27 @@ class TransformerDecoder(nn.Module):
         memory_mask: Optional[Tensor] = None,
         tgt_key_padding_mask: Optional[Tensor] = None,
         memory_key_padding_mask: Optional[Tensor] = None,
+        memory_kv: Optional[List[Tuple[Tensor, Tensor]]] = None,
+        cache: Optional[List[Dict[str, Tensor]]] = None,
     ) -> Tensor:
+        """
+        memory_kv is the result of encode_memory, it is computed here if not given.
+
+        When cache is given, decode incrementally: tgt only contains the newest
+        positions, and the states of previous positions are read from and
+        appended to the per-layer cache.
+        """
         output = tgt
 
+        if memory_kv is None:
+            memory_kv = self.encode_memory(memory)
+
+        if cache is not None and len(cache) == 0:
+            cache.extend({} for _ in range(self.num_layers))
+
         arm = None
         for i, mod in enumerate(self.layers):
+            layer_cache = cache[i] if cache is not None else None
             output, attn = mod(
                 output,
                 memory,
@@ -51,9 +83,16 @@ class TransformerDecoder(nn.Module):
                 memory_mask=memory_mask,
                 tgt_key_padding_mask=tgt_key_padding_mask,
                 memory_key_padding_mask=memory_key_padding_mask,
+                memory_kv=memory_kv[i],
+                cache=layer_cache,
+                # cross-attention weights only feed the ARM of the next layer
+                need_weights=self.arm is not None and i != len(self.layers) - 1,
             )
             if i != len(self.layers) - 1 and self.arm is not None:
-                arm = partial(self.arm, attn, memory_key_padding_mask, height)
+                arm_state = cache[i + 1] if cache is not None else None
+                arm = partial(
+                    self.arm, attn, memory_key_padding_mask, height, state=arm_state
+                )
 
         if self.norm is not None:
             output = self.norm(output)
@@ -95,7 +134,10 @@ class TransformerDecoderLayer(nn.Module):
         memory_mask: Optional[Tensor] = None,
         tgt_key_padding_mask: Optional[Tensor] = None,
         memory_key_padding_mask: Optional[Tensor] = None,
-    ) -> Tensor:
+        memory_kv: Optional[Tuple[Tensor, Tensor]] = None,
+        cache: Optional[Dict[str, Tensor]] = None,
+        need_weights: bool = True,
+    ) -> Tuple[Tensor, Optional[Tensor]]:
         r"""Pass the inputs (and mask) through the decoder layer.
 
         Args:
@@ -105,12 +147,35 @@ class TransformerDecoderLayer(nn.Module):
             memory_mask: the mask for the memory sequence (optional).
             tgt_key_padding_mask: the mask for the tgt keys per batch (optional).
             memory_key_padding_mask: the mask for the memory keys per batch (optional).
+            memory_kv: the projected key and value of memory (optional).
+            cache: the incremental decoding cache of this layer (optional).
+            need_weights: return the cross-attention weights, else None (optional).
 
         Shape:
             see the docs in Transformer class.
         """
+        if memory_kv is None:
+            memory_kv = self.multihead_attn.in_proj_kv(memory)
+        memory_k, memory_v = memory_kv
+
+        self_k = self_v = None
+        if cache is not None:
+            k, v = self.self_attn.in_proj_kv(tgt)
+            if "self_k" in cache:
+                k = torch.cat((cache["self_k"], k), dim=2)
+                v = torch.cat((cache["self_v"], v), dim=2)
+            cache["self_k"], cache["self_v"] = k, v
+            self_k, self_v = k.flatten(0, 1), v.flatten(0, 1)
+
         tgt2 = self.self_attn(
-            tgt, tgt, tgt, attn_mask=tgt_mask, key_padding_mask=tgt_key_padding_mask
+            tgt,
+            tgt,
+            tgt,
+            attn_mask=tgt_mask,
+            key_padding_mask=tgt_key_padding_mask,
+            need_weights=False,
+            static_k=self_k,
+            static_v=self_v,
         )[0]
         tgt = tgt + self.dropout1(tgt2)
         tgt = self.norm1(tgt)
@@ -121,6 +186,9 @@ class TransformerDecoderLayer(nn.Module):
             arm=arm,
             attn_mask=memory_mask,
             key_padding_mask=memory_key_padding_mask,
+            need_weights=need_weights,
+            static_k=memory_k.flatten(0, 1),
+            static_v=memory_v.flatten(0, 1),
         )
         tgt = tgt + self.dropout2(tgt2)
         tgt = self.norm2(tgt)
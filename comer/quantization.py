@@ -0,0 +1,116 @@
+import inspect
+import warnings
+from typing import Iterable, Optional
+
+import torch
+import torch.nn as nn
+from torch.quantization import get_default_qconfig, quantize_dynamic, quantize_fx
+
+from comer.datamodule import Batch
+from comer.lit_comer import LitCoMER
+from comer.model.transformer.attention import MultiheadAttention
+
+QUANTIZATION_MODES = ("dynamic", "static")
+
+# torch >= 1.13 traces with example inputs and is configured by a QConfigMapping,
+# 1.8 takes a qconfig dict only
+_PREPARE_FX_EXAMPLE = (
+    "example_inputs" in inspect.signature(quantize_fx.prepare_fx).parameters
+)
+
+
+def quantize(
+    model: LitCoMER,
+    mode: str = "dynamic",
+    calibration: Optional[Iterable[Batch]] = None,
+) -> LitCoMER:
+    """quantize a LitCoMER to int8 for inference on cpu, in place
+
+    BatchNorm of the encoder is folded into the convs, and the linear layers of
+    the decoder, attention projections included, are quantized dynamically.
+    With mode "static", the convs of DenseNet are quantized as well, with the
+    ranges of activations observed on the images of calibration.
+
+    Parameters
+    ----------
+    model : LitCoMER
+    mode : str, optional
+        one of QUANTIZATION_MODES, by default "dynamic"
+    calibration : Optional[Iterable[Batch]], optional
+        batches to observe for mode "static", by default None
+
+    Returns
+    -------
+    LitCoMER
+        model itself, in eval mode and on cpu
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"mode should be one of {QUANTIZATION_MODES}, got {mode}")
+    model = model.eval().cpu()
+
+    encoder = model.comer_model.encoder
+    encoder.fuse_bn()
+
+    decoder = model.comer_model.decoder
+    for m in decoder.modules():
+        if isinstance(m, MultiheadAttention):
+            m.split_in_proj()
+    quantize_dynamic(decoder, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    if mode == "static":
+        densenet = encoder.model
+        # the preallocated buffer of memory_efficient blocks can not be traced
+        for block in (densenet.dense1, densenet.dense2, densenet.dense3):
+            block.memory_efficient = False
+
+        qconfig = get_default_qconfig(torch.backends.quantized.engine)
+        if _PREPARE_FX_EXAMPLE:
+            from torch.ao.quantization import QConfigMapping
+
+            example = (
+                torch.zeros(1, 1, 32, 32),
+                torch.zeros(1, 32, 32, dtype=torch.bool),
+            )
+            densenet = quantize_fx.prepare_fx(
+                densenet, QConfigMapping().set_global(qconfig), example
+            )
+        else:
+            densenet = quantize_fx.prepare_fx(densenet, {"": qconfig})
+        with torch.no_grad():
+            for batch in calibration or []:
+                densenet(batch.imgs, batch.mask)
+        encoder.model = quantize_fx.convert_fx(densenet)
+
+    return model
+
+
+def save_quantized(model: LitCoMER, path: str, mode: str) -> None:
+    """save a model quantized by quantize(model, mode) to be read by load_quantized"""
+    torch.save(
+        {
+            "hyper_parameters": dict(model.hparams),
+            "quantization": mode,
+            "engine": torch.backends.quantized.engine,
+            "state_dict": model.state_dict(),
+        },
+        path,
+    )
+
+
+def load_quantized(path: str) -> LitCoMER:
+    """load a quantized checkpoint written by save_quantized
+
+    The quantized modules are rebuilt from the hyper parameters before the
+    weights and quantization parameters are loaded, so the quantized engine of
+    torch is set to the one used when quantizing.
+    """
+    ckpt = torch.load(path, map_location="cpu")
+    torch.backends.quantized.engine = ckpt["engine"]
+
+    model = LitCoMER(**ckpt["hyper_parameters"])
+    with warnings.catch_warnings():
+        # observers are not run, their ranges come from the state dict below
+        warnings.simplefilter("ignore")
+        quantize(model, ckpt["quantization"])
+    model.load_state_dict(ckpt["state_dict"])
+    return model
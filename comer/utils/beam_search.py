@@ -1,4 +1,4 @@
-from typing import List, Tuple
+from typing import Optional, Tuple
 
 import torch
 from comer.datamodule import vocab
@@ -14,25 +14,127 @@ class BeamSearchScorer:
         beam_size: int,
         alpha: float,
         do_early_stopping: bool,
+        max_len: int,
         device: torch.device,
     ) -> None:
         self.batch_size = batch_size
         self.beam_size = beam_size
         self.alpha = alpha
+        self.do_early_stopping = do_early_stopping
         self.device = device
 
-        self._beam_hyps = [
-            BeamHypotheses(beam_size, alpha, do_early_stopping)
-            for _ in range(batch_size)
-        ]
+        # n-best list of finished hypotheses for each batch, kept in beam_size slots
+        self._hyp_tokens = torch.zeros(
+            (batch_size, beam_size, max_len), dtype=torch.long, device=self.device
+        )
+        self._hyp_lens = torch.zeros(
+            (batch_size, beam_size), dtype=torch.long, device=self.device
+        )
+        # scores are compared in double precision like python floats
+        self._hyp_scores = torch.zeros(
+            (batch_size, beam_size), dtype=torch.double, device=self.device
+        )
+        # when each hypothesis was added, the n-best list is ordered by it
+        self._hyp_order = torch.zeros(
+            (batch_size, beam_size), dtype=torch.long, device=self.device
+        )
+        self._num_hyps = torch.zeros(batch_size, dtype=torch.long, device=self.device)
+        self._worst_scores = torch.full(
+            (batch_size,), 1e9, dtype=torch.double, device=self.device
+        )
+        self._num_added = 0
 
         self._done = torch.tensor(
             [False for _ in range(batch_size)], dtype=torch.bool, device=self.device
         )
+        # batches still being decoded, finished ones are dropped by compact
+        self._alive = torch.arange(batch_size, dtype=torch.long, device=self.device)
 
     def is_done(self) -> bool:
         return self._done.all()
 
+    def compact(self) -> Optional[LongTensor]:
+        """drop the finished batches from the alive ones
+
+        Returns
+        -------
+        Optional[LongTensor]
+            [b' * beam_size] rows of the unfinished beams among current rows,
+            None if no batch is dropped
+        """
+        alive_done = self._done[self._alive]
+        if not alive_done.any():
+            return None
+
+        kept = (~alive_done).nonzero(as_tuple=True)[0]
+        self._alive = self._alive[kept]
+
+        beam_idx = torch.arange(self.beam_size, device=self.device)
+        return (kept[:, None] * self.beam_size + beam_idx[None, :]).view(-1)
+
+    def _add(self, mask: torch.BoolTensor, hyp: LongTensor, sum_logprobs: FloatTensor):
+        """add one new hypothesis to the n-best list of each alive batch where mask is True
+
+        Parameters
+        ----------
+        mask : torch.BoolTensor
+            [b']
+        hyp : LongTensor
+            [b', l]
+        sum_logprobs : FloatTensor
+            [b']
+        """
+        batch_idx = self._alive
+        l = hyp.shape[-1]
+
+        num_hyps = self._num_hyps[batch_idx]
+        worst_scores = self._worst_scores[batch_idx]
+
+        score = sum_logprobs.double() / (l**self.alpha)
+        is_full = num_hyps >= self.beam_size
+        mask = mask & (~is_full | (score > worst_scores))
+
+        # replace the worst hypothesis (the earliest added one if tie) when full,
+        # otherwise fill the next empty slot
+        order = self._hyp_order[batch_idx].masked_fill(
+            self._hyp_scores[batch_idx] != worst_scores[:, None], self._num_added
+        )
+        slot = torch.where(
+            is_full,
+            order.argmin(dim=1),
+            num_hyps.clamp(max=self.beam_size - 1),
+        )
+
+        self._hyp_tokens[batch_idx, slot, :l] = torch.where(
+            mask[:, None], hyp, self._hyp_tokens[batch_idx, slot, :l]
+        )
+        self._hyp_lens[batch_idx, slot] = torch.where(
+            mask, torch.full_like(slot, l), self._hyp_lens[batch_idx, slot]
+        )
+        self._hyp_scores[batch_idx, slot] = torch.where(
+            mask, score, self._hyp_scores[batch_idx, slot]
+        )
+        self._hyp_order[batch_idx, slot] = torch.where(
+            mask,
+            torch.full_like(slot, self._num_added),
+            self._hyp_order[batch_idx, slot],
+        )
+        self._num_added += 1
+
+        num_hyps = (num_hyps + mask.long()).clamp(max=self.beam_size)
+        filled = (
+            torch.arange(self.beam_size, device=self.device)[None, :]
+            < num_hyps[:, None]
+        )
+        self._num_hyps[batch_idx] = num_hyps
+        self._worst_scores[batch_idx] = torch.where(
+            num_hyps > 0,
+            self._hyp_scores[batch_idx]
+            .masked_fill(~filled, float("inf"))
+            .min(dim=1)[0],
+            torch.full_like(worst_scores, 1e9),
+        )
+
     def process(
         self,
         input_ids: LongTensor,
@@ -45,86 +147,64 @@ class BeamSearchScorer:
         Parameters
         ----------
         input_ids : LongTensor
-            [b * beam_size, l]
+            [b' * beam_size, l], b' is the number of alive batches
         next_scores : FloatTensor
-            [b, 2 * beam_size]
+            [b', 2 * beam_size]
         next_tokens : LongTensor
-            [b, 2 * beam_size]
+            [b', 2 * beam_size]
         next_indices : LongTensor
-            [b, 2 * beam_size]
+            [b', 2 * beam_size]
 
         Returns
         -------
         Tuple[FloatTensor, LongTensor, LongTensor]
-            next_scores: [b * beam_size]
-            next_tokens: [b * beam_size]
-            next_indices: [b * beam_size]
+            next_scores: [b' * beam_size]
+            next_tokens: [b' * beam_size]
+            next_indices: [b' * beam_size]
         """
-        next_beam_scores = torch.zeros(
-            (self.batch_size, self.beam_size),
-            dtype=next_scores.dtype,
-            device=self.device,
-        )
-        next_beam_tokens = torch.zeros(
-            (self.batch_size, self.beam_size),
-            dtype=next_tokens.dtype,
-            device=self.device,
-        )
-        next_beam_indices = torch.zeros(
-            (self.batch_size, self.beam_size),
-            dtype=next_indices.dtype,
-            device=self.device,
-        )
-
-        for batch_idx, beam_hyp in enumerate(self._beam_hyps):
-            if self._done[batch_idx]:
-                assert len(beam_hyp) >= self.beam_size
-                # pad the batch
-                next_beam_scores[batch_idx, :] = 0
-                next_beam_tokens[batch_idx, :] = vocab.PAD_IDX
-                next_beam_indices[batch_idx, :] = batch_idx * self.beam_size
-                continue
-
-            beam_idx = 0
-            for beam_token_rank, (next_score, next_token, next_index) in enumerate(
-                zip(
-                    next_scores[batch_idx],
-                    next_tokens[batch_idx],
-                    next_indices[batch_idx],
-                )
-            ):
-                batch_beam_idx = batch_idx * self.beam_size + next_index
-                l2r_done = (
-                    input_ids[batch_beam_idx][0].item() == vocab.SOS_IDX
-                    and next_token.item() == vocab.EOS_IDX
-                )
-                r2l_done = (
-                    input_ids[batch_beam_idx][0].item() == vocab.EOS_IDX
-                    and next_token.item() == vocab.SOS_IDX
-                )
-                if l2r_done or r2l_done:
-                    if beam_token_rank >= self.beam_size:
-                        # if beam_token does not belong to top num_beams tokens, it should not be added
-                        continue
-                    beam_hyp.add(input_ids[batch_beam_idx].clone(), next_score.item())
-                else:
-                    # add next predicted token since it is not eos_token
-                    next_beam_scores[batch_idx, beam_idx] = next_score
-                    next_beam_tokens[batch_idx, beam_idx] = next_token
-                    next_beam_indices[batch_idx, beam_idx] = batch_beam_idx
-                    beam_idx += 1
-
-                # once the beam for next step is full, don't add more tokens to it.
-                if beam_idx == self.beam_size:
-                    break
-
-            assert beam_idx == self.beam_size
-
-            self._done[batch_idx] = beam_hyp.is_done(
-                best_sum_logprobs=next_beam_scores[batch_idx].max().item(),
-                cur_len=input_ids.shape[-1],
+        batch_idx = torch.arange(self._alive.shape[0], device=self.device)
+        done = self._done[self._alive]
+        batch_beam_idx = batch_idx[:, None] * self.beam_size + next_indices
+
+        start_tokens = input_ids[batch_beam_idx, 0]
+        l2r_done = (start_tokens == vocab.SOS_IDX) & (next_tokens == vocab.EOS_IDX)
+        r2l_done = (start_tokens == vocab.EOS_IDX) & (next_tokens == vocab.SOS_IDX)
+        is_finished = l2r_done | r2l_done
+
+        # if beam_token does not belong to top num_beams tokens, it should not be added
+        for i in range(self.beam_size):
+            self._add(
+                is_finished[:, i] & ~done,
+                input_ids[batch_beam_idx[:, i]],
+                next_scores[:, i],
             )
 
+        # the first beam_size unfinished tokens go to the next step,
+        # there are at most beam_size finished ones in 2 * beam_size candidates
+        rank = torch.arange(2 * self.beam_size, device=self.device)
+        sort_key = is_finished.long() * (2 * self.beam_size) + rank[None, :]
+        kept = sort_key.sort(dim=1)[1][:, : self.beam_size]
+
+        next_beam_scores = next_scores.gather(1, kept)
+        next_beam_tokens = next_tokens.gather(1, kept)
+        next_beam_indices = batch_beam_idx.gather(1, kept)
+
+        # pad the done batches
+        next_beam_scores = next_beam_scores.masked_fill(done[:, None], 0)
+        next_beam_tokens = next_beam_tokens.masked_fill(done[:, None], vocab.PAD_IDX)
+        next_beam_indices = torch.where(
+            done[:, None], batch_idx[:, None] * self.beam_size, next_beam_indices
+        )
+
+        # none of the hypotheses being generated can become better than the worst one
+        cur_score = next_beam_scores.max(dim=1)[0].double() / (
+            input_ids.shape[-1] ** self.alpha
+        )
+        is_done = self._num_hyps[self._alive] >= self.beam_size
+        if not self.do_early_stopping:
+            is_done = is_done & (self._worst_scores[self._alive] >= cur_score)
+        self._done[self._alive] = done | is_done
+
         return (
             next_beam_scores.view(-1),
             next_beam_tokens.view(-1),
@@ -135,95 +215,43 @@ class BeamSearchScorer:
         self,
         input_ids: LongTensor,
         final_scores: FloatTensor,
-    ) -> Tuple[List[LongTensor], FloatTensor]:
+    ) -> Tuple[LongTensor, LongTensor, FloatTensor]:
         """generate final output
 
         Parameters
         ----------
         input_ids : LongTensor
-            [b * beam_size, l]
+            [b' * beam_size, l], b' is the number of alive batches
         final_scores : FloatTensor
-            [b * beam_size]
+            [b' * beam_size]
 
         Returns
         -------
-        Tuple[List[LongTensor], FloatTensor]
-            List[LongTensor]: [b * beam_size] without SOS or EOS token
+        Tuple[LongTensor, LongTensor, FloatTensor]
+            LongTensor: [b * beam_size, l] without SOS or EOS token, padded
+            LongTensor: [b * beam_size] lengths
             FloatTensor: [b * beam_size] corresponding scores
         """
-        # finalize all open beam hypotheses and add to generated hypotheses
-        for batch_idx, beam_hyp in enumerate(self._beam_hyps):
-            if self._done[batch_idx]:
-                continue
-
-            # all open beam hypotheses are added to the beam hypothesis
-            # beam hypothesis class automatically keeps the best beams
-            for beam_id in range(self.beam_size):
-                batch_beam_idx = batch_idx * self.beam_size + beam_id
-                final_score = final_scores[batch_beam_idx].item()
-                final_tokens = input_ids[batch_beam_idx]
-                beam_hyp.add(final_tokens, final_score)
+        # all open beam hypotheses of unfinished batches are added to the n-best list
+        alive_idx = torch.arange(self._alive.shape[0], device=self.device)
+        not_done = ~self._done[self._alive]
+        for beam_id in range(self.beam_size):
+            batch_beam_idx = alive_idx * self.beam_size + beam_id
+            self._add(not_done, input_ids[batch_beam_idx], final_scores[batch_beam_idx])
 
-        all_hyps: List[LongTensor] = []
-        scores: FloatTensor = torch.zeros(
-            self.batch_size * self.beam_size, dtype=torch.float, device=self.device
-        )
-
-        for beam_hyp in self._beam_hyps:
-            for score, seq in beam_hyp.beams:
-                scores[len(all_hyps)] = score
-                all_hyps.append(seq[1:])
+        batch_idx = torch.arange(self.batch_size, device=self.device)
 
-        return all_hyps, scores
+        order = self._hyp_order.argsort(dim=1)
+        tokens = self._hyp_tokens[batch_idx[:, None], order]
+        scores = self._hyp_scores.gather(1, order).view(-1).float()
+        # without SOS
+        lens = self._hyp_lens.gather(1, order).view(-1) - 1
 
+        # slots may keep tokens of longer evicted hypotheses after the length
+        tokens = tokens.view(self.batch_size * self.beam_size, -1)
+        max_len = int(lens.max())
+        all_hyps = tokens[:, 1 : max_len + 1]
+        pos = torch.arange(max_len, device=self.device)
+        all_hyps = all_hyps.masked_fill(pos[None, :] >= lens[:, None], vocab.PAD_IDX)
 
-class BeamHypotheses:
-    def __init__(self, num_beams: int, length_penalty: float, early_stopping: bool):
-        """
-        Initialize n-best list of hypotheses.
-        """
-        self.length_penalty = length_penalty
-        self.early_stopping = early_stopping
-        self.num_beams = num_beams
-        self.beams: List[Tuple[float, LongTensor]] = []
-        self.worst_score = 1e9
-
-    def __len__(self):
-        """
-        Number of hypotheses in the list.
-        """
-        return len(self.beams)
-
-    def add(self, hyp: LongTensor, sum_logprobs: float):
-        """
-        Add a new hypothesis to the list.
-        """
-        # if not _check_hypothesis_bracket(tuple(hyp.tolist())):
-        #     sum_logprobs = float("-inf")
-
-        score = sum_logprobs / (hyp.shape[-1] ** self.length_penalty)
-        if len(self) < self.num_beams or score > self.worst_score:
-            self.beams.append((score, hyp))
-            if len(self) > self.num_beams:
-                sorted_next_scores = sorted(
-                    [(s, idx) for idx, (s, _) in enumerate(self.beams)]
-                )
-                del self.beams[sorted_next_scores[0][1]]
-                self.worst_score = sorted_next_scores[1][0]
-            else:
-                self.worst_score = min(score, self.worst_score)
-
-    def is_done(self, best_sum_logprobs: float, cur_len: int) -> bool:
-        """
-        If there are enough hypotheses and that none of the hypotheses being generated can become better than the worst
-        one in the heap, then we are done with this sentence.
-        """
-
-        if len(self) < self.num_beams:
-            return False
-        elif self.early_stopping:
-            return True
-        else:
-            cur_score = best_sum_logprobs / cur_len ** self.length_penalty
-            ret = self.worst_score >= cur_score
-            return ret
+        return all_hyps, lens, scores
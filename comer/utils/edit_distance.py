@@ -0,0 +1,131 @@
+from multiprocessing import Pool
+from typing import Hashable, List, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch import LongTensor
+
+Tokens = Sequence[Hashable]
+
+
+def edit_distance(
+    hyp: LongTensor, hyp_lens: LongTensor, ref: LongTensor, ref_lens: LongTensor
+) -> LongTensor:
+    """batched Levenshtein distance between rows of hyp and ref
+
+    The dp runs row by row over hyp, a row is computed for the whole batch at
+    once, and insertions along a row are resolved by a cummin.
+
+    Parameters
+    ----------
+    hyp : LongTensor
+        [b, m]
+    hyp_lens : LongTensor
+        [b]
+    ref : LongTensor
+        [b, n]
+    ref_lens : LongTensor
+        [b]
+
+    Returns
+    -------
+    LongTensor
+        [b]
+    """
+    pos = torch.arange(ref.size(1) + 1, device=ref.device)
+    # dp[b, j]: distance between hyp[b, :i] and ref[b, :j]
+    dp = pos.repeat(ref.size(0), 1)
+    for i in range(hyp.size(1)):
+        cost = (hyp[:, i, None] != ref).long()
+        row = torch.cat(
+            (dp[:, :1] + 1, torch.min(dp[:, 1:] + 1, dp[:, :-1] + cost)), dim=1
+        )
+        # dp[i, j] = min_k(row[k] + j - k)
+        row = torch.cummin(row - pos, dim=1)[0] + pos
+        dp = torch.where((i < hyp_lens)[:, None], row, dp)
+    return dp.gather(1, ref_lens[:, None]).squeeze(1)
+
+
+def _pad(seqs: List[List[int]]) -> Tuple[LongTensor, LongTensor]:
+    lens = np.array([len(s) for s in seqs], dtype=np.int64)
+    padded = np.zeros((len(seqs), max(lens.max(), 1)), dtype=np.int64)
+    padded[np.arange(padded.shape[1])[None, :] < lens[:, None]] = np.fromiter(
+        (t for s in seqs for t in s), dtype=np.int64, count=lens.sum()
+    )
+    return torch.from_numpy(padded), torch.from_numpy(lens)
+
+
+def _batch_distance(pairs: Tuple[List[List[int]], List[List[int]]]) -> np.ndarray:
+    hyp, hyp_lens = _pad(pairs[0])
+    ref, ref_lens = _pad(pairs[1])
+    return edit_distance(hyp, hyp_lens, ref, ref_lens).numpy()
+
+
+def edit_distances(
+    hyps: Sequence[Tokens],
+    refs: Sequence[Tokens],
+    batch_size: int = 256,
+    num_workers: int = 0,
+) -> np.ndarray:
+    """token level Levenshtein distance of each (hyp, ref) pair
+
+    Pairs are sorted by length and computed in batches, so that short pairs
+    are not padded to the longest one.
+
+    Parameters
+    ----------
+    hyps : Sequence[Tokens]
+        predicted token sequences, eg: LaTeX tokens or vocab indices
+    refs : Sequence[Tokens]
+        reference token sequences
+    batch_size : int, optional
+        number of pairs computed together, by default 256
+    num_workers : int, optional
+        number of processes computing batches, by default 0 for in process
+
+    Returns
+    -------
+    np.ndarray
+        [n] distance of each pair
+    """
+    assert len(hyps) == len(refs)
+    if len(hyps) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    token2idx = {}
+    hyps = [[token2idx.setdefault(t, len(token2idx)) for t in h] for h in hyps]
+    refs = [[token2idx.setdefault(t, len(token2idx)) for t in r] for r in refs]
+
+    order = sorted(range(len(hyps)), key=lambda i: max(len(hyps[i]), len(refs[i])))
+    batches = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+    pairs = [([hyps[i] for i in b], [refs[i] for i in b]) for b in batches]
+
+    if num_workers > 0:
+        with Pool(num_workers) as pool:
+            results = pool.map(_batch_distance, pairs)
+    else:
+        results = [_batch_distance(p) for p in pairs]
+
+    dist = np.empty(len(hyps), dtype=np.int64)
+    for b, res in zip(batches, results):
+        dist[b] = res
+    return dist
+
+
+def exprate_table(
+    hyps: Sequence[Tokens],
+    refs: Sequence[Tokens],
+    error_tol: int = 3,
+    batch_size: int = 256,
+    num_workers: int = 0,
+) -> np.ndarray:
+    """ExpRate with at most 0, 1, ..., error_tol - 1 token errors tolerated,
+    the same table as scripts/test/extract_exprate.py
+
+    Returns
+    -------
+    np.ndarray
+        [error_tol] rate in [0, 1]
+    """
+    dist = edit_distances(hyps, refs, batch_size, num_workers)
+    return (dist[None, :] <= np.arange(error_tol)[:, None]).mean(axis=1)
@@ -1,14 +1,14 @@
 from abc import abstractmethod
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import pytorch_lightning as pl
 import torch
 import torch.nn.functional as F
 from comer.datamodule import vocab, vocab_size
-from comer.utils.utils import Hypothesis, ce_loss, to_tgt_output
+from comer.utils.utils import Hypothesis, ce_loss, flip_padded, to_tgt_output
 from einops import rearrange
 from einops.einops import repeat
-from torch import FloatTensor, LongTensor
+from torch import FloatTensor, LongTensor, Tensor
 
 from .beam_search import BeamSearchScorer
 
@@ -17,9 +17,31 @@ from .beam_search import BeamSearchScorer
 
 
 class DecodeModel(pl.LightningModule):
+    @abstractmethod
+    def transform_memory(
+        self, src: List[FloatTensor]
+    ) -> List[List[Tuple[Tensor, Tensor]]]:
+        """project src into the key and value used by every decoder layer
+
+        Parameters
+        ----------
+        src : List[FloatTensor]
+            [b, t, d]
+
+        Returns
+        -------
+        List[List[Tuple[Tensor, Tensor]]]
+            k, v of each layer for each src: [b, ...]
+        """
+        raise NotImplementedError("This is an abstract method.")
+
     @abstractmethod
     def transform(
-        self, src: List[FloatTensor], src_mask: List[LongTensor], input_ids: LongTensor
+        self,
+        src: List[FloatTensor],
+        src_mask: List[LongTensor],
+        input_ids: LongTensor,
+        memory: Optional[List[List[Tuple[Tensor, Tensor]]]] = None,
     ) -> FloatTensor:
         """decode one step
 
@@ -31,6 +53,8 @@ class DecodeModel(pl.LightningModule):
             [b, t]
         input_ids : LongTensor
             [b, l]
+        memory : Optional[List[List[Tuple[Tensor, Tensor]]]], optional
+            result of transform_memory for src, by default None
 
         Returns
         -------
@@ -39,6 +63,75 @@ class DecodeModel(pl.LightningModule):
         """
         raise NotImplementedError("This is an abstract method.")
 
+    @abstractmethod
+    def transform_step(
+        self,
+        src: List[FloatTensor],
+        src_mask: List[LongTensor],
+        input_ids: LongTensor,
+        memory: List[List[Tuple[Tensor, Tensor]]],
+        cache: List[Dict[str, Tensor]],
+    ) -> FloatTensor:
+        """decode the last step of input_ids incrementally
+
+        Parameters
+        ----------
+        src : List[FloatTensor]
+            [b, t, d]
+        src_mask : List[LongTensor]
+            [b, t]
+        input_ids : LongTensor
+            [b, l]
+        memory : List[List[Tuple[Tensor, Tensor]]]
+            result of transform_memory for src
+        cache : List[Dict[str, Tensor]]
+            states of previous steps, updated in place, every tensor is [b, ...]
+
+        Returns
+        -------
+        FloatTensor
+            [b, vocab_size]
+        """
+        raise NotImplementedError("This is an abstract method.")
+
+    @staticmethod
+    def reorder_cache(cache: List[Dict[str, Tensor]], beam_idx: LongTensor) -> None:
+        """select the cached states of beams kept by beam search
+
+        Parameters
+        ----------
+        cache : List[Dict[str, Tensor]]
+            every tensor is [b, ...]
+        beam_idx : LongTensor
+            [b',]
+        """
+        for layer_cache in cache:
+            for k, v in layer_cache.items():
+                layer_cache[k] = v.index_select(0, beam_idx)
+
+    @staticmethod
+    def select_memory(
+        memory: List[List[Tuple[Tensor, Tensor]]], idx: LongTensor
+    ) -> List[List[Tuple[Tensor, Tensor]]]:
+        """select rows of memory instead of projecting the repeated src again
+
+        Parameters
+        ----------
+        memory : List[List[Tuple[Tensor, Tensor]]]
+            every tensor is [b, ...]
+        idx : LongTensor
+            [b',]
+
+        Returns
+        -------
+        List[List[Tuple[Tensor, Tensor]]]
+            every tensor is [b', ...]
+        """
+        return [
+            [(k.index_select(0, idx), v.index_select(0, idx)) for k, v in m]
+            for m in memory
+        ]
+
     def beam_search(
         self,
         src: List[FloatTensor],
@@ -66,10 +159,55 @@ class DecodeModel(pl.LightningModule):
         -------
         List[Hypothesis]: [batch_size,]
         """
+        hyps, hyp_lens, scores = self.padded_beam_search(
+            src, src_mask, beam_size, max_len, alpha, early_stopping, temperature
+        )
+        return [
+            Hypothesis(hyp[:l], score, "l2r")
+            for hyp, l, score in zip(hyps, hyp_lens.tolist(), scores)
+        ]
+
+    def padded_beam_search(
+        self,
+        src: List[FloatTensor],
+        src_mask: List[LongTensor],
+        beam_size: int,
+        max_len: int,
+        alpha: float,
+        early_stopping: bool,
+        temperature: float,
+    ) -> Tuple[LongTensor, LongTensor, FloatTensor]:
+        """run beam search to decode, keeping the best hypotheses on device
+
+        Parameters
+        ----------
+        src : List[FloatTensor]
+            [b, t, d]
+        src_mask : List[LongTensor]
+            [b, t]
+        beam_size : int
+        max_len : int
+        alpha : float
+        early_stopping : bool
+
+        Returns
+        -------
+        Tuple[LongTensor, LongTensor, FloatTensor]
+            LongTensor: [b, l] best hypothesis in l2r order, padded with PAD_IDX
+            LongTensor: [b] lengths
+            FloatTensor: [b] scores
+        """
         batch_size = src[0].shape[0] * 2  # mul 2 for bi-direction
         batch_beam_size = batch_size * beam_size
         half_bb_size = batch_beam_size // 2
 
+        # project memory once per image, then reuse it for both directions
+        memory = self.transform_memory(src)
+        double_idx = torch.arange(
+            batch_size // 2, dtype=torch.long, device=self.device
+        ).repeat(2)
+        memory = self.select_memory(memory, double_idx)
+
         for i in range(len(src)):
             # [2 * b, t, d], [l2r l2r, r2l r2l]
             src[i] = torch.cat((src[i], src[i]), dim=0)
@@ -90,13 +228,14 @@ class DecodeModel(pl.LightningModule):
         input_ids = torch.cat((l2r, r2l), dim=0)
 
         beam_scorer = BeamSearchScorer(
-            batch_size, beam_size, alpha, early_stopping, self.device
+            batch_size, beam_size, alpha, early_stopping, max_len, self.device
         )
 
         # first beam search
-        hyps, scores = self._beam_search(
+        hyps, hyp_lens, scores = self._beam_search(
             src=src,
             src_mask=src_mask,
+            memory=memory,
             input_ids=input_ids,
             beam_scorer=beam_scorer,
             beam_size=beam_size,
@@ -105,21 +244,25 @@ class DecodeModel(pl.LightningModule):
         )
 
         # reverse half last
-        for i in range(half_bb_size, batch_beam_size):
-            hyps[i] = torch.flip(hyps[i], dims=[0])
+        hyps = torch.cat(
+            (
+                hyps[:half_bb_size],
+                flip_padded(hyps[half_bb_size:], hyp_lens[half_bb_size:]),
+            ),
+            dim=0,
+        )
 
-        lens = [len(h) + 1 for h in hyps]  # plus to append start token
         r2l_tgt, r2l_out = to_tgt_output(
-            hyps[:half_bb_size], "r2l", self.device, pad_to_len=max(lens)
+            hyps[:half_bb_size], hyp_lens[:half_bb_size], "r2l"
         )
         l2r_tgt, l2r_out = to_tgt_output(
-            hyps[half_bb_size:], "l2r", self.device, pad_to_len=max(lens)
+            hyps[half_bb_size:], hyp_lens[half_bb_size:], "l2r"
         )
         tgt = torch.cat((l2r_tgt, r2l_tgt), dim=0)
         out = torch.cat((l2r_out, r2l_out), dim=0)
 
         # calculate final score
-        rev_scores = self._rate(src, src_mask, tgt, out, alpha, temperature)
+        rev_scores = self._rate(src, src_mask, memory, tgt, out, alpha, temperature)
         rev_scores = torch.cat(
             (rev_scores[half_bb_size:], rev_scores[:half_bb_size]), dim=0
         )
@@ -141,22 +284,19 @@ class DecodeModel(pl.LightningModule):
             best_split * half_bb_size + batch_indices * beam_size + best_indices
         )
 
-        ret: List[Hypothesis] = []
-        for idx, score in zip(best_indices, best_scores):
-            hpy = Hypothesis(hyps[idx], score, "l2r")
-            ret.append(hpy)
-        return ret
+        return hyps[best_indices], hyp_lens[best_indices], best_scores
 
     def _beam_search(
         self,
         src: List[FloatTensor],
         src_mask: List[LongTensor],
+        memory: List[List[Tuple[Tensor, Tensor]]],
         input_ids: LongTensor,
         beam_scorer: BeamSearchScorer,
         beam_size: int,
         max_len: int,
         temperature: float,
-    ) -> Tuple[List[LongTensor], FloatTensor]:
+    ) -> Tuple[LongTensor, LongTensor, FloatTensor]:
         """inner beam search
 
         Parameters
@@ -165,6 +305,8 @@ class DecodeModel(pl.LightningModule):
             [b, t, d]
         src_mask : List[LongTensor]
             [b, t]
+        memory : List[List[Tuple[Tensor, Tensor]]]
+            result of transform_memory for src
         input_ids: LongTensor
             [b, 1]
         beam_size : int
@@ -172,17 +314,25 @@ class DecodeModel(pl.LightningModule):
 
         Returns
         _______
-        Tuple[List[LongTensor], FloatTensor]
-            List[LongTensor]: [b * beam_size] without SOS or EOS token
+        Tuple[LongTensor, LongTensor, FloatTensor]
+            LongTensor: [b * beam_size, l] without SOS or EOS token, padded
+            LongTensor: [b * beam_size] lengths
             FloatTensor: [b * beam_size] corresponding scores
         """
         batch_size, cur_len = input_ids.shape
 
         beam_scores = torch.zeros(batch_size, dtype=torch.float, device=self.device)
 
+        # inputs of alive batches, finished batches are dropped from them
+        step_src, step_src_mask, step_memory = src, src_mask, memory
+
+        cache: List[Dict[str, Tensor]] = []
         while cur_len < max_len and not beam_scorer.is_done():
             next_token_logits = (
-                self.transform(src, src_mask, input_ids)[:, -1, :] / temperature
+                self.transform_step(
+                    step_src, step_src_mask, input_ids, step_memory, cache
+                )
+                / temperature
             )
             # [b *, l, v]
             next_token_scores = F.log_softmax(next_token_logits, dim=-1)
@@ -211,6 +361,11 @@ class DecodeModel(pl.LightningModule):
                 for i in range(len(src)):
                     src[i] = repeat(src[i], "b ... -> (b m) ...", m=beam_size)
                     src_mask[i] = repeat(src_mask[i], "b ... -> (b m) ...", m=beam_size)
+                expand_idx = torch.arange(
+                    batch_size, dtype=torch.long, device=self.device
+                ).repeat_interleave(beam_size)
+                memory[:] = self.select_memory(memory, expand_idx)
+                step_src, step_src_mask, step_memory = list(src), list(src_mask), memory
 
             beam_scores, beam_next_tokens, beam_idx = beam_scorer.process(
                 input_ids=input_ids,
@@ -223,6 +378,22 @@ class DecodeModel(pl.LightningModule):
                 (input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)), dim=-1
             )
 
+            # cache is built before repeating for beams in the first step
+            cache_idx = beam_idx // beam_size if cur_len == 1 else beam_idx
+
+            # drop the beams of finished batches, so they are not decoded any more
+            kept = beam_scorer.compact()
+            if kept is not None:
+                input_ids = input_ids[kept]
+                beam_scores = beam_scores[kept]
+                step_src = [s[kept] for s in step_src]
+                step_src_mask = [m[kept] for m in step_src_mask]
+                step_memory = self.select_memory(step_memory, kept)
+                cache_idx = cache_idx[kept]
+                batch_size = kept.shape[0] // beam_size
+
+            self.reorder_cache(cache, cache_idx)
+
             cur_len += 1
 
         return beam_scorer.finalize(input_ids, beam_scores)
@@ -231,6 +402,7 @@ class DecodeModel(pl.LightningModule):
         self,
         src: List[FloatTensor],
         src_mask: List[LongTensor],
+        memory: List[List[Tuple[Tensor, Tensor]]],
         tgt: LongTensor,
         out: LongTensor,
         alpha: float,
@@ -244,6 +416,8 @@ class DecodeModel(pl.LightningModule):
             [b * beam_size, t, d]
         src_mask : List[LongTensor]
             [b * beam_size, t]
+        memory : List[List[Tuple[Tensor, Tensor]]]
+            result of transform_memory for src
         tgt : LongTensor
             [b * beam_size, l]
         out : LongTensor
@@ -257,7 +431,7 @@ class DecodeModel(pl.LightningModule):
             [b * beam_size]
         """
         b = tgt.shape[0]
-        out_hat = self.transform(src, src_mask, tgt) / temperature
+        out_hat = self.transform(src, src_mask, tgt, memory) / temperature
 
         loss = ce_loss(out_hat, out, reduction="none")
         loss = rearrange(loss, "(b l) -> b l", b=b)
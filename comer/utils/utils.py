@@ -1,8 +1,9 @@
-from typing import List, Optional, Tuple, Union
+from typing import List, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
 from comer.datamodule import vocab
+from comer.utils.edit_distance import edit_distance
 from einops import rearrange
 from torch import LongTensor
 from torchmetrics import Metric
@@ -40,23 +41,55 @@ class Hypothesis:
 
 
 class ExpRateRecorder(Metric):
-    def __init__(self, dist_sync_on_step=False):
+    def __init__(self, error_tol: int = 0, dist_sync_on_step=False):
+        """
+        Parameters
+        ----------
+        error_tol : int, optional
+            an expression is counted as correct with at most error_tol token
+            edit errors, by default 0
+        dist_sync_on_step : bool, optional
+        """
         super().__init__(dist_sync_on_step=dist_sync_on_step)
+        self.error_tol = error_tol
 
         self.add_state("total_line", default=torch.tensor(0.0), dist_reduce_fx="sum")
         self.add_state("rec", default=torch.tensor(0.0), dist_reduce_fx="sum")
 
-    def update(self, indices_hat: List[List[int]], indices: List[List[int]]):
-        for pred, truth in zip(indices_hat, indices):
-            pred = vocab.indices2label(pred)
-            truth = vocab.indices2label(truth)
-
-            is_same = pred == truth
-
-            if is_same:
-                self.rec += 1
+    def update(
+        self,
+        indices_hat: LongTensor,
+        hat_lens: LongTensor,
+        indices: LongTensor,
+        lens: LongTensor,
+    ):
+        """
+        Parameters
+        ----------
+        indices_hat : LongTensor
+            [b, m], padded with PAD_IDX
+        hat_lens : LongTensor
+            [b]
+        indices : LongTensor
+            [b, n], padded with PAD_IDX
+        lens : LongTensor
+            [b]
+        """
+        if self.error_tol > 0:
+            is_correct = edit_distance(indices_hat, hat_lens, indices, lens) <= (
+                self.error_tol
+            )
+        else:
+            l = max(indices_hat.size(1), indices.size(1))
+            indices_hat = F.pad(
+                indices_hat, (0, l - indices_hat.size(1)), value=vocab.PAD_IDX
+            )
+            indices = F.pad(indices, (0, l - indices.size(1)), value=vocab.PAD_IDX)
+            # padding in both is PAD_IDX, so equal rows need only equal lengths
+            is_correct = (hat_lens == lens) & (indices_hat == indices).all(dim=1)
 
-            self.total_line += 1
+        self.rec += is_correct.sum()
+        self.total_line += is_correct.numel()
 
     def compute(self) -> float:
         exp_rate = self.rec / self.total_line
@@ -85,89 +118,93 @@ def ce_loss(
     return loss
 
 
+def flip_padded(indices: LongTensor, lens: LongTensor) -> LongTensor:
+    """reverse each row within its length, padding stays at the end
+
+    Parameters
+    ----------
+    indices : LongTensor
+        [b, l], padded with PAD_IDX
+    lens : LongTensor
+        [b]
+
+    Returns
+    -------
+    LongTensor
+        [b, l]
+    """
+    pos = torch.arange(indices.size(1), device=indices.device)[None, :]
+    lens = lens[:, None]
+    flipped = indices.gather(1, (lens - 1 - pos).clamp(min=0))
+    return flipped.masked_fill(pos >= lens, vocab.PAD_IDX)
+
+
 def to_tgt_output(
-    tokens: Union[List[List[int]], List[LongTensor]],
+    indices: LongTensor,
+    lens: LongTensor,
     direction: str,
-    device: torch.device,
     pad_to_len: Optional[int] = None,
 ) -> Tuple[LongTensor, LongTensor]:
     """Generate tgt and out for indices
 
     Parameters
     ----------
-    tokens : Union[List[List[int]], List[LongTensor]]
-        indices: [b, l]
+    indices : LongTensor
+        [b, l], padded with PAD_IDX
+    lens : LongTensor
+        [b]
     direction : str
-        one of "l2f" and "r2l"
-    device : torch.device
+        one of "l2r" and "r2l"
+    pad_to_len : Optional[int], optional
+        min length of tgt and out, by default None
 
     Returns
     -------
-    Tuple[torch.Tensor, torch.Tensor]
-        tgt, out: [b, l], [b, l]
+    Tuple[LongTensor, LongTensor]
+        tgt, out: [b, l + 1], [b, l + 1]
     """
     assert direction in {"l2r", "r2l"}
 
-    if isinstance(tokens[0], list):
-        tokens = [torch.tensor(t, dtype=torch.long) for t in tokens]
-
     if direction == "l2r":
-        tokens = tokens
         start_w = vocab.SOS_IDX
         stop_w = vocab.EOS_IDX
     else:
-        tokens = [torch.flip(t, dims=[0]) for t in tokens]
+        indices = flip_padded(indices, lens)
         start_w = vocab.EOS_IDX
         stop_w = vocab.SOS_IDX
 
-    batch_size = len(tokens)
-    lens = [len(t) for t in tokens]
-
-    length = max(lens) + 1
+    length = indices.size(1) + 1
     if pad_to_len is not None:
         length = max(length, pad_to_len)
 
-    tgt = torch.full(
-        (batch_size, length),
-        fill_value=vocab.PAD_IDX,
-        dtype=torch.long,
-        device=device,
-    )
-    out = torch.full(
-        (batch_size, length),
-        fill_value=vocab.PAD_IDX,
-        dtype=torch.long,
-        device=device,
-    )
-
-    for i, token in enumerate(tokens):
-        tgt[i, 0] = start_w
-        tgt[i, 1 : (1 + lens[i])] = token
-
-        out[i, : lens[i]] = token
-        out[i, lens[i]] = stop_w
+    tokens = F.pad(indices, (0, length - indices.size(1)), value=vocab.PAD_IDX)
+    pos = torch.arange(length, device=indices.device)[None, :]
+
+    out = tokens.masked_fill(pos == lens[:, None], stop_w)
+    tgt = torch.cat((torch.full_like(tokens[:, :1], start_w), tokens[:, :-1]), dim=1)
 
     return tgt, out
 
 
 def to_bi_tgt_out(
-    tokens: List[List[int]], device: torch.device
+    indices: LongTensor, lens: LongTensor
 ) -> Tuple[LongTensor, LongTensor]:
     """Generate bidirection tgt and out
 
     Parameters
     ----------
-    tokens : List[List[int]]
-        indices: [b, l]
-    device : torch.device
+    indices : LongTensor
+        [b, l], padded with PAD_IDX
+    lens : LongTensor
+        [b]
 
     Returns
     -------
     Tuple[LongTensor, LongTensor]
-        tgt, out: [2b, l], [2b, l]
+        tgt, out: [2b, l + 1], [2b, l + 1]
     """
-    l2r_tgt, l2r_out = to_tgt_output(tokens, "l2r", device)
-    r2l_tgt, r2l_out = to_tgt_output(tokens, "r2l", device)
+    l2r_tgt, l2r_out = to_tgt_output(indices, lens, "l2r")
+    r2l_tgt, r2l_out = to_tgt_output(indices, lens, "r2l")
 
     tgt = torch.cat((l2r_tgt, r2l_tgt), dim=0)
     out = torch.cat((l2r_out, r2l_out), dim=0)
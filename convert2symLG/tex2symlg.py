@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""
+Convert tokenized LaTeX (the CoMER vocab) to symbol level LG in process,
+without pandoc, BeautifulSoup or perl.
+
+Produces the same objects, relations and node tags as the tex2symlg pipeline:
+  pandoc --mathml      -> parse_latex (tokens to the MathML tree of texmath)
+  process_mml.py       -> symbols and xml:id of each MathML node
+  mml2lg.pl -s         -> normalize and seg_srt (CROHME normalization and SRT)
+  update_nodeTags.py   -> node_tags (absolute path of each symbol)
+Latex that pandoc does not parse as math gets no .lg file, as in tex2symlg.
+"""
+
+import os
+import sys
+import zipfile
+
+# symLG label of each token, ie: pandoc's MathML text after normalizeSymbol
+SYMBOLS = {
+    "-": "-",
+    "<": "\\lt",
+    ">": "\\gt",
+    ",": "COMMA",
+    "\\Delta": "\\Delta",
+    "\\Pi": "Π",
+    "\\alpha": "\\alpha",
+    "\\beta": "\\beta",
+    "\\cdot": "⋅",
+    "\\cdots": "⋯",
+    "\\div": "\\div",
+    "\\exists": "\\exists",
+    "\\forall": "\\forall",
+    "\\gamma": "\\gamma",
+    "\\geq": "\\geq",
+    "\\in": "\\in",
+    "\\infty": "\\infty",
+    "\\int": "\\int",
+    "\\lambda": "\\lambda",
+    "\\ldots": "\\ldots",
+    "\\leq": "\\leq",
+    "\\mu": "\\mu",
+    "\\neq": "\\neq",
+    "\\phi": "\\phi",
+    "\\pi": "\\pi",
+    "\\pm": "\\pm",
+    "\\prime": "\\prime",
+    "\\rightarrow": "\\rightarrow",
+    "\\sigma": "\\sigma",
+    "\\sum": "\\sum",
+    "\\theta": "\\theta",
+    "\\times": "\\times",
+    "\\{": "\\{",
+    "\\}": "\\}",
+    "\\sqrt": "√",  # \sqrt without radicand
+}
+# operator names, followed by U+2061 (function application) in MathML
+OPERATORS = {
+    "\\sin": "\\sin",
+    "\\cos": "\\cos",
+    "\\tan": "\\tan",
+    "\\log": "\\log",
+    "\\lim": "\\lim",
+}
+FUNCTION_APPLICATION = "⁡"
+
+# edges of each MathML tag and the child holding them, as in mml2lg.pl
+TAG_TO_SRT = {
+    "mover": [(0, 1, "Above")],
+    "mrow": [(0, 1, "Right")],
+    "msup": [(0, 1, "Sup")],
+    "msub": [(0, 1, "Sub")],
+    "mfrac": [(-1, 0, "Above"), (-1, 1, "Below")],
+    "msqrt": [(-1, 0, "Inside"), (-1, 1, "Inside"), (0, 1, "Right")],
+    "mroot": [(-1, 0, "Inside"), (-1, 1, "Above")],
+    "munder": [(0, 1, "Below")],
+    "munderover": [(0, 1, "Below"), (0, 2, "Above")],
+    "msubsup": [(0, 1, "Sub"), (0, 2, "Sup")],
+}
+TAG_MAIN_SYMB = {
+    "mrow": 1,
+    "msup": 0,
+    "msub": 0,
+    "mfrac": -1,
+    "msqrt": -1,
+    "mroot": -1,
+    "munder": 0,
+    "mover": 0,
+    "munderover": 0,
+    "msubsup": 0,
+    "mo": -1,
+    "mi": -1,
+    "mn": -1,
+}
+REL_TAGS = {"Right": "R"}
+
+
+class Node:
+    """MathML node, label is set for symbols (mi/mo/mn)"""
+
+    def __init__(self, tag, sub=None, label=None, operator=False):
+        self.tag = tag
+        self.sub = sub if sub is not None else []
+        self.label = label
+        self.operator = operator
+        self.id = None
+        self.children = []
+        self.main = None
+
+
+class ParseError(ValueError):
+    pass
+
+
+def _apply_function(nodes):
+    # operator names followed by a sibling get U+2061 in mrow and scripts
+    return [
+        (
+            Node("mrow", [n, Node("mo", label=FUNCTION_APPLICATION)])
+            if n.operator and i < len(nodes) - 1
+            else n
+        )
+        for i, n in enumerate(nodes)
+    ]
+
+
+def _row(nodes):
+    if len(nodes) == 1:
+        return nodes[0]
+    return Node("mrow", _apply_function(nodes))
+
+
+class _Parser:
+    """recursive descent over tokens, following the TeX reader of texmath"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return None
+
+    def take(self):
+        tok = self.peek()
+        if tok is None:
+            raise ParseError("unexpected end")
+        self.pos += 1
+        return tok
+
+    def many_expr(self, stop=None):
+        nodes = []
+        while self.peek() is not None and self.peek() != stop:
+            nodes.append(self.expr())
+        return nodes
+
+    def group(self):
+        # '{' already taken
+        nodes = self.many_expr("}")
+        if self.peek() != "}":
+            raise ParseError("unbalanced {")
+        self.pos += 1
+        return _row(nodes)
+
+    def leaf(self, tok):
+        if tok in OPERATORS:
+            return Node("mi", label=OPERATORS[tok], operator=True)
+        if tok in SYMBOLS:
+            return Node("mi", label=SYMBOLS[tok])
+        if len(tok) == 1 and tok not in "{}^_&#$%~\\":
+            return Node("mi", label=tok)
+        raise ParseError(f"unknown token {tok}")
+
+    def tex_token(self):
+        tok = self.take()
+        if tok == "{":
+            return self.group()
+        if tok in ("\\frac", "\\limits", "\\{", "}"):
+            raise ParseError(f"{tok} is not a token")
+        if tok in ("^", "_"):
+            # read as a char, eg: \sqrt ^ b
+            return Node("mi", label=tok)
+        return self.leaf(tok)
+
+    def try_parse(self, parse):
+        pos = self.pos
+        try:
+            return parse()
+        except ParseError:
+            self.pos = pos
+            return None
+
+    def expr1(self):
+        tok = self.peek()
+        if tok is None:
+            raise ParseError("unexpected end")
+        if tok in ("^", "_"):
+            # script without base
+            node = Node("mi", label="")
+            node = self.sub_sup(None, node) or self.super_or_subscripted(None, node)
+            if node is None:
+                raise ParseError(f"nothing after {tok}")
+            return node
+        self.pos += 1
+        if tok == "{":
+            return self.group()
+        if tok == "\\frac":
+            num = self.tex_token()
+            return Node("mfrac", [num, self.tex_token()])
+        if tok == "\\sqrt":
+            if self.peek() == "[":
+                # no backtracking once the index is opened
+                return self.sqrt()
+            root = self.try_parse(self.sqrt)
+            if root is not None:
+                return root
+        if tok in ("}", "\\limits"):
+            raise ParseError(f"unexpected {tok}")
+        return self.leaf(tok)
+
+    def sqrt(self):
+        if self.peek() == "[":
+            self.pos += 1
+            index = self.many_expr("]")
+            if self.take() != "]":
+                raise ParseError("unbalanced [")
+            return Node("mroot", [self.tex_token(), _row(index)])
+        return Node("msqrt", [self.tex_token()])
+
+    def expr(self):
+        node = self.expr1()
+        limits = None
+        if self.peek() == "\\limits":
+            self.pos += 1
+            limits = True
+        return (
+            self.sub_sup(limits, node)
+            or self.super_or_subscripted(limits, node)
+            or node
+        )
+
+    def script(self, symbol, parse):
+        if self.peek() != symbol:
+            raise ParseError(f"expect {symbol}")
+        self.pos += 1
+        return parse()
+
+    def sub_sup(self, limits, base):
+        def sub_first():
+            sub = self.script("_", self.expr1)
+            return sub, self.script("^", self.expr1)
+
+        def sup_first():
+            sup = self.script("^", self.expr1)
+            return self.script("_", self.expr1), sup
+
+        scripts = self.try_parse(sub_first) or self.try_parse(sup_first)
+        if scripts is None:
+            return None
+        if limits:
+            return Node("munderover", [base, *scripts])
+        return Node("msubsup", _apply_function([base, *scripts]))
+
+    def super_or_subscripted(self, limits, base):
+        tok = self.peek()
+        if tok not in ("^", "_"):
+            return None
+        pos = self.pos
+        self.pos += 1
+        script = self.try_parse(self.expr)
+        if script is None:
+            self.pos = pos
+            return None
+        if limits:
+            return Node("mover" if tok == "^" else "munder", [base, script])
+        return Node("msup" if tok == "^" else "msub", _apply_function([base, script]))
+
+
+def parse_latex(tokens):
+    """MathML tree of tokenized latex, as pandoc --mathml renders it inline
+
+    Parameters
+    ----------
+    tokens : List[str]
+        eg: ['\\frac', '{', 'a', '}', '{', 'b', '}']
+
+    Returns
+    -------
+    Node
+        root of the tree, None when pandoc would not render it as math
+    """
+    if len(tokens) == 0:
+        return None
+    parser = _Parser(tokens)
+    try:
+        nodes = parser.many_expr()
+    except ParseError:
+        return None
+    if parser.peek() is not None:
+        return None
+    return _row(nodes)
+
+
+def symbols(root):
+    """set xml:id of MathML nodes as process_mml.py does, returning the
+    symbols (id, label) in the order of traceGroups"""
+    leaves, fracs, roots = [], [], []
+    # ids count nodes in document order, 0 being the <semantics> tag
+    stack = [root]
+    count = 1
+    while stack:
+        node = stack.pop()
+        if node.label is not None:
+            node.id = f"{node.label}_{count}".replace(",", "COMMA", 1)
+            leaves.append(node)
+        elif node.tag == "mfrac":
+            node.id = f"_{count}"
+            fracs.append(node)
+        elif node.tag in ("msqrt", "mroot"):
+            node.id = f"_{count}"
+            roots.append(node)
+        stack.extend(reversed(node.sub))
+        count += 1
+    return (
+        [(n.id, n.label) for n in leaves]
+        + [(n.id, "-") for n in fracs]
+        + [(n.id, "\\sqrt") for n in roots]
+    )
+
+
+def _flatten_first(node):
+    # replace the first child (an mrow) by its children
+    node.sub[:] = node.sub[0].sub + node.sub[1:]
+
+
+def _split_rest(node):
+    # keep the first child, move the others into a new mrow
+    node.sub[:] = [node.sub[0], Node("mrow", node.sub[1:])]
+
+
+def normalize(current):
+    """CROHME normalization of mml2lg.pl (norm_mathMLNorm): binary right
+    recursive mrow, msub/msup attached to the last symbol of an mrow base.
+    Returns True when the parent needs another pass."""
+    redo_father = False
+    redo_from_child = True
+    while redo_from_child:
+        redo_from_child = False
+        for exp in current:
+            redo = True
+            while redo:
+                redo = False
+                nb = len(exp.sub)
+                if exp.tag == "math":
+                    if nb > 1:
+                        exp.sub[:] = [Node("mrow", list(exp.sub))]
+                        redo = True
+                elif exp.tag == "mrow":
+                    if nb > 2:
+                        _split_rest(exp)
+                        redo = True
+                    elif nb == 1:
+                        child = exp.sub[0]
+                        exp.tag, exp.id, exp.label = child.tag, child.id, child.label
+                        exp.sub = child.sub
+                        redo = True
+                    elif nb == 2 and exp.sub[0].tag == "mrow":
+                        _flatten_first(exp)
+                        redo = True
+                elif exp.tag == "msqrt":
+                    if nb > 2:
+                        _split_rest(exp)
+                        redo = True
+                    elif nb in (1, 2) and exp.sub[0].tag == "mrow":
+                        _flatten_first(exp)
+                        redo = True
+                elif exp.tag in ("msub", "msup"):
+                    if nb == 2 and exp.sub[0].tag == "mrow" and exp.sub[0].sub:
+                        base = exp.sub[0].sub
+                        script = Node(exp.tag, [base[-1], exp.sub[1]])
+                        script.id = exp.id
+                        exp.tag, exp.id = "mrow", None
+                        exp.sub = base
+                        base[-1] = script
+                        redo = True
+                        redo_father = True
+            if not redo_father:
+                redo_from_child |= normalize(exp.sub)
+    return redo_father
+
+
+def seg_srt(current, srt):
+    """relations between symbols of mml2lg.pl (getSegSRT), keyed by
+    '[id1],[id2]'. Returns ids of all symbols under current, in preorder."""
+    children = []
+    for exp in current:
+        exp.children = seg_srt(exp.sub, srt)
+        if exp.id is not None:
+            children.append(exp.id)
+        children.extend(exp.children)
+
+        k = TAG_MAIN_SYMB.get(exp.tag)
+        if k == -1:
+            exp.main = exp.id
+        elif k is not None:
+            exp.main = exp.sub[k].main if k < len(exp.sub) else None
+
+        for src, dst, rel in TAG_TO_SRT.get(exp.tag, []):
+            if src == -1:
+                id1 = exp.main
+            else:
+                id1 = exp.sub[src].main if src < len(exp.sub) else None
+            if dst < len(exp.sub):
+                target = exp.sub[dst]
+                id2 = (
+                    target.id
+                    if target.id is not None
+                    else (target.children[0] if target.children else None)
+                )
+                if id2 is not None:
+                    srt[f'[{id1 or ""}],[{id2}]'] = (id1, id2, rel)
+    return children
+
+
+def node_tags(objects, relations):
+    """absolute path of each symbol from the root, as update_nodeTags.py"""
+    parents = {}
+    for parent, child, rel in relations:
+        if child not in parents or parents[child][1] == "Inside":
+            parents[child] = parent, rel
+    tags = {}
+    for obj in objects:
+        path = ""
+        key = obj
+        visited = set()
+        while key in parents and key not in visited:
+            visited.add(key)
+            key, rel = parents[key]
+            path = REL_TAGS.get(rel, rel) + path
+        tags[obj] = "O" + path
+    return tags
+
+
+def latex2symlg(tokens, ui):
+    """symLG of tokenized latex
+
+    Parameters
+    ----------
+    tokens : List[str]
+        latex tokens, eg: a CoMER prediction split by spaces
+    ui : str
+        name written in the '# IUD' line
+
+    Returns
+    -------
+    str
+        content of the .lg file, None when tex2symlg would not write one
+    """
+    root = parse_latex(tokens)
+    if root is None:
+        return None
+    objects = symbols(root)
+    normalize([Node("math", [root])])
+    srt = {}
+    seg_srt([root], srt)
+    relations = [srt[key] for key in sorted(srt) if srt[key][0]]
+    tags = node_tags([obj_id for obj_id, _ in objects], relations)
+
+    lines = ["# IUD, " + ui, "# Objects(%d):" % len(objects)]
+    for obj_id, label in objects:
+        lines.append(
+            "O, %s, %s, 1.0, %s"
+            % (obj_id, label.replace(",", "COMMA", 1), tags[obj_id])
+        )
+    lines.append("")
+    lines.append("# Relations from SRT:")
+    for id1, id2, rel in relations:
+        lines.append("R, %s, %s, %s, 1.0" % (id1, id2, rel))
+    return "\n".join(lines) + "\n"
+
+
+def read_prediction(text):
+    """latex tokens of a CoMER result file: '%img_base' then '$latex$'"""
+    lines = [l for l in text.splitlines() if not l.startswith("%")]
+    latex = " ".join(lines).strip()
+    if len(latex) > 1 and latex.startswith("$") and latex.endswith("$"):
+        latex = latex[1:-1]
+    return latex.split()
+
+
+def convert(inputs, outdir):
+    """write the .lg file of each (name, text) of inputs to outdir,
+    returning the number of files written"""
+    os.makedirs(outdir, exist_ok=True)
+    written = 0
+    for name, text in inputs:
+        ui = os.path.splitext(os.path.basename(name))[0]
+        lg = latex2symlg(read_prediction(text), ui)
+        if lg is None:
+            print("math not parsed for:", name)
+            continue
+        with open(os.path.join(outdir, ui + ".lg"), "w") as f:
+            f.write(lg)
+        written += 1
+    return written
+
+
+def read_inputs(path):
+    """(name, text) of the .txt files in a folder or in a result.zip"""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                if name.endswith(".txt"):
+                    yield name, archive.read(name).decode()
+    else:
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".txt"):
+                with open(os.path.join(path, name)) as f:
+                    yield name, f.read()
+
+
+if __name__ == "__main__":
+    """
+    Usage: tex2symlg.py texdir outdir
+           tex2symlg.py result.zip outdir
+    """
+    if len(sys.argv) < 3:
+        print("usage: tex2symlg.py texdir outdir")
+        print("       tex2symlg.py result.zip outdir")
+        exit()
+
+    n = convert(read_inputs(sys.argv[1]), sys.argv[2])
+    print("*** converted %d files *******" % n)
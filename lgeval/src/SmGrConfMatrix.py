@@ -13,35 +13,51 @@ from operator import itemgetter
 GRAPH_SIZE=100
 
 class SmDict(object):
-	"""This is not a real dictionnary but it is like a dictionnary using only 
-	the == operator (without hash) 
+	"""This is like a dictionnary using smallGraphs as keys, and the
+	isomorphism to know if 2 smallGraphs are the same. Keys are indexed
+	by their canonical form (SmallGraph.canonicalKey()); when the label
+	metrics do not provide one, keys are found by scanning with ==.
 	A value can be associate to a smallGraph. 
 	For efficiency, use an object as a value to avoid call to set()
-	It uses the isomorphism to know if 2 smallGraphs are the same."""
+	The items keep their insertion order in myitems."""
 	
 	def __init__(self,*args):
 		self.myitems = []
+		self.index = {}
 	
-	def set(self, sg, value):
+	def find(self, sg):
+		"""return the position of the key isomorphic to sg in myitems, -1 if none"""
+		key = sg.canonicalKey()
+		if key is not None:
+			return self.index.get(key, -1)
 		for i in range(len(self.myitems)):
 			if(sg == self.myitems[i][0]):
-				self.myitems[i][1] = value
-				return
+				return i
+		return -1
+	
+	def add(self, sg, value):
+		key = sg.canonicalKey()
+		if key is not None:
+			self.index[key] = len(self.myitems)
 		self.myitems.append((sg,value))
+	
+	def set(self, sg, value):
+		i = self.find(sg)
+		if i >= 0:
+			self.myitems[i] = (self.myitems[i][0], value)
+		else:
+			self.add(sg, value)
 		
 	def get(self, sg, defaultType = object):
 		"""find the corresponding key and if not found add it with the default value"""
-		for i in range(len(self.myitems)):
-			if(sg == self.myitems[i][0]):
-				return self.myitems[i][1]
-		self.myitems.append((sg, defaultType()))
-		return self.myitems[-1][1]
+		i = self.find(sg)
+		if i < 0:
+			self.add(sg, defaultType())
+			i = len(self.myitems) - 1
+		return self.myitems[i][1]
 		
 	def __contains__(self,sg):
-		for i in range(len(self.myitems)):
-			if(sg == self.myitems[i][0]):
-				return True
-		return False
+		return self.find(sg) >= 0
 
 	def getIter(self):
 		for p in self.myitems:
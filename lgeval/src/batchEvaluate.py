@@ -0,0 +1,312 @@
+################################################################
+# batchEvaluate.py
+#
+# Python driver for the evaluate script. Each output/ground truth
+# pair is read and compared once (metrics and differences from a
+# single Lg.compare call), pairs are compared in a process pool, and
+# pairs whose input files are unchanged since the last run are not
+# compared again. Metric summaries and confusion matrices are
+# accumulated in memory and written at the end. A pair whose files
+# can not be read or compared is reported and counted as an error, and
+# the other pairs are evaluated as usual.
+#
+# Writes the same Results_<name>/ directory as evaluate did.
+################################################################
+import argparse
+import csv
+import glob
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import traceback
+from multiprocessing import Pool
+
+from lg import *
+from lgio import *
+import compareTools
+from sumMetric import MetricSummary, writeSummary
+from sumDiff import ConfusionMatrices, readLabels as readLabelFile
+
+CACHE_FILE = 'evalCache.json'
+
+def useIntersectMetric():
+	"""Same as the INTER option of evallg.py, must be set before reading graphs."""
+	compareTools.cmpNodes = compareTools.intersectMetric
+	compareTools.cmpEdges = compareTools.intersectMetric
+
+def graphLabels(lg):
+	"""Node and edge labels used in a graph, as compileLabels.py collects them."""
+	nodeLabels = set()
+	edgeLabels = set()
+	for node in lg.nlabels:
+		nodeLabels.update(lg.nlabels[node])
+	for edge in lg.elabels:
+		edgeLabels.update(lg.elabels[edge])
+	return (sorted(nodeLabels), sorted(edgeLabels))
+
+def comparePair(pair):
+	"""Compare an output graph with its ground truth, returning the lines
+	'evallg.py out gt m INTER' and 'evallg.py out gt diff INTER' print,
+	the labels of both graphs and None. If reading or comparing the graphs
+	raises, metrics and diff are empty (as evallg.py printed nothing) and
+	the traceback is returned last."""
+	(outFile, gtFile) = pair
+	labels = (([], []), ([], []))
+	try:
+		lg1 = Lg(outFile)
+		lg2 = Lg(gtFile)
+		labels = (graphLabels(lg1), graphLabels(lg2))
+
+		lg1.labelMissingEdges()
+		lg2.labelMissingEdges()
+		out = lg1.compare(lg2)
+
+		metricStream = io.StringIO()
+		writeMetrics(out, metricStream)
+		diffStream = io.StringIO()
+		writeDiff(out[1], out[3], out[2], diffStream)
+	except Exception:
+		return ('', '', labels, traceback.format_exc())
+	diff = diffStream.getvalue().rstrip('\n')
+	if diff != '':
+		diff += '\n'
+	return (metricStream.getvalue(), diff, labels, None)
+
+def readLabels(fileName):
+	"""Labels of a graph that is not compared, e.g. an output without ground truth."""
+	return graphLabels(Lg(fileName))
+
+def fileStamp(fileName, cached=None):
+	"""(mtime, size, sha1) of a file, the hash is only computed again when
+	mtime or size differ from the cached stamp."""
+	if not os.path.exists(fileName):
+		return None
+	stat = os.stat(fileName)
+	if cached is not None and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+		return cached
+	with open(fileName, 'rb') as f:
+		digest = hashlib.sha1(f.read()).hexdigest()
+	return [stat.st_mtime_ns, stat.st_size, digest]
+
+def sameStamp(stamp, cached):
+	if stamp is None or cached is None:
+		return stamp == cached
+	return stamp[1:] == cached[1:]
+
+def writeLabels(fileName, nodeLabels, edgeLabels):
+	"""Same output as compileLabels.py."""
+	outString = "NODE LABELS:"
+	for label in sorted(nodeLabels):
+		outString += "\n" + label
+	outString += "\n\nEDGE LABELS:"
+	for label in sorted(edgeLabels):
+		outString += "\n" + label
+	with open(fileName, 'w') as f:
+		f.write(outString + '\n')
+
+def writeFileMetrics(fileName, fileRows):
+	"""Pair file names and results with metric values, header row from metric
+	names. Files that could not be compared have no metric row (None)."""
+	header = next(row for (_, row) in fileRows if row is not None)
+	with open(fileName, 'w') as f:
+		f.write('File,Result,' + ','.join(header[0::2]) + '\n')
+		for (result, row) in fileRows:
+			if row is None:
+				f.write(result + '\n')
+			else:
+				f.write(result + ',' + ','.join(row[1::2]) + '\n')
+
+def main():
+	parser = argparse.ArgumentParser(
+		description='Evaluates all label graph (.lg) files in outputDir against '
+		'corresponding files in groundTruthDir, or file pairs listed in fileList.')
+	parser.add_argument('inputs', nargs='+',
+		help='outputDir groundTruthDir [p/t/d/s/b] OR fileList [p/t/d/s/b]')
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+		help='number of processes comparing graphs')
+	args = parser.parse_args()
+
+	inputs = args.inputs
+	bName = os.path.basename(os.path.normpath(inputs[0]))
+	dotArg = ''
+	if not os.path.isdir(inputs[0]):
+		labelString = 'List File: ' + inputs[0]
+		with open(inputs[0]) as f:
+			rows = [ line.split() for line in f if line.strip() ]
+		outputs = [ row[0] for row in rows ]
+		targets = [ row[1] for row in rows ]
+		pairs = list(zip(outputs, targets))
+		if len(inputs) > 1:
+			dotArg = inputs[1]
+	else:
+		labelString = 'Output File Directory:  ' + inputs[0] + '\n' \
+				+ 'Ground Truth Directory: ' + inputs[1]
+		outputs = sorted(glob.glob(os.path.join(inputs[0], '*.lg')))
+		targets = sorted(glob.glob(os.path.join(inputs[1], '*.lg')))
+		pairs = []
+		for target in targets:
+			fName = os.path.splitext(os.path.basename(target))[0]
+			pairs.append(((inputs[0] + '/' + fName + '.lg').replace('//', '/'), target))
+		if len(inputs) > 2:
+			dotArg = inputs[2]
+	print(labelString)
+	print('')
+
+	resultsDir = 'Results_' + bName
+	metricsDir = os.path.join(resultsDir, 'Metrics')
+	os.makedirs(metricsDir, exist_ok=True)
+	if dotArg != '':
+		os.makedirs(os.path.join(resultsDir, 'errorGraphs', 'dot'), exist_ok=True)
+		os.makedirs(os.path.join(resultsDir, 'errorGraphs', 'pdf'), exist_ok=True)
+
+	cacheFile = os.path.join(resultsDir, CACHE_FILE)
+	cache = {}
+	if os.path.exists(cacheFile):
+		with open(cacheFile) as f:
+			cache = json.load(f)
+
+	print('Evaluating files...')
+	useIntersectMetric()
+
+	# Find pairs to compare, the others are taken from the cache.
+	fNames = []
+	stamps = []
+	todo = []
+	# Metrics and differences of pairs compared in this run.
+	computed = {}
+	for (outFile, gtFile) in pairs:
+		fName = os.path.splitext(os.path.basename(gtFile))[0]
+		entry = cache.get(fName)
+		cached = entry if entry is not None and entry['pair'] == [outFile, gtFile] else None
+		stamp = (fileStamp(outFile, cached and cached['out']),
+				fileStamp(gtFile, cached and cached['gt']))
+		fNames.append(fName)
+		stamps.append(stamp)
+		if cached is not None \
+				and sameStamp(stamp[0], cached['out']) \
+				and sameStamp(stamp[1], cached['gt']) \
+				and os.path.exists(os.path.join(metricsDir, fName + '.csv')):
+			print('    Already processed: ' + gtFile)
+		else:
+			todo.append(len(fNames) - 1)
+
+	with Pool(max(1, args.jobs)) as pool:
+		results = pool.imap(comparePair, [ pairs[i] for i in todo ], chunksize=4)
+		for (i, (metrics, diff, labels, error)) in zip(todo, results):
+			(outFile, gtFile) = pairs[i]
+			fName = fNames[i]
+			print('  >> Comparing ' + fName + '.lg')
+			if error is not None:
+				sys.stderr.write('  !! Error comparing ' + outFile + ' and ' + gtFile \
+						+ ':\n' + error)
+			computed[fName] = (metrics, diff)
+			with open(os.path.join(metricsDir, fName + '.csv'), 'w') as f:
+				f.write(metrics)
+			diffFile = os.path.join(metricsDir, fName + '.diff')
+			if diff != '':
+				with open(diffFile, 'w') as f:
+					f.write(diff)
+				if dotArg != '':
+					dotCmd = [ 'lg2dot', outFile, gtFile ]
+					if dotArg != 'p':
+						dotCmd.append(dotArg)
+					subprocess.run(dotCmd)
+					os.replace(fName + '.dot',
+						os.path.join(resultsDir, 'errorGraphs', 'dot', fName + '.dot'))
+					os.replace(fName + '.pdf',
+						os.path.join(resultsDir, 'errorGraphs', 'pdf', fName + '.pdf'))
+			elif os.path.exists(diffFile):
+				os.remove(diffFile)
+
+			cache[fName] = {
+				'pair': [outFile, gtFile],
+				'out': stamps[i][0],
+				'gt': stamps[i][1],
+				'correct': diff == '' and error is None,
+				'error': error is not None,
+				'labels': labels,
+			}
+			# Keep progress, so that an interrupted run can be resumed.
+			if len(cache) % 100 == 0:
+				with open(cacheFile, 'w') as f:
+					json.dump(cache, f)
+
+		# Labels of outputs that have no ground truth, as compileLabels.py
+		# reads all outputs.
+		pairOutputs = set(outFile for (outFile, _) in pairs)
+		extraOutputs = [ o for o in outputs if o.replace('//', '/') not in pairOutputs ]
+		extraLabels = pool.map(readLabels, extraOutputs)
+
+	with open(cacheFile, 'w') as f:
+		json.dump(cache, f)
+
+	# Compile labels from ground truth and outputs.
+	nodeLabels = (set(), set())
+	edgeLabels = (set(), set())
+	for fName in fNames:
+		for (k, (nLabels, eLabels)) in enumerate(cache[fName]['labels']):
+			nodeLabels[k].update(nLabels)
+			edgeLabels[k].update(eLabels)
+	for (nLabels, eLabels) in extraLabels:
+		nodeLabels[0].update(nLabels)
+		edgeLabels[0].update(eLabels)
+	writeLabels(os.path.join(resultsDir, 'labelsGT.txt'), nodeLabels[1], edgeLabels[1])
+	writeLabels(os.path.join(resultsDir, 'labelsOutput.txt'), nodeLabels[0], edgeLabels[0])
+
+	# Accumulate metric summaries and confusion matrices over all files,
+	# files are only read for pairs taken from the cache.
+	fileRows = []
+	summary = MetricSummary()
+	confusions = ConfusionMatrices(os.path.join(resultsDir, bName + '.diff'))
+	hasErrors = False
+	failed = []
+	for ((outFile, _), fName) in zip(pairs, fNames):
+		entry = cache[fName]
+		if fName in computed:
+			(metrics, diff) = computed[fName]
+		else:
+			with open(os.path.join(metricsDir, fName + '.csv')) as f:
+				metrics = f.read()
+			diff = ''
+			if not entry['correct'] and not entry.get('error', False):
+				with open(os.path.join(metricsDir, fName + '.diff')) as f:
+					diff = f.read()
+		if entry.get('error', False):
+			failed.append(outFile)
+			fileRows.append((outFile + ', Error', None))
+		else:
+			result = 'Correct' if entry['correct'] else 'Incorrect'
+			for row in csv.reader(metrics.splitlines()):
+				fileRows.append((outFile + ', ' + result, row))
+				summary.addRow(row)
+		if not entry['correct']:
+			hasErrors = True
+			for row in csv.reader(diff.splitlines()):
+				confusions.addRow(row)
+	if not hasErrors:
+		open(os.path.join(resultsDir, '00_NoErrors'), 'w').close()
+
+	with open(os.path.join(resultsDir, 'Summary.txt'), 'w') as f:
+		if summary.nbEM > 0:
+			writeSummary(summary, labelString, stream=f)
+	(gtNodeLabels, _) = readLabelFile(os.path.join(resultsDir, 'labelsGT.txt'))
+	with open(os.path.join(resultsDir, 'ConfusionMatrices.html'), 'w') as f:
+		confusions.write(f, gtNodeLabels, withHTML=True)
+	with open(os.path.join(resultsDir, 'ConfusionMatrices.csv'), 'w') as f:
+		confusions.write(f, gtNodeLabels)
+
+	# Spreadsheet pairing file names with metrics.
+	if summary.nbEM > 0:
+		writeFileMetrics(os.path.join(resultsDir, 'FileMetrics.csv'), fileRows)
+
+	if len(failed) > 0:
+		print(str(len(failed)) + ' file(s) could not be compared, see Error in FileMetrics.csv:')
+		for outFile in failed:
+			print('    ' + outFile)
+	print('done.')
+
+if __name__ == '__main__':
+	main()
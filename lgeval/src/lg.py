@@ -100,15 +100,17 @@ class Lg(object):
 			MIN_OBJECT_ENTRY_LENGTH = 5
 			MIN_OBJECT_EDGE_ENTRY_LENGTH = 5
 			try:
-				fileReader = csv.reader(open(fileName))
+				lgFile = open(fileName)
 			except:
 				# Create an empty graph if a file cannot be found.
 				# Set the error flag.
 				sys.stderr.write('  !! IO Error (cannot open): ' + fileName + '\n')
 				self.error = True
 				return
+			with lgFile:
+				rows = list(csv.reader(lgFile))
 			objectDict = dict([])
-			for row in fileReader:
+			for row in rows:
 				# Skip blank lines.
 				if len(row) == 0 or len(row) == 1 and row[0].strip() == '':
 					continue
@@ -121,7 +123,7 @@ class Lg(object):
 						self.error = True
 					else:
 						nid = row[1].strip() # remove leading/trailing whitespace
-						if nid in list(self.nlabels):
+						if nid in self.nlabels:
 							nlabelDict = self.nlabels[ nid ]
 							nlabel = row[2].strip()
 							# if nlabel in nlabelDict:
@@ -157,7 +159,7 @@ class Lg(object):
 									self.file + '):\n\t' + str(row) + '\n')
 							self.error = True
 							nid = primPair[0]
-							if nid in list(self.nlabels):
+							if nid in self.nlabels:
 								nlabelDict = self.nlabels[ nid ]
 								nlabel = row[3].strip()
 								# if nlabel in nlabelDict:
@@ -169,7 +171,7 @@ class Lg(object):
 							nlabelDict[ nlabel ] = float(row[4])
 
 						#an edge already existing, add a new label
-						elif primPair in list(self.elabels):
+						elif primPair in self.elabels:
 							elabelDict = self.elabels[ primPair ]
 							elabel = row[3].strip()
 							# if elabel in elabelDict:
@@ -248,7 +250,7 @@ class Lg(object):
 						for n in rawnodeList:
 							nid = n.strip()
 							nodeList.append(nid)
-							if nid in list(self.nlabels):
+							if nid in self.nlabels:
 								nlabelDict = self.nlabels[ nid ]
 								
 								# Add (or replace) entry for the label.
@@ -268,7 +270,7 @@ class Lg(object):
 								if nid1 != nid2:
 									primPair = ( nid1, nid2 )
 									elabel = nlabel 
-									if primPair in list(self.elabels):
+									if primPair in self.elabels:
 										elabelDict = self.elabels[ primPair ]
 										
 										# Add (or replace) entry for the label.
@@ -308,7 +310,7 @@ class Lg(object):
 								for nid2 in nodeList2:
 									if nid1 != nid2:
 										primPair = ( nid1, nid2 )
-										if primPair in list(self.elabels):
+										if primPair in self.elabels:
 											elabelDict = self.elabels[ primPair ]
 											
 											# Add (or replace) entry for the label.
@@ -339,11 +341,11 @@ class Lg(object):
 			nid1 = elabel[0]
 			nid2 = elabel[1]
 
-			if not nid1 in list(self.nlabels):
+			if not nid1 in self.nlabels:
 				self.nlabels[ nid1 ] = { '_' : 1.0 }
 				anodeList = anodeList + [ nid1 ]
 				anonNode = True
-			if not nid2 in list(self.nlabels):
+			if not nid2 in self.nlabels:
 				self.nlabels[ nid2 ] = { '_' : 1.0 }
 				anodeList = anodeList + [ nid2 ]
 				anonNode = True
@@ -518,28 +520,27 @@ class Lg(object):
 		i = 0
 		segmentList = []
 		rootSegments = set([])
+
+		# Index of segments by primitive set, instead of scanning all segments.
+		segmentIndex = {}
 		
 		# For each label associated with each primitive, there is a possible object/segment
 		for primitive,segments in primSets.items():
 			if not primitive in primitiveSegmentMap:
 				primitiveSegmentMap[ primitive ] = {}
 			for lab in list(segments):
-				alreadySegmented = False
-				for j in range(len(segmentList)):
-					if segments[lab] == segmentList[j]["prim"]:
-						if not primitive in primitiveSegmentMap:
-							primitiveSegmentMap[ primitive ] = {}
-						primitiveSegmentMap[ primitive ][lab] = 'Obj' + str(j)
-						alreadySegmented = True
-						if lab not in segmentList[j]["label"]:
-							segmentPrimitiveMap[  'Obj' + str(j) ][1].append(lab)
-							segmentList[j]["label"].add(lab)
-						break
-
-				if not alreadySegmented:
+				primKey = frozenset(segments[lab])
+				if primKey in segmentIndex:
+					j = segmentIndex[ primKey ]
+					primitiveSegmentMap[ primitive ][lab] = 'Obj' + str(j)
+					if lab not in segmentList[j]["label"]:
+						segmentPrimitiveMap[  'Obj' + str(j) ][1].append(lab)
+						segmentList[j]["label"].add(lab)
+				else:
 					# Add the new segment.
 					newSegment = 'Obj' + str(i)
-					segmentList = segmentList + [ {"label":{lab},"prim":primSets[primitive][lab]} ]
+					segmentList.append( {"label":{lab},"prim":primSets[primitive][lab]} )
+					segmentIndex[ primKey ] = i
 					segmentPrimitiveMap[ newSegment ] = (segments[lab],[lab])
 					primitiveSegmentMap[ primitive ][lab] = newSegment
 					rootSegments.add(newSegment)
@@ -633,8 +634,8 @@ class Lg(object):
 					# DEBUG (RZ): this is producing a primitive edge-level count:
 					# do not count segment edges that are undefined (e.g. in one direction,
 					# but not the other)
-					if p != primitive and (p,primitive) in list(self.elabels) and \
-							lab1 in list(self.elabels[ (p,primitive) ]):
+					if p != primitive and (p,primitive) in self.elabels and \
+							lab1 in self.elabels[ (p,primitive) ]:
 						if p in edgeFromP1:
 							edgeFromP1[p].append(lab1)
 						else:  
@@ -643,8 +644,8 @@ class Lg(object):
 			for (lab2,seg2) in ps2[primitive].items():
 				for p in sp2[seg2][0]:
 					# DEBUG (RZ) - see DEBUG comment above.
-					if p != primitive and (p,primitive) in list(lg2.elabels) and \
-							lab2 in list(lg2.elabels[ (p, primitive) ]):
+					if p != primitive and (p,primitive) in lg2.elabels and \
+							lab2 in lg2.elabels[ (p, primitive) ]:
 						if p in edgeFromP2:
 							edgeFromP2[p].append(lab2)
 						else:
@@ -663,7 +664,7 @@ class Lg(object):
 				# RZ June 2015: Record edges that are specifically valid merges with disagreeing labels.
 				#     Also record sets of undirected edges that disagree.
 				for (l1,l2) in diff:
-					if l1 in list(self.nlabels[p]) and l2 in list(lg2.nlabels[p]):
+					if l1 in self.nlabels[p] and l2 in lg2.nlabels[p]:
 						edgeDiffClassCount += 1
 					
 					# RZ: we do not have a *segmentation* difference if corresponding segm.
@@ -721,7 +722,7 @@ class Lg(object):
 				continue
 
 			primitiveTupleList = tuple( sorted( list(sp1[ObjID][ 0 ] )))
-			if primitiveTupleList in list(targets) \
+			if primitiveTupleList in targets \
 					and not primitiveTupleList in matchedTargets:
 				matchedTargets.add( primitiveTupleList )
 				correctSegments.add( ObjID )
@@ -762,16 +763,16 @@ class Lg(object):
 			targetObjNameParent = None
 			targetObjNameChild = None
 
-			if primitiveTupleListParent in list(targetObjIds):
+			if primitiveTupleListParent in targetObjIds:
 				targetObjNameParent = targetObjIds[ primitiveTupleListParent ]
-			if primitiveTupleListChild in list(targetObjIds):
+			if primitiveTupleListChild in targetObjIds:
 				targetObjNameChild = targetObjIds[ primitiveTupleListChild ]
 			
 			# Check whether the objects are correctly segmented by their object identifiers
 			if not ( thisPair[0] in correctSegments and  thisPair[1] in correctSegments):
 				# Avoid counting mis-segmented objects as having valid relationships
 				falsePositive = True
-			elif not ( targetObjNameParent, targetObjNameChild ) in list(sre2):
+			elif not ( targetObjNameParent, targetObjNameChild ) in sre2:
 				# Check that there is an edge between these objects in the target graph.
 				falsePositive = True
 			else:
@@ -891,9 +892,9 @@ class Lg(object):
 				nlabelMismatch = nlabelMismatch + cost
 				# add errors in error list
 				for (l1,l2) in errL:
-					nodeconflicts = nodeconflicts + [ (nid, [ (l1, 1.0) ], [(l2, 1.0)] ) ]
+					nodeconflicts.append( (nid, [ (l1, 1.0) ], [(l2, 1.0)] ) )
 				# add node in error list
-				nodeClassError = nodeClassError.union([nid])
+				nodeClassError.add(nid)
 
 		# Two-sided comparison of *label sets* (look from absent edges in both
 		# graphs!) Must check whether edge exists; '_' represents a "NONE"
@@ -928,7 +929,7 @@ class Lg(object):
 
 		# One-sided comparison for common edges. Compared by cmpEdges
 		for npair in list(self.elabels):
-			if npair in list(lg2.elabels):
+			if npair in lg2.elabels:
 				(cost,errL) = self.cmpEdges(list(self.elabels[npair]),list(lg2.elabels[npair]))
 				if cost > 0:
 					elabelMismatch = elabelMismatch + cost
@@ -1018,13 +1019,13 @@ class Lg(object):
 		nodeChildMap = {}
 		rootNodes = set(list(segmentPrimitiveMap))
 		for (parent, child) in segmentEdges:
-			if not child in list(nodeParentMap):
+			if not child in nodeParentMap:
 				nodeParentMap[ child ] = [ parent ]
 				rootNodes.remove( child )
 			else:
 				nodeParentMap[ child ] += [ parent ]
 
-			if not parent in list(nodeChildMap):
+			if not parent in nodeChildMap:
 				nodeChildMap[ parent ] = [ child ]
 			else:
 				nodeChildMap[ parent ] += [ child ]
@@ -1038,7 +1039,7 @@ class Lg(object):
 			nextNode = fringe.pop(0)
 
 			# Skip leaf nodes.
-			if nextNode in list(nodeChildMap):
+			if nextNode in nodeChildMap:
 				children = copy.deepcopy(nodeChildMap[ nextNode ])
 				
 				for child in children:
@@ -1113,7 +1114,7 @@ class Lg(object):
 		for node1 in list(self.nlabels):
 			for node2 in list(self.nlabels):
 				if not node1 == node2:
-					if not (node1, node2) in list(self.elabels):
+					if not (node1, node2) in self.elabels:
 						self.elabels[(node1, node2)] = {'_' : 1.0 }
 
 	# Returns NONE: modifies in-place.
@@ -1121,8 +1122,7 @@ class Lg(object):
 		"""Move all missing/unlabeled edges to the hiddenEdges field."""
 		# Move all edges labeled '_' to the hiddenEdges field.
 		for edge in list(self.elabels):
-			if set( list(self.elabels[ edge ]) ) == \
-					set( [ '_' ] ):
+			if len(self.elabels[ edge ]) == 1 and '_' in self.elabels[ edge ]:
 				self.hiddenEdges[ edge ] = self.elabels[ edge ]
 				del self.elabels[ edge ]
 
@@ -1373,7 +1373,7 @@ class Lg(object):
 		# start to build the LG at the object level
 		# add nodes for object with the labels from the first prim
 		lgObj = Lg()
-		for (sid,lprim) in spGT.iteritems():
+		for (sid,lprim) in spGT.items():
 			lgObj.nlabels[sid] = lgGT.nlabels[list(lprim[0])[0]]
 
 		# Compute the specific 'segment-level' graph edges that disagree, at the
@@ -1395,7 +1395,7 @@ class Lg(object):
 			for parentId in thisParentIds:
 				for childId in thisChildIds:
 					# DEBUG: compare only label sets, not values.
-					if not (parentId, childId) in list(self.elabels) or \
+					if not (parentId, childId) in self.elabels or \
 					   (0,[]) != self.cmpEdges(list(self.elabels[ (parentId, childId) ]), list(lgGT.elabels[ (parentId, childId) ])):
 						segEdgeErr.add(thisPair)
 						continue
@@ -1434,12 +1434,12 @@ def mergeLabelLists(llist1, weight1, llist2, weight2, combfn):
 	# have to test whether labels exist
 	# in one or both list.
 	for (label, value) in allLabels:
-		if label in list(llist1) and \
-				label in list(llist2):
+		if label in llist1 and \
+				label in llist2:
 			llist1[ label ] = \
 				combfn( llist1[label], weight1,\
 						llist2[label], weight2 )
-		elif label in list(llist2):
+		elif label in llist2:
 			llist1[ label ] = \
 				weight2 * llist2[label]
 		else:
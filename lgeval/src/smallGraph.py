@@ -17,10 +17,70 @@ Created on Mon Jun 10 04:13:40 2013
 """
 
 import itertools
+import functools
 import cmath
 from math import sqrt
 import compareTools
 
+# Number of canonical forms kept by canonicalForm().
+CANONICAL_CACHE_SIZE = 65536
+
+def labelKey(metric, labels):
+	"""Return a hashable key for a label list such that two lists get the
+	same key exactly when metric reports no difference between them, or
+	None if metric is not an equivalence on label sets (e.g. intersectMetric)."""
+	if metric is compareTools.defaultMetric:
+		return tuple(sorted(set(labels)))
+	if metric is compareTools.filteredMetric:
+		labelS = set(labels) - compareTools.ignoredLabelSet
+		if len(compareTools.selectedLabelSet) > 0:
+			labelS &= compareTools.selectedLabelSet
+		return tuple(sorted(labelS))
+	return None
+
+def rankOf(signatures):
+	"""Replace each signature by its rank among the distinct signatures."""
+	ranks = dict((s,r) for (r,s) in enumerate(sorted(set(signatures.values()))))
+	return dict((n,ranks[s]) for (n,s) in signatures.items())
+
+@functools.lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def canonicalForm(nodeItems, edgeItems):
+	"""Canonical labeling of a small graph given as (id, labelKey) node pairs
+	and ((id,id), labelKey) edge pairs, where absent ('_') edges are removed.
+	Two graphs get the same form iff they are isomorphic.
+	Nodes are first split into classes by color refinement (label, then
+	labels of in/out edges and neighbours); only the orderings within each
+	class are tried, and the smallest edge encoding is kept."""
+	outE = dict((n,[]) for (n,_) in nodeItems)
+	inE = dict((n,[]) for (n,_) in nodeItems)
+	for ((a,b),l) in edgeItems:
+		outE[a].append((b,l))
+		inE[b].append((a,l))
+	rank = rankOf(dict(nodeItems))
+	while True:
+		sig = {}
+		for (n,_) in nodeItems:
+			sig[n] = (rank[n], tuple(sorted((rank[m],l) for (m,l) in outE[n])), \
+				tuple(sorted((rank[m],l) for (m,l) in inE[n])))
+		newRank = rankOf(sig)
+		if len(set(newRank.values())) == len(set(rank.values())):
+			break
+		rank = newRank
+	
+	classes = {}
+	for (n,_) in nodeItems:
+		classes.setdefault(rank[n], []).append(n)
+	classes = [classes[r] for r in sorted(classes)]
+	nodeLabels = dict(nodeItems)
+	labels = tuple(nodeLabels[c[0]] for c in classes for _ in c)
+	best = None
+	for perms in itertools.product(*[itertools.permutations(c) for c in classes]):
+		pos = dict((n,i) for (i,n) in enumerate(itertools.chain(*perms)))
+		code = tuple(sorted((pos[a],pos[b],l) for ((a,b),l) in edgeItems))
+		if best is None or code < best:
+			best = code
+	return (labels, best)
+
 class SmallGraph(object):
 	"""Class for small graphs. The individual nodes
 	and edges have one associated label. 
@@ -76,13 +136,35 @@ class SmallGraph(object):
 			a = str(tab[n])
 			b = str(tab[n+1])			
 			self.edges[(a,b)] = str(tab[n+2])
+	def canonicalKey(self):
+		"""Return a hashable key shared by all isomorphic small graphs, using
+		compareTools.cmpNodes/cmpEdges for labels, or None if these metrics
+		do not allow one (then only iso() can compare graphs)."""
+		nodeItems = []
+		for n in self.nodes:
+			key = labelKey(compareTools.cmpNodes, self.nodes[n])
+			if key is None:
+				return None
+			nodeItems.append((n,key))
+		noEdge = labelKey(compareTools.cmpEdges, ['_'])
+		if noEdge is None:
+			return None
+		edgeItems = []
+		for e in self.edges:
+			key = labelKey(compareTools.cmpEdges, self.edges[e])
+			if key != noEdge:
+				edgeItems.append((e,key))
+		nodeItems.sort()
+		edgeItems.sort()
+		return canonicalForm(tuple(nodeItems), tuple(edgeItems))
+
 	def iso(self,osg):
 		"""true if the two graphs are isomorphisms"""
 		if(len(list(self.nodes)) != len(list(osg.nodes))):# or \ # problem with '_' edges which exist but should be ignored
 			#len(list(self.edges)) != len(list(osg.edges))):
 				return False
-		myLabels = self.nodes.values() + self.edges.values() + ['_'] # add no edge label
-		hisLabels = osg.nodes.values() + osg.edges.values() + ['_'] # add no edge label
+		myLabels = list(self.nodes.values()) + list(self.edges.values()) + ['_'] # add no edge label
+		hisLabels = list(osg.nodes.values()) + list(osg.edges.values()) + ['_'] # add no edge label
 		#myLabels.sort()
 		#hisLabels.sort()
 		#if(myLabels != hisLabels):
@@ -110,7 +192,7 @@ class SmallGraph(object):
 		hisNode = dict(zip(mapping, onodes))
 		#print "Map : " + str(hisNode)
 		#first check the node labels
-		for (my,his) in hisNode.iteritems():
+		for (my,his) in hisNode.items():
 			#if(self.nodes[my] != osg.nodes[his]):
 			if(compareTools.cmpNodes(self.nodes[my] ,osg.nodes[his]) != (0,[])):
 				#print str((self.nodes[my] ,osg.nodes[his])) + ' are diff'
@@ -118,7 +200,7 @@ class SmallGraph(object):
 		#then check the edges, from self to other and reverse
 		checkedEdg = set()
 		#from self to other
-		for (a,b) in self.edges.iterkeys():
+		for (a,b) in self.edges.keys():
 			#id from the other through the mapping
 			(oa,ob) = (str(hisNode[a]),str(hisNode[b]))
 			checkedEdg.add((oa,ob))
@@ -134,14 +216,25 @@ class SmallGraph(object):
 					#print self.edges[(a,b)] + " != " + osg.edges[(oa,ob)]	
 					return False
 		#from other to self except checkedEdg, normaly, only '_' edges are remaining
-		for (oa,ob) in (set(osg.edges.iterkeys()) - checkedEdg):
+		for (oa,ob) in (set(osg.edges.keys()) - checkedEdg):
 			if compareTools.cmpEdges(osg.edges[(oa,ob)], {'_' : 1.0})!= (0,[]):
 				return False
 			
 		return True
 
 	def __eq__(self,o):
+		myKey = self.canonicalKey()
+		if myKey is not None:
+			return myKey == o.canonicalKey()
 		return self.iso(o)
+
+	def __hash__(self):
+		# Without a canonical key, iso() only guarantees equal node counts.
+		key = self.canonicalKey()
+		if key is None:
+			return hash(len(self.nodes))
+		return hash(key)
+
 	def toSVG(self, size = 200, withDef = True, nodeShape='circle'):
 		""" Generate a SVG XML string which draw the nodes (spread on a circle)
 		and edges with all label. 
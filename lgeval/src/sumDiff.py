@@ -13,6 +13,7 @@ import csv
 import collections
 import time
 import os
+from contextlib import redirect_stdout
 
 def addOneError(confM, id1, id2):
         #thanks to "defaultdict" there is nothing to do !
@@ -73,189 +74,228 @@ def writeCSS(output, allID):
         output.write('td:hover{background-color:yellow;} \n')
         output.write('</style></head>\n')
 
-def main():
-        if len(sys.argv) < 3:
-                print("Usage : [[python]] sumDiff.py <file1.diff> <labelsGT.txt> [HTML]\n")
-                print("        Merge results for each line in file1.diff into confusion Matrices.")
-                print("        By default output is sent to stdout in CSV format.")
-                print(" requires list of GT labels from labelsGT.txt.")
-                print("        [HTML] option changes output format to HTML.")
-                sys.exit(0)
-        # Read data from CSV file.
-        fileName = sys.argv[1]
-        labelFile = sys.argv[2]
-        try:
-                fileReader = csv.reader(open(fileName))
-        except:
-                sys.stderr.write('  !! IO Error (cannot open): ' + fileName)
-                sys.exit(1)
-
-        try:
-                labelfileReader = csv.reader(open(labelFile))
-        except:
-                sys.stderr.write('  !! IO Error (cannot open): ' + fileName)
-                sys.exit(1)
-
-        # Read for node and edge label sets.
-        readEdges = False
-        gtNodeLabels = set()
-        gtEdgeLabels = set()
-        for row in labelfileReader:
-                if len(row) == 0:
-                        continue
-                
-                nextEntry = row[0].strip()
-                if nextEntry == 'NODE LABELS:':
-                        continue
-                elif nextEntry == 'EDGE LABELS:':
-                        readEdges = True
-                else:
-                        if readEdges:
-                                gtEdgeLabels.add(nextEntry)
-                        else:
-                                gtNodeLabels.add(nextEntry)
+class ConfusionMatrices(object):
+        """Symbol (node) and relation (edge) label confusions, accumulated
+        from the rows of .diff files (readFile), or rows of differences of
+        each file as they are computed (addRow)."""
+        def __init__(self, fileName=''):
+                self.fileName = fileName
+                #confusion matrix = dict->dict->int
+                self.labelM = collections.defaultdict(collections.defaultdict(int).copy)
+                self.spatRelM = collections.defaultdict(collections.defaultdict(int).copy)
+                #segRelM = collections.defaultdict(collections.defaultdict(int).copy)
 
-        withHTML = False
-        if len(sys.argv) > 3:
-                withHTML = True
-        #confusion matrix = dict->dict->int
-        labelM = collections.defaultdict(collections.defaultdict(int).copy)
-        spatRelM = collections.defaultdict(collections.defaultdict(int).copy)
-        #segRelM = collections.defaultdict(collections.defaultdict(int).copy)
-        
-        allLabel = set()
-        allSR = set()
-        rowCount = -1
+                self.allLabel = set()
+                self.allSR = set()
+                self.rowCount = -1
 
-        # Idenfity all confused symbol labels. We will use this to
-        # present relationship and segmentation confusions separately.
-        symbolLabels = set([])
+                # Idenfity all confused symbol labels. We will use this to
+                # present relationship and segmentation confusions separately.
+                self.symbolLabels = set([])
 
-        nodeErrors = 0
-        allSegErrors = 0
-        allRelErrors = 0
-        fposMerge = 0
-        fnegMerge = 0
+                self.nodeErrors = 0
+                # Messages for invalid rows, written before the matrices.
+                self.messages = []
 
-        for row in fileReader:
-                rowCount += 1
+        def addRow(self, row):
+                self.rowCount += 1
 
                 # Skip blank lines.
                 if len(row) == 0:
-                        continue
+                        return
 
                 entryType = row[0].strip()
                 #skip file names
                 if entryType == "DIFF":
-                        continue
+                        return
                 #process node label errors
                 elif entryType == "*N":
                         # Capture all confused symbol (node) labels.
-                        symbolLabels.add(row[2].strip())
-                        symbolLabels.add(row[5].strip())
+                        self.symbolLabels.add(row[2].strip())
+                        self.symbolLabels.add(row[5].strip())
 
-                        addOneError(labelM,row[2].strip(),row[5].strip())
-                        allLabel.add(row[2].strip())
-                        allLabel.add(row[5].strip())
+                        addOneError(self.labelM,row[2].strip(),row[5].strip())
+                        self.allLabel.add(row[2].strip())
+                        self.allLabel.add(row[5].strip())
 
-                        nodeErrors += 1
+                        self.nodeErrors += 1
 
                 #process link errors
                 elif entryType == "*E":
                         # DEBUG
                         if row[3].strip() == "1.0" or row[6].strip() == "1.0":
-                                print("ERROR at row: " + str(rowCount) + " for file: " + fileName)
-                                print(row)
+                                self.messages.append("ERROR at row: " + str(self.rowCount) + " for file: " + self.fileName)
+                                self.messages.append(str(row))
                         elif not len(row) == 8:
-                                print("INVALID LENGTH at row: " + str(rowCount) + " for file: " + fileName)
-                                print(row)
+                                self.messages.append("INVALID LENGTH at row: " + str(self.rowCount) + " for file: " + self.fileName)
+                                self.messages.append(str(row))
                         
                         outputLabel = row[3].strip()
                         otherLabel = row[6].strip()
-                        addOneError(spatRelM, outputLabel, otherLabel)
+                        addOneError(self.spatRelM, outputLabel, otherLabel)
 
-                        allSR.add(outputLabel)
-                        allSR.add(otherLabel)
+                        self.allSR.add(outputLabel)
+                        self.allSR.add(otherLabel)
 
                 elif entryType == "*S":
                         # Currently ignore segmentation errors (i.e. object-level errors)
-                        continue
-                
-        # Obtain the list of edge labels that do not appear on nodes.
-        # DEBUG: need to consult all GT labels in general case (handling '*' input).
-        mergeEdgeLabel = '*'
-        relOnlyLabels = allSR.difference(symbolLabels).difference(gtNodeLabels)
-        relMergeLabels = relOnlyLabels.union(mergeEdgeLabel)
-
-        # Create a modified confusion histogram where all symbol/segmentation
-        # edge confusions are treated as being of the same type.
-        ShortEdgeMatrix = collections.defaultdict(collections.defaultdict(int).copy)
-        for output in list(spatRelM):
-                olabel = output
-                if not output in relOnlyLabels:
-                        olabel = mergeEdgeLabel
-
-                for target in list(spatRelM[output]):
-                        tlabel = target
-                        if not target in relOnlyLabels:
-                                tlabel = mergeEdgeLabel
-
-                        # Increment the entry for the appropriate matrix.
-                        ShortEdgeMatrix[olabel][tlabel] += spatRelM[output][target]
-
-                        if not olabel == output or not tlabel == target:
-                                allSegErrors += spatRelM[output][target]
-                                if not olabel == output and tlabel == target:
-                                        fposMerge += spatRelM[output][target]
-                                elif not tlabel == target and olabel == output:
-                                        fnegMerge += spatRelM[output][target]
-                        else:
-                                allRelErrors += spatRelM[output][target]
-
-        if withHTML:
-                sys.stdout.write('<html>')
-                writeCSS(sys.stdout, allLabel.union(allSR))
-                print("<font face=\"helvetica,arial,sans-serif\">")
-                print("<h2>LgEval Error Summary</h2>")
-                print(time.strftime("%c"))
-                print("<br>\n")
-                print("<b>File:</b> " + os.path.splitext( os.path.split(fileName)[1] )[0] + "<br>")
-                print("<p>All confusion matrices show only errors. In each matrix, output labels appear in the left column, and target labels in the top row.</p>")
-                print("<UL><LI><A href=\"#nodes\">Node Label Confusion Matrix</A> <LI> <A HREF=\"#ShortEdges\">Edge Label Confusion Matrix (short - ignoring object class confusions)<A> <LI> <A HREF=\"#Edges\">Edge Label Matrix (all labels)</A> </UL>")
-                print ("<hr>")
-                print ("<h2><A NAME=\"nodes\">Node Label Confusion Matrix</A></h2>")
-                print ("<p>"+str(len(allLabel)) + " unique node labels. " + str(nodeErrors) + " errors. ABSENT: a node missing in the output or target graph</p>")
-                affMatHTML(sys.stdout, allLabel, labelM)
-                print("<br><hr><br>")
-                print ("<h2><A NAME=\"ShortEdges\">Edge Label Confusion Matrix (Short)</A></h2>")
-                print ("<p>" + str(len(relOnlyLabels)) + " unique relationship labels + * representing grouping two nodes into an object (any type). " + str(allSegErrors + allRelErrors) + " errors <UL><LI>" + str(allSegErrors) + " Directed segmentation and node pair classification errors (entries in '*'-labeled row and column) <UL><LI><b>" + str(allSegErrors - fposMerge - fnegMerge) + " edges between correctly grouped nodes, but with conflicting classification (* vs. *)</b> <LI>" + str(fposMerge) + " false positive merge edges (* vs. other)<LI>" + str(fnegMerge) + " false negative merge edges (other vs. *) </UL>  <LI>" + str(allRelErrors) + " Directed relationship errors (remaining matrix entries) </UL></p></p>")
-                affMatHTML(sys.stdout, relMergeLabels, ShortEdgeMatrix)
-                #affMatHTML(sys.stdout, relOnlyLabels, spatRelM)
+                        return
+
+        def readFile(self, fileName):
+                with open(fileName) as f:
+                        for row in csv.reader(f):
+                                self.addRow(row)
+
+        def write(self, output, gtNodeLabels, withHTML=False):
+                """Write the three confusion matrices in CSV or HTML format."""
+                for message in self.messages:
+                        output.write(message + "\n")
+                with redirect_stdout(output):
+                        self.writeMatrices(gtNodeLabels, withHTML)
+
+        def writeMatrices(self, gtNodeLabels, withHTML):
+                fileName = self.fileName
+                labelM = self.labelM
+                spatRelM = self.spatRelM
+                allLabel = self.allLabel
+                allSR = self.allSR
+                symbolLabels = self.symbolLabels
+                nodeErrors = self.nodeErrors
+
+                allSegErrors = 0
+                allRelErrors = 0
+                fposMerge = 0
+                fnegMerge = 0
+
+                # Obtain the list of edge labels that do not appear on nodes.
+                # DEBUG: need to consult all GT labels in general case (handling '*' input).
+                mergeEdgeLabel = '*'
+                relOnlyLabels = allSR.difference(symbolLabels).difference(gtNodeLabels)
+                relMergeLabels = relOnlyLabels.union(mergeEdgeLabel)
+
+                # Create a modified confusion histogram where all symbol/segmentation
+                # edge confusions are treated as being of the same type.
+                ShortEdgeMatrix = collections.defaultdict(collections.defaultdict(int).copy)
+                for output in list(spatRelM):
+                        olabel = output
+                        if not output in relOnlyLabels:
+                                olabel = mergeEdgeLabel
+
+                        for target in list(spatRelM[output]):
+                                tlabel = target
+                                if not target in relOnlyLabels:
+                                        tlabel = mergeEdgeLabel
+
+                                # Increment the entry for the appropriate matrix.
+                                ShortEdgeMatrix[olabel][tlabel] += spatRelM[output][target]
+
+                                if not olabel == output or not tlabel == target:
+                                        allSegErrors += spatRelM[output][target]
+                                        if not olabel == output and tlabel == target:
+                                                fposMerge += spatRelM[output][target]
+                                        elif not tlabel == target and olabel == output:
+                                                fnegMerge += spatRelM[output][target]
+                                else:
+                                        allRelErrors += spatRelM[output][target]
+
+                if withHTML:
+                        sys.stdout.write('<html>')
+                        writeCSS(sys.stdout, allLabel.union(allSR))
+                        print("<font face=\"helvetica,arial,sans-serif\">")
+                        print("<h2>LgEval Error Summary</h2>")
+                        print(time.strftime("%c"))
+                        print("<br>\n")
+                        print("<b>File:</b> " + os.path.splitext( os.path.split(fileName)[1] )[0] + "<br>")
+                        print("<p>All confusion matrices show only errors. In each matrix, output labels appear in the left column, and target labels in the top row.</p>")
+                        print("<UL><LI><A href=\"#nodes\">Node Label Confusion Matrix</A> <LI> <A HREF=\"#ShortEdges\">Edge Label Confusion Matrix (short - ignoring object class confusions)<A> <LI> <A HREF=\"#Edges\">Edge Label Matrix (all labels)</A> </UL>")
+                        print ("<hr>")
+                        print ("<h2><A NAME=\"nodes\">Node Label Confusion Matrix</A></h2>")
+                        print ("<p>"+str(len(allLabel)) + " unique node labels. " + str(nodeErrors) + " errors. ABSENT: a node missing in the output or target graph</p>")
+                        affMatHTML(sys.stdout, allLabel, labelM)
+                        print("<br><hr><br>")
+                        print ("<h2><A NAME=\"ShortEdges\">Edge Label Confusion Matrix (Short)</A></h2>")
+                        print ("<p>" + str(len(relOnlyLabels)) + " unique relationship labels + * representing grouping two nodes into an object (any type). " + str(allSegErrors + allRelErrors) + " errors <UL><LI>" + str(allSegErrors) + " Directed segmentation and node pair classification errors (entries in '*'-labeled row and column) <UL><LI><b>" + str(allSegErrors - fposMerge - fnegMerge) + " edges between correctly grouped nodes, but with conflicting classification (* vs. *)</b> <LI>" + str(fposMerge) + " false positive merge edges (* vs. other)<LI>" + str(fnegMerge) + " false negative merge edges (other vs. *) </UL>  <LI>" + str(allRelErrors) + " Directed relationship errors (remaining matrix entries) </UL></p></p>")
+                        affMatHTML(sys.stdout, relMergeLabels, ShortEdgeMatrix)
+                        #affMatHTML(sys.stdout, relOnlyLabels, spatRelM)
                 
-                print("<br><hr><br>")
-                print("<h2><A NAME=\"Edges\">Edge Label Confusion Matrix (All Errors)</A></h2>")
-                print("<p>"+str(len(allSR)) + " unique edge labels representing relationships and node groupings for specific symbol types. " + str(allSegErrors + allRelErrors) + " errors</p>")
-                affMatHTML(sys.stdout, allSR, spatRelM)
+                        print("<br><hr><br>")
+                        print("<h2><A NAME=\"Edges\">Edge Label Confusion Matrix (All Errors)</A></h2>")
+                        print("<p>"+str(len(allSR)) + " unique edge labels representing relationships and node groupings for specific symbol types. " + str(allSegErrors + allRelErrors) + " errors</p>")
+                        affMatHTML(sys.stdout, allSR, spatRelM)
                 
-                print("</font>")
-                sys.stdout.write('</html>')
-        else:
-                print("LgEval Error Summary for: "+fileName)
-                print(time.strftime("%c"))
-                print("")
-                print("NOTE: This file contains 3 confusion matrices.")
-                print("")
-                print("I. Node Label Confusion Matrix: " + str(len(allLabel)) + " unique labels. ABSENT: a node missing in the output or target graph")
-                affMat(sys.stdout, allLabel, labelM)
+                        print("</font>")
+                        sys.stdout.write('</html>')
+                else:
+                        print("LgEval Error Summary for: "+fileName)
+                        print(time.strftime("%c"))
+                        print("")
+                        print("NOTE: This file contains 3 confusion matrices.")
+                        print("")
+                        print("I. Node Label Confusion Matrix: " + str(len(allLabel)) + " unique labels. ABSENT: a node missing in the output or target graph")
+                        affMat(sys.stdout, allLabel, labelM)
                 
-                print("")
-                print("")
-                print("II. Edge Label Confusion Matrix (Short): " + str(len(relOnlyLabels)) + " unique relationship labels + * (merge)")
-                affMat(sys.stdout, relMergeLabels, ShortEdgeMatrix)
+                        print("")
+                        print("")
+                        print("II. Edge Label Confusion Matrix (Short): " + str(len(relOnlyLabels)) + " unique relationship labels + * (merge)")
+                        affMat(sys.stdout, relMergeLabels, ShortEdgeMatrix)
                 
-                print("")
-                print("")
-                print("III. Edge Label Confusion Matrix (Full): " + str(len(allSR)) + " unique labels for relationships and node groupings for specific symbol types")
-                affMat(sys.stdout, allSR, spatRelM)
+                        print("")
+                        print("")
+                        print("III. Edge Label Confusion Matrix (Full): " + str(len(allSR)) + " unique labels for relationships and node groupings for specific symbol types")
+                        affMat(sys.stdout, allSR, spatRelM)
+
+
+def readLabels(labelFile):
+        """Node and edge label sets of a labelsGT.txt file."""
+        readEdges = False
+        gtNodeLabels = set()
+        gtEdgeLabels = set()
+        with open(labelFile) as f:
+                for row in csv.reader(f):
+                        if len(row) == 0:
+                                continue
+                        
+                        nextEntry = row[0].strip()
+                        if nextEntry == 'NODE LABELS:':
+                                continue
+                        elif nextEntry == 'EDGE LABELS:':
+                                readEdges = True
+                        else:
+                                if readEdges:
+                                        gtEdgeLabels.add(nextEntry)
+                                else:
+                                        gtNodeLabels.add(nextEntry)
+        return (gtNodeLabels, gtEdgeLabels)
+
+def main():
+        if len(sys.argv) < 3:
+                print("Usage : [[python]] sumDiff.py <file1.diff> <labelsGT.txt> [HTML]\n")
+                print("        Merge results for each line in file1.diff into confusion Matrices.")
+                print("        By default output is sent to stdout in CSV format.")
+                print(" requires list of GT labels from labelsGT.txt.")
+                print("        [HTML] option changes output format to HTML.")
+                sys.exit(0)
+        # Read data from CSV file.
+        fileName = sys.argv[1]
+        labelFile = sys.argv[2]
+        confusions = ConfusionMatrices(fileName)
+        try:
+                confusions.readFile(fileName)
+        except IOError:
+                sys.stderr.write('  !! IO Error (cannot open): ' + fileName)
+                sys.exit(1)
+
+        # Read for node and edge label sets.
+        try:
+                (gtNodeLabels, _) = readLabels(labelFile)
+        except IOError:
+                sys.stderr.write('  !! IO Error (cannot open): ' + fileName)
+                sys.exit(1)
+
+        withHTML = False
+        if len(sys.argv) > 3:
+                withHTML = True
+        confusions.write(sys.stdout, gtNodeLabels, withHTML)
 
-main()
+if __name__ == '__main__':
+        main()
@@ -12,6 +12,8 @@ import csv
 import math
 import time
 import os
+from array import array
+from contextlib import redirect_stdout
 
 def fmeasure(R,P):
         """Harmonic mean of recall and precision."""
@@ -117,6 +119,58 @@ def printHist(hist,N,field_width):
 
 
 
+class MetricSummary(object):
+        """Streaming aggregate of per-file metrics: each metric is kept as
+        a column (array of floats, one entry per file) together with its running
+        sum, histogram and the indices of files where it is zero.
+
+        Records come from a metrics .csv file (readFile), csv rows (addRow),
+        or directly from an in-process comparison (addMetrics, with the
+        metric list of Lg.compare)."""
+        def __init__(self):
+                self.values = {}
+                self.sums = {}
+                self.hists = {}
+                self.zeroFiles = {}
+                self.fileList = []
+                self.nbEM = 0
+
+        def addMetrics(self, metrics):
+                """Add the (name, value) pairs of one file."""
+                for (name, value) in metrics:
+                        name = name.strip()
+                        value = float(value)
+                        if name not in self.values:
+                                self.values[name] = array('d')
+                                self.sums[name] = 0
+                                self.hists[name] = {}
+                                self.zeroFiles[name] = []
+                        self.values[name].append(value)
+                        self.sums[name] += value
+                        hist = self.hists[name]
+                        hist[value] = hist.get(value, 0) + 1
+                        if value == 0:
+                                self.zeroFiles[name].append(self.nbEM)
+                self.nbEM += 1
+
+        def addRow(self, row):
+                """Add one row of a metrics .csv file."""
+                # Skip blank lines.
+                if len(row) == 0:
+                        return
+                if row[0].strip() == "*M":
+                        self.fileList.append(row[1])
+                        return
+                self.addMetrics((row[i], row[i+1].strip()) for i in range(0,len(row),2))
+
+        def readFile(self, fileName):
+                with open(fileName) as f:
+                        for row in csv.reader(f):
+                                self.addRow(row)
+
+        def zeroCount(self, name):
+                return len(self.zeroFiles[name])
+
 def main():
         if len(sys.argv) < 2:
                 print("Usage : [[python]] sumMetric.py <label> <file1.m> [CSV] \n")
@@ -131,57 +185,32 @@ def main():
         # Read data from CSV file.
         dataSourceLabel = sys.argv[1]
         fileName = sys.argv[2]
+        summary = MetricSummary()
         try:
-                fileReader = csv.reader(open(fileName))
-        except:
+                summary.readFile(fileName)
+        except IOError:
                 sys.stderr.write('  !! IO Error (cannot open): ' + fileName)
                 sys.exit(0)
 
-        # Compile distributions for all metrics.
-        allValues = {}
-        nbEM = 0;
-        fileList = []
-        for row in fileReader:
-                # Skip blank lines.
-                if len(row) == 0:
-                        continue
-
-                entryType = row[0].strip()
-                if entryType == "*M":
-                        fileList = fileList + [row[1]]
-                        continue
-                for i in range(0,len(row),2):
-                        vName =  row[i].strip()
-                        if vName not in allValues:
-                                allValues[vName] = []
-                        allValues[vName] = allValues[vName] \
-                                        + [float(row[i+1].strip())]
-                nbEM+=1
-        
-        # Compile and display the sum for each metric.
-        allSum = {}
-        allZeroCount = {}
-        zeroFileList = {}
-        allHist = {}
-        for v in list(allValues):
-                allSum[v] = sum(allValues[v])
-                #print(str(v) + " = " + str(allSum[v]))
-                allHist[v] = histogramm(allValues[v])
-                allZeroCount[v] = 0
-                for s in range(len(allValues[v])):
-                        if allValues[v][s] == 0:
-                                allZeroCount[v] += 1
-                                if v in list(zeroFileList):
-                                        zeroFileList[v] += '\n' + str(s)
-                                else:
-                                        zeroFileList[v] = str(s)
-                                #print fileList[s]
-                #print ('    Correct expressions: ' + str(nbZ))
+        writeSummary(summary, dataSourceLabel, showCSV)
+
+def writeSummary(summary, dataSourceLabel, showCSV=False, stream=None):
+        """Write the summary of aggregated metrics (the content of Summary.txt,
+        or one CSV line) to stream, by default standard output."""
+        if stream is not None:
+                with redirect_stdout(stream):
+                        writeSummary(summary, dataSourceLabel, showCSV)
+                return
+
+        allValues = summary.values
+        allSum = summary.sums
+        allHist = summary.hists
+        nbEM = summary.nbEM
 
         # Report input counts.
-        correctExps = int(allZeroCount["D_B"])
+        correctExps = summary.zeroCount("D_B")
         #sys.stderr.write( str( zeroFileList[ "D_B" ] ) )
-        correctExps2 = int(allZeroCount["D_E(%)"])
+        correctExps2 = summary.zeroCount("D_E(%)")
         #sys.stdout.write( str( zeroFileList[ "D_E" ] ) )
         if(not correctExps == correctExps2):
                 sys.stderr.write( "Warning : correctExps != correctExps2 (" + str(correctExps) + " vs " + str(correctExps2)+")")
@@ -427,4 +456,5 @@ def main():
                 print('')
 
 
-main()
+if __name__ == '__main__':
+        main()
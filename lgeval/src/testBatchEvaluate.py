@@ -0,0 +1,90 @@
+################################################################
+# testBatchEvaluate.py
+#
+# Tests for the batchEvaluate.py driver of evaluate. Run from this
+# directory with: python3 -m unittest testBatchEvaluate
+################################################################
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 2 + 2
+GOOD_LG = """N,s1,2,1.0
+N,s2,+,1.0
+N,s3,2,1.0
+E,s1,s2,R,1.0
+E,s2,s3,R,1.0
+"""
+
+# 2 - 2, one symbol misclassified
+WRONG_LG = """N,s1,2,1.0
+N,s2,-,1.0
+N,s3,2,1.0
+E,s1,s2,R,1.0
+E,s2,s3,R,1.0
+"""
+
+# Invalid edge, missing the value.
+MALFORMED_LG = """E, node1,node2, SUP
+"""
+
+def writeFile(fileName, text):
+	with open(fileName, 'w') as f:
+		f.write(text)
+
+class TestBatchEvaluate(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmp.cleanup)
+		self.outDir = os.path.join(self.tmp.name, 'out')
+		self.gtDir = os.path.join(self.tmp.name, 'gt')
+		os.makedirs(self.outDir)
+		os.makedirs(self.gtDir)
+		for fName in ['a', 'b', 'c']:
+			writeFile(os.path.join(self.gtDir, fName + '.lg'), GOOD_LG)
+		writeFile(os.path.join(self.outDir, 'a.lg'), GOOD_LG)
+		writeFile(os.path.join(self.outDir, 'b.lg'), MALFORMED_LG)
+		writeFile(os.path.join(self.outDir, 'c.lg'), WRONG_LG)
+		self.resultsDir = os.path.join(self.tmp.name, 'Results_out')
+
+	def evaluate(self):
+		return subprocess.run([ sys.executable, os.path.join(SRC_DIR, 'batchEvaluate.py'),
+				self.outDir, self.gtDir, '-j', '2' ], cwd=self.tmp.name,
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+	def readFileMetrics(self):
+		with open(os.path.join(self.resultsDir, 'FileMetrics.csv')) as f:
+			return [ line.rstrip('\n') for line in f ][1:]
+
+	def checkResults(self, proc):
+		self.assertEqual(proc.returncode, 0, proc.stderr)
+		self.assertIn('done.', proc.stdout)
+		rows = self.readFileMetrics()
+		self.assertEqual(len(rows), 3)
+		self.assertTrue(rows[0].startswith(os.path.join(self.outDir, 'a.lg') + ', Correct,'))
+		self.assertEqual(rows[1], os.path.join(self.outDir, 'b.lg') + ', Error')
+		self.assertTrue(rows[2].startswith(os.path.join(self.outDir, 'c.lg') + ', Incorrect,'))
+		for fName in ['Summary.txt', 'ConfusionMatrices.html', 'ConfusionMatrices.csv']:
+			fileName = os.path.join(self.resultsDir, fName)
+			self.assertTrue(os.path.getsize(fileName) > 0, fName)
+		self.assertFalse(os.path.exists(os.path.join(self.resultsDir, '00_NoErrors')))
+
+	def testMalformedPair(self):
+		proc = self.evaluate()
+		self.checkResults(proc)
+		self.assertIn('Error comparing', proc.stderr)
+		self.assertIn('1 file(s) could not be compared', proc.stdout)
+
+	def testResumeWithMalformedPair(self):
+		self.evaluate()
+		proc = self.evaluate()
+		self.assertEqual(proc.stdout.count('Already processed'), 3)
+		self.checkResults(proc)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,82 @@
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+import typer
+from comer.model.encoder import Encoder
+
+
+def _peak_rss() -> int:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run(
+    memory_efficient: bool,
+    train: bool,
+    batch_size: int,
+    height: int,
+    width: int,
+    steps: int,
+    device: str,
+):
+    # one fresh process per setting so that CPU peak RSS is not shared
+    torch.manual_seed(0)
+    model = Encoder(
+        d_model=256, growth_rate=24, num_layers=16, memory_efficient=memory_efficient
+    ).to(device)
+    model.train(train)
+    img = torch.randn(batch_size, 1, height, width, device=device)
+    mask = torch.zeros(batch_size, height, width, dtype=torch.bool, device=device)
+
+    def step():
+        with torch.set_grad_enabled(train):
+            feature, _ = model(img, mask)
+            if train:
+                feature.mean().backward()
+
+    base = _peak_rss()
+    step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = _peak_rss() - base
+    elapsed = time.perf_counter() - start
+    return peak, steps * batch_size / elapsed
+
+
+def main(
+    batch_size: int = 8,
+    height: int = 128,
+    width: int = 512,
+    steps: int = 5,
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+):
+    # peak memory vs. throughput of the encoder with and without memory_efficient
+    ctx = mp.get_context("spawn")
+    print(f"{'mode':<8}{'memory_efficient':>18}{'peak MiB':>12}{'img/s':>10}")
+    for train in (True, False):
+        for memory_efficient in (False, True):
+            with ctx.Pool(1) as pool:
+                peak, throughput = pool.apply(
+                    _run,
+                    (memory_efficient, train, batch_size, height, width, steps, device),
+                )
+            mode = "train" if train else "eval"
+            print(
+                f"{mode:<8}{str(memory_efficient):>18}"
+                f"{peak / 2 ** 20:>12.1f}{throughput:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    typer.run(main)
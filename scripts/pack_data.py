@@ -0,0 +1,21 @@
+import os
+from zipfile import ZipFile
+
+import typer
+from comer.datamodule.packed import pack_data
+
+
+def main(zipfile_path: str = "data.zip", out_dir: str = "data_packed"):
+    # pack every dataset in data.zip into out_dir/{train, 2014, 2016, 2019}
+    with ZipFile(zipfile_path) as archive:
+        folders = sorted(
+            name.split("/")[1]
+            for name in archive.namelist()
+            if name.startswith("data/") and name.endswith("/caption.txt")
+        )
+        for folder in folders:
+            pack_data(archive, folder, os.path.join(out_dir, folder))
+
+
+if __name__ == "__main__":
+    typer.run(main)
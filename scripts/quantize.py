@@ -0,0 +1,86 @@
+import os
+import time
+import warnings
+from itertools import islice
+from typing import List, Tuple
+
+import torch
+import typer
+from comer.datamodule import CROHMEDatamodule
+from comer.lit_comer import LitCoMER
+from comer.quantization import (
+    QUANTIZATION_MODES,
+    load_quantized,
+    quantize,
+    save_quantized,
+)
+from pytorch_lightning import seed_everything
+
+seed_everything(7)
+
+# dense blocks concatenate features of different ranges, which is expected here
+warnings.filterwarnings("ignore", message="All inputs of this cat operator")
+
+
+def _evaluate(model: LitCoMER, dm: CROHMEDatamodule) -> Tuple[float, float]:
+    # ExpRate and beam search latency per image in ms
+    model.exprate_recorder.reset()
+    n_imgs, elapsed = 0, 0.0
+    with torch.no_grad():
+        for batch in dm.test_dataloader():
+            start = time.perf_counter()
+            hyps, hyp_lens, _ = model.padded_joint_search(batch.imgs, batch.mask)
+            elapsed += time.perf_counter() - start
+            model._record_exprate(hyps, hyp_lens, batch)
+            n_imgs += len(batch)
+    return float(model.exprate_recorder.compute()), elapsed / n_imgs * 1000
+
+
+def main(
+    version: str,
+    mode: str = "dynamic",
+    test_year: List[str] = typer.Option(["2014", "2016", "2019"]),
+    calibration_batches: int = 32,
+    eval_batch_size: int = 4,
+):
+    # quantize the checkpoint of version to int8 and compare it with fp32 on cpu
+    assert mode in QUANTIZATION_MODES, f"mode should be one of {QUANTIZATION_MODES}"
+    ckp_folder = os.path.join("lightning_logs", f"version_{version}", "checkpoints")
+    fnames = os.listdir(ckp_folder)
+    assert len(fnames) == 1
+    ckp_path = os.path.join(ckp_folder, fnames[0])
+    print(f"Quantize with fname: {fnames[0]}")
+
+    model = LitCoMER.load_from_checkpoint(ckp_path, map_location="cpu")
+    calibration = []
+    if mode == "static":
+        # observe activation ranges on training images, not on the test sets
+        dm = CROHMEDatamodule(eval_batch_size=eval_batch_size)
+        dm.setup("fit")
+        calibration = islice(dm.train_dataloader(), calibration_batches)
+    quantize(model, mode, calibration)
+
+    out_path = os.path.join("lightning_logs", f"version_{version}", f"int8_{mode}.pt")
+    save_quantized(model, out_path, mode)
+    print(f"Save quantized model to: {out_path}")
+
+    fp32 = LitCoMER.load_from_checkpoint(ckp_path, map_location="cpu").eval()
+    int8 = load_quantized(out_path)
+
+    print(
+        f"{'year':<6}{'fp32 ExpRate':>14}{'int8 ExpRate':>14}{'delta':>9}"
+        f"{'fp32 ms/img':>13}{'int8 ms/img':>13}{'speedup':>9}"
+    )
+    for year in test_year:
+        dm = CROHMEDatamodule(test_year=year, eval_batch_size=eval_batch_size)
+        dm.setup("test")
+        exprate, latency = _evaluate(fp32, dm)
+        q_exprate, q_latency = _evaluate(int8, dm)
+        print(
+            f"{year:<6}{exprate:>14.4f}{q_exprate:>14.4f}{q_exprate - exprate:>+9.4f}"
+            f"{latency:>13.1f}{q_latency:>13.1f}{latency / q_latency:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -17,12 +17,8 @@ python scripts/test/test.py $version $test_year
 # copy predictions to target folder
 cp result.zip $dir/$test_year.zip
 
-# dump predictions to temp
-mkdir -p test_temp/result
-unzip -q result.zip -d test_temp/result
-
 # convert tex to symlg
-tex2symlg test_temp/result test_temp/pred_symlg
+tex2symlg result.zip test_temp/pred_symlg
 
 # evaluate two symlg folder
 evaluate test_temp/pred_symlg data/$test_year/symLg >/dev/null 2>&1
@@ -0,0 +1,46 @@
+import zipfile
+
+import typer
+from comer.utils.edit_distance import exprate_table
+
+
+def main(
+    test_year: str,
+    error_tol: int,
+    result_path: str = "result.zip",
+    zipfile_path: str = "data.zip",
+    num_workers: int = 0,
+):
+    # token level ExpRate of result.zip, without converting to symLG
+    refs = {}
+    with zipfile.ZipFile(zipfile_path) as archive:
+        with archive.open(f"data/{test_year}/caption.txt", "r") as f:
+            for line in f.readlines():
+                tmp = line.decode().strip().split()
+                refs[tmp[0]] = tmp[1:]
+
+    preds = {}
+    with zipfile.ZipFile(result_path) as archive:
+        for name in archive.namelist():
+            img_base, pred = archive.read(name).decode().split("\n", 1)
+            preds[img_base[1:]] = pred.strip().strip("$").split()
+
+    missing = refs.keys() - preds.keys()
+    if missing:
+        print(f"{len(missing)} images are not predicted, counted as wrong")
+
+    img_bases = sorted(refs.keys() & preds.keys())
+    rates = exprate_table(
+        [preds[img_base] for img_base in img_bases],
+        [refs[img_base] for img_base in img_bases],
+        error_tol=error_tol,
+        num_workers=num_workers,
+    )
+    rates = rates * len(img_bases) / len(refs)
+
+    for i, rate in enumerate(rates):
+        print(f"Exprate {i} tolerated: {rate * 100:.3f}")
+
+
+if __name__ == "__main__":
+    typer.run(main)